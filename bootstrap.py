@@ -21,6 +21,22 @@ from engage.utils.system_info_bootstrap import get_platform
 
 from engage.utils.find_exe import find_executable, find_python_executable, get_python_search_paths
 from engage.utils.log_setup import setup_logger, parse_log_options, add_log_option
+from engage.utils.venv_template_bootstrap import get_file_digest, \
+     get_template_key, get_virtualenv_template, clone_virtualenv
+
+# Python packages installed into the engage virtualenv. Each entry is a list
+# of package files to look for in sw_packages, and the package name or url
+# to give pip if none of them are present.
+BOOTSTRAP_PACKAGES = [# JF 2012-05-11: Don't install provision and its
+                      # dependencies - moving down to DJM level.
+                      #(["paramiko-1.7.6.zip"], "paramiko"),
+                      #(["apache-libcloud-0.6.2.tar.bz2"], None),
+                      #(["argparse-1.2.1.tar.gz"], "argparse"),
+                      #(["provision-0.9.3-dev.tar.gz"], None),
+                      (["nose-1.0.0.tar.gz"], "nose"),
+                      (["engage_utils-1.0.tar.gz"], "git+git://github.com/genforma/engage-utils.git")]
+
+DEFAULT_VENV_TEMPLATE_DIR = "~/.engage/venv_templates"
 
 
 def compare_versions(vstr1, vstr2):
@@ -54,17 +70,20 @@ def get_virtualenv_version(exe_path):
     ## return [int(component) if component.isdigit() else component
     ##         for component in ver_string.split(".")]
 
-def create_virtualenv(desired_python_dir, logger, package_dir,
-                      base_python_exe=None,
-                      never_download=False):
-    virtualenv_search_dirs = get_python_search_paths()
+def find_virtualenv(logger, base_python_exe=None):
+    """Returns a (python_exe, virtualenv_exe, virtualenv_version) triple"""
     python_exe = find_python_executable(logger, explicit_path=base_python_exe)
     # we start our virtualenv executable search at the same place as where we have
     # the python executable. Then, we check a bunch of well-known places to stick
     # virtualenv
     virtualenv_search_dirs = [os.path.dirname(python_exe)] + get_python_search_paths()
     virtualenv = find_executable("virtualenv", virtualenv_search_dirs, logger)
-    version = get_virtualenv_version(virtualenv)
+    return (python_exe, virtualenv, get_virtualenv_version(virtualenv))
+
+def create_virtualenv(desired_python_dir, logger, package_dir,
+                      base_python_exe=None,
+                      never_download=False):
+    (python_exe, virtualenv, version) = find_virtualenv(logger, base_python_exe)
     if compare_versions("1.6.1", version)>=0:
         # --never-download and --extra-search-dir were added in 1.6.1
         has_options = True
@@ -151,6 +170,88 @@ def run_install(engage_bin_dir, sw_packages_dir, package_file_list,
     logger.info("pip install successful")
 
 
+def get_pycrypto_package_files(platform):
+    return ["pycrypto-2.3-%s.tar.gz" % platform, "pycrypto-2.3.tar.gz"]
+
+
+def install_bootstrap_packages(engage_bin_dir, sw_packages_dir, logger,
+                               never_download=False):
+    platform = get_platform()
+    if not is_package_installed(engage_bin_dir, "Crypto.Cipher.AES", logger):
+        if platform=="linux64" and (not never_download):
+            run_apt_install("python-crypto", logger)
+        else:
+            # Pycrypto may be preinstalled on the machine.
+            # If so, we don't install our local copy, as installation
+            # can be expensive (involves a g++ compile).
+            run_install(engage_bin_dir, sw_packages_dir,
+                        get_pycrypto_package_files(platform),
+                        logger, "pycrypto",
+                        never_download=never_download)
+
+    # run install for all of the bootstrap packages
+    for (package_file_list, alternate) in BOOTSTRAP_PACKAGES:
+        run_install(engage_bin_dir, sw_packages_dir,
+                    package_file_list,
+                    logger, alternate,
+                    never_download=never_download)
+
+
+def get_virtualenv_template_key(kind, logger, sw_packages_dir, options):
+    """The template key is a digest of everything that determines the contents
+    of the virtualenv: the platform, the python executable and its version,
+    the virtualenv version, and, for the engage virtualenv, the package
+    manifest (the local package files we would install and their contents).
+    """
+    (python_exe, virtualenv, virtualenv_version) = \
+        find_virtualenv(logger, options.python_exe)
+    subproc = subprocess.Popen([python_exe, "-c", "import sys; print sys.version"],
+                               shell=False, stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT)
+    python_version = subproc.communicate()[0].rstrip()
+    platform = get_platform()
+    components = [kind, platform, os.path.realpath(python_exe), python_version,
+                  virtualenv_version, str(options.never_download)]
+    if kind=="engage":
+        manifest = [(get_pycrypto_package_files(platform), "pycrypto")] + \
+                   BOOTSTRAP_PACKAGES
+        for (package_file_list, alternate) in manifest:
+            component = str(alternate)
+            for package_file in package_file_list:
+                package_path = os.path.join(sw_packages_dir, package_file)
+                if os.path.exists(package_path):
+                    component = "%s %s" % (package_file,
+                                           get_file_digest(package_path))
+                    break
+            components.append(component)
+    return get_template_key(components)
+
+
+def setup_virtualenv(kind, venv_dir, logger, sw_packages_dir, options):
+    """Create the virtualenv of the specified kind ("engage", which includes
+    the bootstrap packages, or "python", for the deployed apps). Unless
+    disabled, we clone it from a template virtualenv, building the template
+    first if this is the first bootstrap on the host with the same inputs.
+    """
+    def build(build_dir):
+        create_virtualenv(build_dir, logger,
+                          sw_packages_dir,
+                          base_python_exe=options.python_exe,
+                          never_download=options.never_download)
+        if kind=="engage":
+            install_bootstrap_packages(os.path.join(build_dir, "bin"),
+                                       sw_packages_dir, logger,
+                                       never_download=options.never_download)
+    if not options.use_venv_template:
+        build(venv_dir)
+        return
+    key = get_virtualenv_template_key(kind, logger, sw_packages_dir, options)
+    template_root = os.path.abspath(os.path.expanduser(options.venv_template_dir))
+    template_dir = get_virtualenv_template(template_root, "%s-%s" % (kind, key),
+                                           build, logger)
+    clone_virtualenv(template_dir, venv_dir, logger)
+
+
 def main(argv):
     usage = "usage: %prog [options] deployment_home"
     parser = OptionParser(usage=usage)
@@ -172,6 +273,15 @@ def main(argv):
                       action="store_true",
                       help="If specified, never try to download packages during bootstrap. If a package is required, exit with an error.",
                       dest="never_download")
+    parser.add_option("--venv-template-dir",
+                      default=DEFAULT_VENV_TEMPLATE_DIR,
+                      help="Directory for the virtualenv templates shared by deployment homes on this host (defaults to %s)" % DEFAULT_VENV_TEMPLATE_DIR,
+                      dest="venv_template_dir")
+    parser.add_option("--no-venv-template",
+                      default=True,
+                      action="store_false",
+                      help="If specified, build the virtualenvs from scratch rather than cloning them from a template",
+                      dest="use_venv_template")
     parser.add_option("--include-test-data",
                       default=False,
                       action="store_true",
@@ -219,10 +329,9 @@ def main(argv):
     sw_packages_src_loc = os.path.join(base_src_dir, "sw_packages")
     sw_packages_dst_loc = os.path.join(engage_home, "sw_packages")
 
-    create_virtualenv(engage_home, logger,
-                      sw_packages_src_loc,
-                      base_python_exe=options.python_exe,
-                      never_download=options.never_download)
+    # the bootstrap packages are installed as a part of the virtualenv
+    setup_virtualenv("engage", engage_home, logger, sw_packages_src_loc,
+                     options)
     logger.info("Created python virtualenv for engage")
 
     # copy this bootstrap script and the upgrade script
@@ -272,39 +381,10 @@ def main(argv):
     # copy the sw_packages directory
     copy_tree(sw_packages_src_loc, sw_packages_dst_loc, logger)
 
-    if not is_package_installed(engage_bin_dir, "Crypto.Cipher.AES", logger):
-        if get_platform()=="linux64" and (not options.never_download):
-            run_apt_install("python-crypto", logger)
-        else:
-            # Pycrypto may be preinstalled on the machine.
-            # If so, we don't install our local copy, as installation
-            # can be expensive (involves a g++ compile).
-            run_install(engage_bin_dir, sw_packages_src_loc,
-                        ["pycrypto-2.3-%s.tar.gz" % platform, "pycrypto-2.3.tar.gz"],
-                        logger, "pycrypto",
-                        never_download=options.never_download)
-
-    bootstrap_packages = [# JF 2012-05-11: Don't install provision and its
-                          # dependencies - moving down to DJM level.
-                          #(["paramiko-1.7.6.zip"], "paramiko"),
-                          #(["apache-libcloud-0.6.2.tar.bz2"], None),
-                          #(["argparse-1.2.1.tar.gz"], "argparse"),
-                          #(["provision-0.9.3-dev.tar.gz"], None),
-                          (["nose-1.0.0.tar.gz"], "nose"),
-                          (["engage_utils-1.0.tar.gz"], "git+git://github.com/genforma/engage-utils.git")]
-    # run install for all of the bootstrap packages
-    for (package_file_list, alternate) in bootstrap_packages:
-        run_install(engage_bin_dir, sw_packages_src_loc,
-                    package_file_list,
-                    logger, alternate,
-                    never_download=options.never_download)
-    
     # create a virtualenv for the deployed apps
     deployed_virtualenv = os.path.join(deployment_home, "python")
-    create_virtualenv(deployed_virtualenv, logger,
-                      sw_packages_src_loc,
-                      base_python_exe=options.python_exe,
-                      never_download=options.never_download)
+    setup_virtualenv("python", deployed_virtualenv, logger,
+                     sw_packages_src_loc, options)
     logger.info("Created a virtualenv for deployed apps")
 
     deployed_config_dir = os.path.join(deployment_home, "config")
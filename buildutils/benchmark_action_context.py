@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+"""Benchmark for the construction of action.Context objects. Drivers create
+a Context in their Manager constructor, so this is paid for every resource
+on each svcctl, backup, and upgrade run, even if the driver never renders
+a template. We compare against a baseline which does what Context
+originally did: wrap the entire resource json in _Config objects and build
+the flattened substitution map up front.
+"""
+import sys
+import os.path
+import time
+import logging
+from optparse import OptionParser
+
+try:
+    import engage.drivers.action as action
+except ImportError:
+    python_pkg_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "../python_pkg"))
+    if not os.path.exists(python_pkg_path):
+        raise # can't find path, just bail out
+    sys.path.append(python_pkg_path)
+    import engage.drivers.action as action
+
+
+class EagerConfig(object):
+    """The original _Config, which wrapped all nested values up front"""
+    def __init__(self, props, _qualified_name=None):
+        self._props = {}
+        self._qualified_name = _qualified_name
+        for (prop_name, prop_val) in props.items():
+            self._props[prop_name] = self._wrap_child_val(prop_name, prop_val)
+
+    def _get_child_prop_qname(self, name):
+        if self._qualified_name:
+            return self._qualified_name + "." + name
+        else:
+            return name
+
+    def _wrap_child_val(self, prop_name, prop_val):
+        if isinstance(prop_val, dict):
+            return EagerConfig(prop_val, self._get_child_prop_qname(prop_name))
+        elif isinstance(prop_val, list):
+            return [self._wrap_child_val(prop_name + "[%d]" % i, prop_val[i])
+                    for i in range(len(prop_val))]
+        else:
+            return prop_val
+
+    def _make_flattened_map(self, map):
+        for (prop_name, prop_val) in self._props.items():
+            key = self._get_child_prop_qname(prop_name)
+            if isinstance(prop_val, EagerConfig):
+                prop_val._make_flattened_map(map)
+            elif isinstance(prop_val, list):
+                map[key] = prop_val.__repr__()
+            else:
+                map[key] = str(prop_val)
+
+    def __repr__(self):
+        return self._props.__repr__()
+
+
+def eager_context(resource_json):
+    props = EagerConfig(resource_json)
+    substitutions = {}
+    props._make_flattened_map(substitutions)
+    return (props, substitutions)
+
+
+def generate_resource_json(i, num_env):
+    """Generate the json for a resource instance, as returned by
+    ResourceMD.to_json().
+    """
+    def key(j):
+        return {u"name":u"resource-type-%d" % (j % 50),
+                u"version":u"1.%d" % (j % 7)}
+    return {u"id":u"resource-%d" % i, u"key":key(i),
+            u"properties":{u"installed":True},
+            u"config_port":{u"home":u"/opt/app/resource-%d" % i,
+                            u"port":8000+i, u"log_level":u"info",
+                            u"log_dir":u"/opt/app/resource-%d/log" % i,
+                            u"pid_file":u"/opt/app/resource-%d/pid" % i},
+            u"input_ports":{u"host":{u"hostname":u"localhost",
+                                     u"os_type":u"linux",
+                                     u"os_user_name":u"engage",
+                                     u"genforma_home":u"/opt/app",
+                                     u"sudo_password":u"GenForma/engage/sudo_password"},
+                            u"python":{u"home":u"/opt/app/python/bin/python",
+                                       u"PYTHONPATH":u"/opt/app/python/lib/python2.7/site-packages",
+                                       u"version":u"2.7"}},
+            u"output_ports":{u"service":{u"url":u"http://localhost:%d/" % (8000+i),
+                                         u"port":8000+i}},
+            u"inside":{u"id":u"master-host",
+                       u"key":{u"name":u"ubuntu-linux", u"version":u"10.04"},
+                       u"port_mapping":{u"host":u"host"}},
+            u"environment":[{u"id":u"resource-%d" % j, u"key":key(j),
+                             u"port_mapping":{}}
+                            for j in range(num_env)],
+            u"peers":[]}
+
+
+def time_fn(fn, resources):
+    start = time.time()
+    for r in resources:
+        fn(r)
+    return time.time() - start
+
+
+def main(argv):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("-n", "--num-resources", dest="num_resources",
+                      type="int", default=2000,
+                      help="Number of resource instances (default 2000)")
+    parser.add_option("-e", "--num-env", dest="num_env", type="int",
+                      default=5,
+                      help="Number of environment dependencies per resource (default 5)")
+    (options, args) = parser.parse_args(argv)
+    resources = [generate_resource_json(i, options.num_env)
+                 for i in range(options.num_resources)]
+    logger = logging.getLogger("benchmark")
+    filepath = os.path.abspath(__file__)
+    def lazy(r):
+        ctx = action.Context(r, logger, filepath)
+        ctx.props.config_port.home # typical access in a driver
+    def lazy_with_template(r):
+        ctx = action.Context(r, logger, filepath)
+        ctx.props.config_port.home
+        ctx.substitutions
+    def eager(r):
+        (props, substitutions) = eager_context(r)
+        props._props["config_port"]._props["home"]
+    print "%d resources, %d environment dependencies each" % \
+          (options.num_resources, options.num_env)
+    print "%-32s %14s" % ("", "usec/manager")
+    for (name, fn) in [("eager (original)", eager),
+                       ("lazy Context", lazy),
+                       ("lazy Context + substitutions", lazy_with_template)]:
+        t = time_fn(fn, resources)
+        print "%-32s %14.1f" % (name, 1000000.0*t/options.num_resources)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+"""Benchmark for engage.utils.json_backend. We load and dump our real
+metadata files (the resource definitions, the software library, and the
+packages.json files of the drivers), plus a synthetic installed resources
+file with many resource instances, using each available backend, in both
+the pretty-printed (indent=2, sort_keys) and compact modes. The results of
+each backend are checked against the stdlib json module.
+"""
+import sys
+import os
+import os.path
+import glob
+import time
+import json
+from optparse import OptionParser
+
+try:
+    import engage.utils.json_backend as json_backend
+except ImportError:
+    python_pkg_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "../python_pkg"))
+    if not os.path.exists(python_pkg_path):
+        raise # can't find path, just bail out
+    sys.path.append(python_pkg_path)
+    import engage.utils.json_backend as json_backend
+
+BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+
+def get_metadata_files():
+    files = [os.path.join(BASE_DIR, "metadata/resource_definitions.json"),
+             os.path.join(BASE_DIR, "metadata/resource_library.json")]
+    files.extend(sorted(glob.glob(os.path.join(BASE_DIR,
+                                               "python_pkg/engage/drivers/*/*/packages.json"))))
+    return files
+
+
+def generate_installed_resources(num_resources):
+    """Generate an installed_resources.json-like list. The instances are
+    modeled on those in the install solutions generated by the config
+    engine.
+    """
+    resources = []
+    for i in range(num_resources):
+        resources.append({u"id":u"resource-%d" % i,
+                          u"key":{u"name":u"resource-%d" % (i % 50),
+                                  u"version":u"1.%d" % (i % 7)},
+                          u"properties":{u"installed":True,
+                                         u"use_as_install_target":False},
+                          u"config_port":{u"home":u"/opt/app/resource-%d" % i,
+                                          u"port":8000+i,
+                                          u"log_level":u"info"},
+                          u"input_ports":{u"host":{u"hostname":u"localhost",
+                                                   u"os_user_name":u"engage",
+                                                   u"genforma_home":u"/opt/app"}},
+                          u"output_ports":{u"service":{u"url":u"http://localhost:%d/" % (8000+i)}},
+                          u"inside":{u"id":u"master-host",
+                                     u"key":{u"name":u"ubuntu-linux",
+                                             u"version":u"10.04"},
+                                     u"port_mapping":{u"host":u"host"}},
+                          u"environment":[{u"id":u"resource-%d" % j,
+                                           u"key":{u"name":u"resource-%d" % (j % 50),
+                                                   u"version":u"1.%d" % (j % 7)},
+                                           u"port_mapping":{}}
+                                          for j in range(max(0, i-3), i)],
+                          u"peers":[]})
+    return resources
+
+
+def time_fn(fn, repeat):
+    start = time.time()
+    for i in range(repeat):
+        result = fn()
+    return (time.time() - start, result)
+
+
+def benchmark(name, text, repeat):
+    """Time loads and dumps of text for each backend. Returns True if all
+    the backends agree with the stdlib module.
+    """
+    expected = json.loads(text)
+    ok = True
+    for backend_name in json_backend.get_available_backends():
+        json_backend.set_backend(backend_name)
+        (load_time, data) = time_fn(lambda: json_backend.loads(text), repeat)
+        (pretty_time, pretty) = \
+            time_fn(lambda: json_backend.dumps(data, indent=2, sort_keys=True),
+                    repeat)
+        (compact_time, compact) = \
+            time_fn(lambda: json_backend.dumps(data, compact=True), repeat)
+        print "%-28s %-10s %10.2f %10.2f %10.2f %8.0f%%" % \
+              (name, backend_name, 1000.0*load_time/repeat,
+               1000.0*pretty_time/repeat, 1000.0*compact_time/repeat,
+               100.0*len(compact)/max(len(pretty), 1))
+        if data!=expected or json.loads(pretty)!=expected or \
+           json.loads(compact)!=expected:
+            print "ERROR: %s backend results for %s do not match json module" % \
+                  (backend_name, name)
+            ok = False
+    return ok
+
+
+def main(argv):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("-r", "--repeat", dest="repeat", type="int",
+                      default=20, help="Number of repetitions (default 20)")
+    parser.add_option("-n", "--num-resources", dest="num_resources",
+                      type="int", default=500,
+                      help="Number of resources in the synthetic installed resources file (default 500)")
+    (options, args) = parser.parse_args(argv)
+    print "Default backend: %s, available backends: %s" % \
+          (json_backend.get_backend_name(),
+           ", ".join(json_backend.get_available_backends()))
+    print "%-28s %-10s %10s %10s %10s %9s" % \
+          ("file", "backend", "load (ms)", "pretty (ms)", "compact (ms)",
+           "size")
+    default_backend = json_backend.get_backend_name()
+    ok = True
+    try:
+        for filename in get_metadata_files():
+            with open(filename, "rb") as f:
+                text = f.read()
+            name = os.path.relpath(filename, BASE_DIR)
+            if len(name)>28:
+                name = "..." + name[-25:]
+            ok = benchmark(name, text, options.repeat) and ok
+        text = json.dumps(generate_installed_resources(options.num_resources),
+                          indent=2, sort_keys=True)
+        ok = benchmark("installed_resources (%d)" % options.num_resources,
+                       text, options.repeat) and ok
+    finally:
+        json_backend.set_backend(default_backend)
+    if not ok:
+        return 1
+    print "Results match."
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
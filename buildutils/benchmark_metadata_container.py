@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+"""Benchmark for json_metadata_utils.MetadataContainer. We generate a
+synthetic library with many resource keys, each having several entries
+distinguished by match properties (as for platform-specific packages), and
+compare lookups against a linear scan of the entries (the original
+implementation). The results of the two are also checked for agreement.
+"""
+import sys
+import os.path
+import time
+import random
+from optparse import OptionParser
+
+try:
+    import engage.engine.json_metadata_utils as json_metadata_utils
+except ImportError:
+    python_pkg_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "../python_pkg"))
+    if not os.path.exists(python_pkg_path):
+        raise # can't find path, just bail out
+    sys.path.append(python_pkg_path)
+    import engage.engine.json_metadata_utils as json_metadata_utils
+
+from engage.drivers.resource_metadata import ResourceMD
+
+OSES = [u"mac-osx", u"linux", u"windows-xp", u"solaris"]
+ARCHES = [u"x86", u"x86_64", u"ppc"]
+
+
+class Entry(object):
+    def __init__(self, id, key, match_properties):
+        self.id = id
+        self.key = key
+        self.match_properties = match_properties
+
+
+class LinearContainer(object):
+    """Baseline: the original implementation, which scans the entries for
+    a key and parses the match properties on every lookup.
+    """
+    def __init__(self):
+        self.entries = {}
+
+    def add_entry(self, entry):
+        key_hash = json_metadata_utils._hash_string_for_key(entry.key)
+        self.entries.setdefault(key_hash, []).append(entry)
+
+    def get_entry(self, resource_md):
+        key_hash = json_metadata_utils._hash_string_for_key(resource_md.key)
+        for entry in self.entries.get(key_hash, []):
+            if json_metadata_utils._is_valid_for_resource(entry.key,
+                                                          entry.match_properties,
+                                                          resource_md):
+                return entry
+        return None
+
+
+def generate_entries(num_entries, entries_per_key, rnd):
+    entries = []
+    for i in range(num_entries):
+        key = {u"name":u"resource-%d" % (i/entries_per_key),
+               u"version":u"1.%d" % ((i/entries_per_key) % 7)}
+        j = i % entries_per_key
+        match = {u"config_port.os":OSES[j % len(OSES)],
+                 u"config_port.arch":ARCHES[(j/len(OSES)) % len(ARCHES)]}
+        if j==entries_per_key-1:
+            match = {} # fallback entry which matches any platform
+        entries.append(Entry(i, key, match))
+    return entries
+
+
+def generate_resources(num_resources, num_keys, rnd):
+    resources = []
+    for i in range(num_resources):
+        k = rnd.randint(0, num_keys)
+        key = {u"name":u"resource-%d" % k, u"version":u"1.%d" % (k % 7)}
+        resources.append(ResourceMD(u"r%d" % i, key,
+                                    config_port={u"os":rnd.choice(OSES + [u"aix"]),
+                                                 u"arch":rnd.choice(ARCHES)}))
+    return resources
+
+
+def time_container(container_class, entries, resources):
+    start = time.time()
+    c = container_class()
+    for e in entries:
+        c.add_entry(e)
+    load_time = time.time() - start
+    start = time.time()
+    results = [c.get_entry(r) for r in resources]
+    return (load_time, time.time() - start, results)
+
+
+def main(argv):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("-e", "--entries", dest="entries", type="int",
+                      default=50000, help="Number of library entries (default 50000)")
+    parser.add_option("-k", "--entries-per-key", dest="entries_per_key",
+                      type="int", default=13,
+                      help="Number of entries for each resource key (default 13)")
+    parser.add_option("-l", "--lookups", dest="lookups", type="int",
+                      default=20000, help="Number of lookups (default 20000)")
+    (options, args) = parser.parse_args(argv)
+    rnd = random.Random(42)
+    entries = generate_entries(options.entries, options.entries_per_key, rnd)
+    resources = generate_resources(options.lookups,
+                                   options.entries/options.entries_per_key,
+                                   rnd)
+    print "%d entries, %d entries per key, %d lookups" % \
+          (options.entries, options.entries_per_key, options.lookups)
+    (base_load, base_lookup, base_results) = \
+        time_container(LinearContainer, entries, resources)
+    (new_load, new_lookup, new_results) = \
+        time_container(json_metadata_utils.MetadataContainer, entries,
+                       resources)
+    print "%-20s %10s %10s %14s" % ("", "load (s)", "lookup (s)",
+                                    "lookups/sec")
+    for (name, load, lookup) in [("linear scan", base_load, base_lookup),
+                                 ("MetadataContainer", new_load, new_lookup)]:
+        print "%-20s %10.3f %10.3f %14.0f" % (name, load, lookup,
+                                              options.lookups/max(lookup, 0.000001))
+    mismatches = [r.id for (r, a, b) in zip(resources, base_results, new_results)
+                  if a is not b]
+    if len(mismatches)>0:
+        print "ERROR: %d lookups returned different entries, e.g. %s" % \
+              (len(mismatches), mismatches[0:5])
+        return 1
+    print "Results match."
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+"""Memory benchmark for resource_metadata.ResourceMD and ResourceRef. We
+create the metadata for a synthetic deployment with many resource
+instances (as parsed from installed_resources.json), and then the Config
+objects that the drivers create from it. The sizes are compared against a
+baseline using the original representation (instances with a __dict__, a
+separate key dictionary per instance and reference, and eager conversion
+of all the ports to Config objects).
+
+Sizes are computed by walking the object graph and adding up
+sys.getsizeof() for each distinct object, so shared objects are only
+counted once.
+"""
+import sys
+import os.path
+import time
+from optparse import OptionParser
+
+try:
+    import engage.drivers.resource_metadata as resource_metadata
+except ImportError:
+    python_pkg_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "../python_pkg"))
+    if not os.path.exists(python_pkg_path):
+        raise # can't find path, just bail out
+    sys.path.append(python_pkg_path)
+    import engage.drivers.resource_metadata as resource_metadata
+
+NUM_TYPES = 50
+
+
+class BaselineRef:
+    """The original ResourceRef"""
+    def __init__(self, id, key, port_mapping=None):
+        self.id = id
+        self.key = key
+        self.port_mapping = port_mapping or {}
+
+
+class BaselineMD:
+    """The original ResourceMD"""
+    def __init__(self, id, key, properties=None, config_port=None,
+                 input_ports=None, output_ports=None,
+                 inside=None, environment=None, peers=None,
+                 driver_module_name=None, package=None):
+        self.id = id
+        self.key = key
+        self.properties = properties or {}
+        self.config_port = config_port or {}
+        self.input_ports = input_ports or {}
+        self.output_ports = output_ports or {}
+        self.inside = inside
+        self.environment = environment or []
+        self.peers = peers or []
+        self.driver_module_name = driver_module_name
+        self.package = package
+
+    def get_config(self):
+        # the original Config converted all nested dictionaries eagerly
+        return BaselineConfig({"config_port":self.config_port,
+                               "input_ports":self.input_ports,
+                               "output_ports":self.output_ports})
+
+
+class BaselineConfig:
+    def __init__(self, props_in):
+        self.__dict__["_props"] = {}
+        for (name, value) in props_in.items():
+            if isinstance(value, dict):
+                value = BaselineConfig(value)
+            self._props[name] = value
+
+
+def _key(i):
+    return {u"name":u"resource-type-%d" % (i % NUM_TYPES),
+            u"version":u"1.%d" % (i % 7)}
+
+
+def generate_resource_json(i):
+    """Generate the json for resource instance i, in the form that
+    parse_resource_from_json() receives it. Each call returns new objects,
+    as when parsing a file.
+    """
+    return {u"id":u"resource-%d" % i,
+            u"key":_key(i),
+            u"properties":{u"installed":True},
+            u"config_port":{u"home":u"/opt/app/resource-%d" % i,
+                            u"port":8000+i, u"log_level":u"info"},
+            u"input_ports":{u"host":{u"hostname":u"localhost",
+                                     u"os_user_name":u"engage",
+                                     u"genforma_home":u"/opt/app"}},
+            u"output_ports":{u"service":{u"url":u"http://localhost:%d/" % (8000+i)}},
+            u"inside":{u"id":u"master-host",
+                       u"key":{u"name":u"ubuntu-linux", u"version":u"10.04"},
+                       u"port_mapping":{u"host":u"host"}},
+            u"environment":[{u"id":u"resource-%d" % j, u"key":_key(j),
+                             u"port_mapping":{}}
+                            for j in range(max(0, i-3), i)],
+            u"peers":[]}
+
+
+def create_metadata(num_resources, md_class, ref_class):
+    result = []
+    for i in range(num_resources):
+        j = generate_resource_json(i)
+        inside = ref_class(j[u"inside"][u"id"], j[u"inside"][u"key"],
+                           j[u"inside"][u"port_mapping"])
+        environment = [ref_class(r[u"id"], r[u"key"], r[u"port_mapping"])
+                       for r in j[u"environment"]]
+        result.append(md_class(j[u"id"], j[u"key"], j[u"properties"],
+                               j[u"config_port"], j[u"input_ports"],
+                               j[u"output_ports"], inside, environment,
+                               j[u"peers"]))
+    return result
+
+
+def get_size(root):
+    """Return the total size of the objects reachable from root, counting
+    each object once. Classes, modules, and functions are not counted.
+    """
+    seen = set()
+    total = 0
+    stack = [root]
+    while len(stack)>0:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, (type, type(sys))) or \
+           callable(obj):
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        if hasattr(obj, "__dict__"):
+            stack.append(obj.__dict__)
+        for cls in type(obj).__mro__:
+            for name in getattr(cls, "__slots__", ()):
+                if name!="__weakref__" and hasattr(obj, name):
+                    stack.append(getattr(obj, name))
+    return total
+
+
+def measure(name, num_resources, md_class, ref_class, get_config):
+    start = time.time()
+    metadata = create_metadata(num_resources, md_class, ref_class)
+    create_time = time.time() - start
+    md_size = get_size(metadata)
+    start = time.time()
+    configs = [get_config(md) for md in metadata]
+    config_time = time.time() - start
+    total_size = get_size((metadata, configs))
+    print "%-12s %12.1f %12.1f %10.3f %10.3f" % \
+          (name, md_size/1024.0, (total_size-md_size)/1024.0, create_time,
+           config_time)
+    return (md_size, total_size)
+
+
+def main(argv):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("-n", "--num-resources", dest="num_resources",
+                      type="int", default=5000,
+                      help="Number of resource instances (default 5000)")
+    (options, args) = parser.parse_args(argv)
+    print "%d resource instances of %d types" % (options.num_resources,
+                                                NUM_TYPES)
+    print "%-12s %12s %12s %10s %10s" % ("", "metadata KB", "configs KB",
+                                         "create (s)", "config (s)")
+    (base_md, base_total) = measure("baseline", options.num_resources,
+                                    BaselineMD, BaselineRef,
+                                    lambda md: md.get_config())
+    (new_md, new_total) = measure("ResourceMD", options.num_resources,
+                                  resource_metadata.ResourceMD,
+                                  resource_metadata.ResourceRef,
+                                  lambda md: md.get_config())
+    print "Metadata is %.0f%% of baseline, metadata plus configs %.0f%% of baseline" % \
+          (100.0*new_md/base_md, 100.0*new_total/base_total)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -34,28 +34,48 @@ let scalar_eq v v' =
   | Boolean b, Boolean b' -> b = b'
   | _ -> false
 
+(** Strings are ordered as versions: they are split into components at each
+ *  '.' or '-', numeric components are compared as integers (so "10.0" is
+ *  greater than "9.0"), and numeric components sort before non-numeric ones.
+ *  This must agree with version_key in python_pkg/engage/utils/rdef.py.
+ *)
+type version_component =
+    VersionNum of int
+  | VersionStr of string
+
+let version_components (s:string) :version_component list =
+  List.map
+    (fun c ->
+       if Str.string_match (Str.regexp "^[0-9]+$") c 0
+       then VersionNum (int_of_string c)
+       else VersionStr c)
+    (List.filter (fun c -> c <> "") (Str.split (Str.regexp "[.-]") s))
+
+let compare_versions (s:string) (s':string) :int =
+  compare (version_components s) (version_components s')
+
 let scalar_gt v v' =
   match (v,v') with
   | Integer i, Integer i' -> i > i'
-  | String s, String s' -> s > s'
+  | String s, String s' -> compare_versions s s' > 0
   | _ -> false
 
 let scalar_lt v v' =
   match (v,v') with
   | Integer i, Integer i' -> i < i'
-  | String s, String s' -> s < s'
+  | String s, String s' -> compare_versions s s' < 0
   | _ -> false
 
 let scalar_geq v v' =
   match (v,v') with
   | Integer i, Integer i' -> i >= i'
-  | String s, String s' -> s >= s'
+  | String s, String s' -> compare_versions s s' >= 0
   | _ -> false
 
 let scalar_leq v v' =
   match (v,v') with
   | Integer i, Integer i' -> i <= i'
-  | String s, String s' -> s <= s'
+  | String s, String s' -> compare_versions s s' <= 0
   | _ -> false
 
 
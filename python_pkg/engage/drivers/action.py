@@ -221,6 +221,7 @@ The following actions are defined by this module:
  * sudo_set_file_permissions <path> <user-id> <group-id> <mode-bits>
  * sudo_set_file_perms_by_name <path> <mode_bits> {user_name=effective_user} {group_name=effective_group}
  * template <src-data-file> <target-path>
+ * template_batch <list of (src-data-file, target-path) pairs> {src_dir=None}
 
 
 Value Actions
@@ -261,6 +262,9 @@ import engage.utils.regexp as regexp
 import engage.utils.path as pathutils
 import engage.utils.cfg_file as cfg_file
 import engage.utils.http as httputils
+import engage.utils.trace as tracing
+import engage.utils.template_engine as template_engine
+from engage.utils.template_engine import TemplateError
 from engage.utils.user_error import UserError, EngageErrInf, convert_exc_to_user_error
 import gettext
 _ = gettext.gettext
@@ -451,11 +455,27 @@ class SudoValueAction(ValueAction):
 
 
 class _Config(object):
+    """Read-only property view of the resource json. The json is not copied
+    up front: nested dicts and lists are wrapped when first accessed, and
+    _add() wraps the path it adds to, so that the original json is never
+    modified (copy-on-write).
+    """
     def __init__(self, props, _qualified_name=None):
-        self.__dict__["_props"] = {}
+        self.__dict__["_props"] = dict(props)
         self.__dict__["_qualified_name"] = _qualified_name
-        for (prop_name, prop_val) in props.items():
-            self._props[prop_name] = self._wrap_child_val(prop_name, prop_val)
+        # names of properties whose values are dicts or lists which have
+        # not yet been wrapped
+        self.__dict__["_unwrapped"] = set([name for (name, val) in props.items()
+                                           if isinstance(val, dict) or
+                                              isinstance(val, list)])
+
+    def _child(self, name):
+        """Return the value of the property, wrapping it if needed.
+        """
+        if name in self._unwrapped:
+            self._props[name] = self._wrap_child_val(name, self._props[name])
+            self._unwrapped.discard(name)
+        return self._props[name]
 
     def _get_child_prop_qname(self, name, list_idx=None):
         if list_idx:
@@ -490,7 +510,7 @@ class _Config(object):
                 self._props[name] = value
         else:
             if self._props.has_key(key):
-                nested_val = self._props[key]
+                nested_val = self._child(key)
                 if isinstance(nested_val, _Config):
                     nested_val._add(".".join(rest), value)
                 else:
@@ -507,8 +527,8 @@ class _Config(object):
         key = name_comps[0]
         rest = name_comps[1:]
         if len(rest)==0 and self._props.has_key(key):
-            return self._props[key]
-        elif self._props.has_key(key) and isinstance(self._props[key], _Config):
+            return self._child(key)
+        elif self._props.has_key(key) and isinstance(self._child(key), _Config):
             return self._props[key]._get(".".join(rest))
         else:
             raise AttributeError, \
@@ -520,16 +540,28 @@ class _Config(object):
             key = self._get_child_prop_qname(prop_name)
             if isinstance(prop_val, _Config):
                 prop_val._make_flattened_map(map)
+            elif isinstance(prop_val, dict) and prop_name in self._unwrapped:
+                # no need to wrap the dict just to flatten it
+                _make_flattened_map_for_dict(prop_val, key, map)
             elif isinstance(prop_val, list):
                 # the flattened map notation does not really work
                 # with lists. We just add the string representation of
                 # the list
-                map[key] = prop_val.__repr__()
+                map[key] = self._child(prop_name).__repr__()
             else:
                 map[key] = str(prop_val)
-    
+
+    def _has_flattened_key(self, qualified_name):
+        """Return True if qualified_name would be in the map generated by
+        _make_flattened_map(), without generating the map.
+        """
+        try:
+            return not isinstance(self._get(qualified_name), _Config)
+        except AttributeError:
+            return False
+
     def __getattr__(self, name):
-        if self._props.has_key(name): return self._props[name]
+        if self._props.has_key(name): return self._child(name)
         else: raise AttributeError, "%s not an attribute" % name
 
     def __setattr__(self, name, value):
@@ -546,6 +578,20 @@ class _Config(object):
         return self._props.__repr__()
 
 
+def _make_flattened_map_for_dict(d, qualified_name, map):
+    """Add the entries for an unwrapped dict to the flattened map, as
+    _Config._make_flattened_map() would for the wrapped dict.
+    """
+    for (prop_name, prop_val) in d.items():
+        key = qualified_name + "." + prop_name
+        if isinstance(prop_val, dict):
+            _make_flattened_map_for_dict(prop_val, key, map)
+        elif isinstance(prop_val, list):
+            map[key] = prop_val.__repr__()
+        else:
+            map[key] = str(prop_val)
+
+
 class Context(object):
     """This is the main state object used by actions. It should be
     created by the driver using the resource metadata.
@@ -562,25 +608,54 @@ class Context(object):
         self.filepath = os.path.abspath(os.path.expanduser(filepath))
         self.sudo_password_fn = sudo_password_fn
         self.dry_run = dry_run
-        self.substitutions = {}
-        self.props._make_flattened_map(self.substitutions)
-        if not self.substitutions.has_key("id"):
+        # The substitution map is only built when first needed (see the
+        # substitutions property). Until then, values added via add() are
+        # kept here, so that they can be applied when it is built.
+        self._substitutions = None
+        self._added_substitutions = {}
+        if not self.props._has_flattened_key("id"):
             raise UserError(errors[ERR_MISSING_ID_PROP])
 
+    @property
+    def substitutions(self):
+        """Map from qualified property names to string values, used for
+        template substitutions. Building the map requires walking the
+        entire resource json, so we wait until it is first used. After
+        that, add() updates it incrementally.
+        """
+        if self._substitutions==None:
+            substitutions = {}
+            self.props._make_flattened_map(substitutions)
+            substitutions.update(self._added_substitutions)
+            self._substitutions = substitutions
+            self._added_substitutions = None
+        return self._substitutions
+
+    def _has_substitution(self, key):
+        if self._substitutions!=None:
+            return self._substitutions.has_key(key)
+        else:
+            return self._added_substitutions.has_key(key) or \
+                   self.props._has_flattened_key(key)
+
     def add(self, key, value):
         """Add a property and value to the existing metadata. Useful for
         dynamically computed properties. Property names may be of the form
         "x.y.z".
         """
-        if self.substitutions.has_key(key):
+        if self._has_substitution(key):
             raise AttributeError, \
                   "Context already has a value for key %s" % key
         self.props._add(key, value)
         if isinstance(value, _Config) or isinstance(value, dict) or \
            isinstance(value, list):
-            self.substitutions[key] = value.__repr__()
+            subst_value = value.__repr__()
+        else:
+            subst_value = str(value)
+        if self._substitutions!=None:
+            self._substitutions[key] = subst_value
         else:
-            self.substitutions[key] = str(value)
+            self._added_substitutions[key] = subst_value
 
     def checkp(self, qualified_prop_name, typ=None):
         """Check that specified property is present in the props field.
@@ -593,7 +668,7 @@ class Context(object):
 
         Returns a context instance.
         """
-        if not self.substitutions.has_key(qualified_prop_name):
+        if not self._has_substitution(qualified_prop_name):
             raise UserError(errors[ERR_PROP_NOT_FOUND],
                             msg_args={"id": self.props.id,
                                       "name":qualified_prop_name})
@@ -638,20 +713,22 @@ class Context(object):
                "r() passed an action of type %s, not an instance of Action" % type(a).__name__
         action_and_args = a.format_action_args(*args, **kwargs)
         self.logger.action(action_and_args)
-        try:
-            if not self.dry_run:
-                a.run(*args, **kwargs)
-            else:
-                a.dry_run(*args, **kwargs)
-        except UserError:
-            raise
-        except Exception, e:
-            exc_info = sys.exc_info()
-            self.logger.exception("Exception executing action %s: %s" %
-                                  (action_and_args, e.__repr__()))
-            raise convert_exc_to_user_error(sys.exc_info(), errors[ERR_UNEXPECTED_EXC_IN_ACTION],
-                                            msg_args={"exc":e.__repr__(), "action":action_and_args,
-                                                      "id":self.props.id})
+        with tracing.span(a.NAME, "action", resource=self.props.id,
+                          dry_run=self.dry_run):
+            try:
+                if not self.dry_run:
+                    a.run(*args, **kwargs)
+                else:
+                    a.dry_run(*args, **kwargs)
+            except UserError:
+                raise
+            except Exception, e:
+                exc_info = sys.exc_info()
+                self.logger.exception("Exception executing action %s: %s" %
+                                      (action_and_args, e.__repr__()))
+                raise convert_exc_to_user_error(sys.exc_info(), errors[ERR_UNEXPECTED_EXC_IN_ACTION],
+                                                msg_args={"exc":e.__repr__(), "action":action_and_args,
+                                                          "id":self.props.id})
         return self
 
     def r_su(self, sudo_action, *args, **kwargs):
@@ -665,31 +742,33 @@ class Context(object):
                % type(a).__name__
         action_and_args = a.format_action_args(*args, **kwargs)
         self.logger.action(action_and_args)
-        try:
-            if procutils.SUDO_PASSWORD_REQUIRED!=None:
-                if procutils.SUDO_PASSWORD_REQUIRED==True and \
-                       (not self.sudo_password_fn()):
-                    raise UserError(errors[ERR_NO_SUDO_PW],
-                                    msg_args={"id":self.props.id,
-                                              "action":a.name})
-                if not self.dry_run:
-                    a.sudo_run(*args, **kwargs)
-                else:
-                    a.dry_run(*args, **kwargs)
-            else: # running as root, no need to sudo
-                if not self.dry_run:
-                    a.run(*args, **kwargs)
-                else:
-                    a.dry_run(*args, **kwargs)
-        except UserError:
-            raise
-        except Exception, e:
-            exc_info = sys.exc_info()
-            self.logger.exception("Exception executing action %s: %s" %
-                                  (action_and_args, e.__repr__()))
-            raise convert_exc_to_user_error(sys.exc_info(), errors[ERR_UNEXPECTED_EXC_IN_ACTION],
-                                            msg_args={"exc":e.__repr__(), "action":action_and_args,
-                                                      "id":self.props.id})
+        with tracing.span(a.NAME, "sudo_action", resource=self.props.id,
+                          dry_run=self.dry_run):
+            try:
+                if procutils.SUDO_PASSWORD_REQUIRED!=None:
+                    if procutils.SUDO_PASSWORD_REQUIRED==True and \
+                           (not self.sudo_password_fn()):
+                        raise UserError(errors[ERR_NO_SUDO_PW],
+                                        msg_args={"id":self.props.id,
+                                                  "action":a.name})
+                    if not self.dry_run:
+                        a.sudo_run(*args, **kwargs)
+                    else:
+                        a.dry_run(*args, **kwargs)
+                else: # running as root, no need to sudo
+                    if not self.dry_run:
+                        a.run(*args, **kwargs)
+                    else:
+                        a.dry_run(*args, **kwargs)
+            except UserError:
+                raise
+            except Exception, e:
+                exc_info = sys.exc_info()
+                self.logger.exception("Exception executing action %s: %s" %
+                                      (action_and_args, e.__repr__()))
+                raise convert_exc_to_user_error(sys.exc_info(), errors[ERR_UNEXPECTED_EXC_IN_ACTION],
+                                                msg_args={"exc":e.__repr__(), "action":action_and_args,
+                                                          "id":self.props.id})
         return self
 
     def rv(self, value_action, *args, **kwargs):
@@ -700,22 +779,24 @@ class Context(object):
                "rv() passed an action of type %s, not an instance of ValueAction" % type(a).__name__
         action_and_args = a.format_action_args(*args, **kwargs)
         self.logger.action(action_and_args)
-        try:
-            if not self.dry_run:
-                result = a.run(*args, **kwargs)
-                self.logger.debug(a.format_action_result(result))
-                return result
-            else:
-                return a.dry_run(*args, **kwargs)
-        except UserError:
-            raise
-        except Exception, e:
-            exc_info = sys.exc_info()
-            self.logger.exception("Exception executing action %s: %s" %
-                                  (action_and_args, e.__repr__()))
-            raise convert_exc_to_user_error(sys.exc_info(), errors[ERR_UNEXPECTED_EXC_IN_ACTION],
-                                            msg_args={"exc":e.__repr__(), "action":action_and_args,
-                                                      "id":self.props.id})
+        with tracing.span(a.NAME, "action", resource=self.props.id,
+                          dry_run=self.dry_run):
+            try:
+                if not self.dry_run:
+                    result = a.run(*args, **kwargs)
+                    self.logger.debug(a.format_action_result(result))
+                    return result
+                else:
+                    return a.dry_run(*args, **kwargs)
+            except UserError:
+                raise
+            except Exception, e:
+                exc_info = sys.exc_info()
+                self.logger.exception("Exception executing action %s: %s" %
+                                      (action_and_args, e.__repr__()))
+                raise convert_exc_to_user_error(sys.exc_info(), errors[ERR_UNEXPECTED_EXC_IN_ACTION],
+                                                msg_args={"exc":e.__repr__(), "action":action_and_args,
+                                                          "id":self.props.id})
 
     def rv_su(self, sudo_value_action, *args, **kwargs):
         """Run the specified ValueAction as the super user, providing it the
@@ -728,35 +809,37 @@ class Context(object):
             % type(a).__name__
         action_and_args = a.format_action_args(*args, **kwargs)
         self.logger.action(action_and_args)
-        try:
-            if procutils.SUDO_PASSWORD_REQUIRED!=None:
-                if procutils.SUDO_PASSWORD_REQUIRED==True and \
-                       (not self.sudo_password_fn()):
-                    raise UserError(errors[ERR_NO_SUDO_PW],
-                                    msg_args={"id":self.props.id,
-                                              "action":a.name})
-                if not self.dry_run:
-                    result = a.sudo_run(*args, **kwargs)
-                    self.logger.debug(a.format_action_result(result))
-                    return result
-                else:
-                    return a.dry_run(*args, **kwargs)
-            else: # running as root
-                if not self.dry_run:
-                    result = a.run(*args, **kwargs)
-                    self.logger.debug(a.format_action_result(result))
-                    return result
-                else:
-                    return a.dry_run(*args, **kwargs)
-        except UserError:
-            raise
-        except Exception, e:
-            exc_info = sys.exc_info()
-            self.logger.exception("Exception executing action %s: %s" %
-                                  (action_and_args, e.__repr__()))
-            raise convert_exc_to_user_error(sys.exc_info(), errors[ERR_UNEXPECTED_EXC_IN_ACTION],
-                                            msg_args={"exc":e.__repr__(), "action":action_and_args,
-                                                      "id":self.props.id})
+        with tracing.span(a.NAME, "sudo_action", resource=self.props.id,
+                          dry_run=self.dry_run):
+            try:
+                if procutils.SUDO_PASSWORD_REQUIRED!=None:
+                    if procutils.SUDO_PASSWORD_REQUIRED==True and \
+                           (not self.sudo_password_fn()):
+                        raise UserError(errors[ERR_NO_SUDO_PW],
+                                        msg_args={"id":self.props.id,
+                                                  "action":a.name})
+                    if not self.dry_run:
+                        result = a.sudo_run(*args, **kwargs)
+                        self.logger.debug(a.format_action_result(result))
+                        return result
+                    else:
+                        return a.dry_run(*args, **kwargs)
+                else: # running as root
+                    if not self.dry_run:
+                        result = a.run(*args, **kwargs)
+                        self.logger.debug(a.format_action_result(result))
+                        return result
+                    else:
+                        return a.dry_run(*args, **kwargs)
+            except UserError:
+                raise
+            except Exception, e:
+                exc_info = sys.exc_info()
+                self.logger.exception("Exception executing action %s: %s" %
+                                      (action_and_args, e.__repr__()))
+                raise convert_exc_to_user_error(sys.exc_info(), errors[ERR_UNEXPECTED_EXC_IN_ACTION],
+                                                msg_args={"exc":e.__repr__(), "action":action_and_args,
+                                                          "id":self.props.id})
 
     def poll_rv(self, timeout_tries, time_between_tries, stop_pred, value_action, *args, **kwargs):
         """Method which runs a value action multiple times until it either returns true or times out.
@@ -774,7 +857,9 @@ class Context(object):
             if stop_pred(self.rv(value_action, *args, **kwargs)):
                 return True
             else:
-                if i != (timeout_tries-1): time.sleep(time_between_tries)
+                if i != (timeout_tries-1):
+                    tracing.sleep(time_between_tries, resource=self.props.id,
+                                  action=value_action.NAME)
         self.logger.debug("Poll on action %s timed out after %d tries" % (value_action.NAME, timeout_tries))
         return False
 
@@ -795,7 +880,9 @@ class Context(object):
             if stop_pred(v):
                 return v
             else:
-                if i != (timeout_tries-1): time.sleep(time_between_tries)
+                if i != (timeout_tries-1):
+                    tracing.sleep(time_between_tries, resource=self.props.id,
+                                  action=value_action.NAME)
         raise UserError(errors[ERR_CHECK_POLL_TIMEOUT],
                         msg_args={"id":self.props.id,
                                   "action":value_action.NAME,
@@ -995,38 +1082,8 @@ class check_installable_to_dir(Action):
             _warning(self, "install directory '%s' already exists" % install_dir)
 
 
-def _build_template_var_re():
-    import engage.utils.regexp as r
-    start_char = r.character_set("A-Za-z\\_")
-    follow_char = r.character_set("A-Za-z0-9\\_")
-    identifier = r.concat(start_char,
-                          r.zero_or_more(follow_char))
-    composite_identifier = r.concat(identifier,
-                                    r.zero_or_more(r.concat(r.lit("."),
-                                                            identifier)))
-    template_var = r.concat(r.lit("${"), r.group(composite_identifier), r.lit("}"))
-    escape = r.lit("$$")
-    return r.or_match(escape, template_var)
-
-_template_var_re = _build_template_var_re().compile()
-
-
-class TemplateError(Exception):
-    def __init__(self, msg, var):
-        super(TemplateError, self).__init__(msg)
-        self.var = var
-
 def _substitute_in_string(s, substitutions):
-    def sub(mo):
-        s = mo.string[mo.start():mo.end()]
-        if s == "$$":
-            return s
-        else:
-            var = mo.group(1)
-            if not substitutions.has_key(var):
-                raise TemplateError("Variable '%s' found in document but not in substitution map" % var, var)
-            return substitutions[var]
-    return _template_var_re.sub(sub, s)
+    return template_engine.compile_template(s).render(substitutions)
 
 
 class get_template_subst(ValueAction):
@@ -1050,15 +1107,15 @@ class get_template_subst(ValueAction):
     def run(self, src_file, src_dir=None):
         src_path = self._get_src_path(src_file, src_dir)
         _check_file_exists(src_path, self)
-        with open(src_path, "rb") as f:
-            try:
-                return _substitute_in_string(f.read(), self.ctx.substitutions)
-            except TemplateError, e:
-                raise UserError(errors[ERR_TMPL_KEY],
-                                msg_args={"key":e.var,
-                                          "file":src_path,
-                                          "resid":self.ctx.props.id,
-                                          "action":"substitute"})
+        try:
+            return template_engine.render_file(src_path,
+                                               self.ctx.substitutions)
+        except TemplateError, e:
+            raise UserError(errors[ERR_TMPL_KEY],
+                            msg_args={"key":e.var,
+                                      "file":src_path,
+                                      "resid":self.ctx.props.id,
+                                      "action":"substitute"})
         
     def dry_run(self, src_file, src_dir=None):
         src_path = self._get_src_path(src_file, src_dir)
@@ -1089,15 +1146,15 @@ class template(Action):
         target_path = os.path.abspath(os.path.expanduser(target_path))
         _check_file_exists(src_path, self)
         _check_dir_exists(os.path.dirname(target_path), self)
-        with open(src_path, "rb") as f:
-            try:
-                data = _substitute_in_string(f.read(), self.ctx.substitutions)
-            except TemplateError, e:
-                raise UserError(errors[ERR_TMPL_KEY],
-                                msg_args={"key":e.var,
-                                          "file":src_path, 
-                                          "resid":self.ctx.props.id,
-                                          "action":"template"})
+        try:
+            data = template_engine.render_file(src_path,
+                                               self.ctx.substitutions)
+        except TemplateError, e:
+            raise UserError(errors[ERR_TMPL_KEY],
+                            msg_args={"key":e.var,
+                                      "file":src_path, 
+                                      "resid":self.ctx.props.id,
+                                      "action":"template"})
         with open(target_path, "wb") as f:
             f.write(data)
 
@@ -1107,6 +1164,56 @@ class template(Action):
         _check_file_exists(src_path, self)
         _check_dir_exists(os.path.dirname(target_path), self)
 
+class template_batch(Action):
+    """Action: Instantiate a list of template files. templates is a list of
+    (src_file, target_path) pairs. As with the template action, the source
+    files are in the data subdirectory, relative to the calling file,
+    unless src_dir is specified.
+
+    All the templates are checked for missing variables before any target
+    files are written.
+    """
+    NAME = "template_batch"
+    def __init__(self, ctx):
+        super(template_batch, self).__init__(ctx)
+
+    def _get_paths(self, templates, src_dir):
+        paths = []
+        for (src_file, target_path) in templates:
+            if src_dir:
+                src_path = os.path.join(src_dir, src_file)
+            else:
+                src_path = fileutils.get_data_file_path(self.ctx.filepath,
+                                                        src_file)
+            src_path = os.path.abspath(os.path.expanduser(src_path))
+            target_path = os.path.abspath(os.path.expanduser(target_path))
+            _check_file_exists(src_path, self)
+            _check_dir_exists(os.path.dirname(target_path), self)
+            paths.append((src_path, target_path))
+        return paths
+
+    def _render(self, paths):
+        try:
+            return template_engine.render_batch([src for (src, tgt) in paths],
+                                                self.ctx.substitutions)
+        except TemplateError, e:
+            raise UserError(errors[ERR_TMPL_KEY],
+                            msg_args={"key":e.var,
+                                      "file":e.path,
+                                      "resid":self.ctx.props.id,
+                                      "action":self.NAME})
+
+    def run(self, templates, src_dir=None):
+        paths = self._get_paths(templates, src_dir)
+        results = self._render(paths)
+        for ((src_path, target_path), data) in zip(paths, results):
+            with open(target_path, "wb") as f:
+                f.write(data)
+
+    def dry_run(self, templates, src_dir=None):
+        self._render(self._get_paths(templates, src_dir))
+
+
 class instantiate_template_str(Action):
     """Action: Instantiate a template string, creating the specified file.
     """
@@ -1413,7 +1520,10 @@ def _check_poll(calling_action, stop_pred, description,
         if v==True:
             return
         else:
-            if i != (timeout_tries-1): time.sleep(time_between_tries)
+            if i != (timeout_tries-1):
+                tracing.sleep(time_between_tries,
+                              resource=calling_action.ctx.props.id,
+                              action=calling_action.NAME)
     raise UserError(errors[ERR_ACTION_POLL_TIMEOUT],
                     msg_args={"id":calling_action.ctx.props.id,
                               "action":calling_action.NAME,
@@ -1703,7 +1813,26 @@ class TestActions(unittest.TestCase):
     def testAdd(self):
         self.ctx.add("prop3", os.path.join(self.ctx.props.config_port.prop1, "test"))
         self.assertEqual(self.ctx.props.prop3, "/foo/bar/test")
-        
+
+    def testAddBeforeAndAfterSubstitutions(self):
+        self.assert_(self.ctx._substitutions==None)
+        self.ctx.add("config_port.prop3", "before")
+        self.assertRaises(AttributeError, self.ctx.add, "config_port.prop1", "x")
+        self.assertEqual("before", self.ctx.substitutions["config_port.prop3"])
+        self.assertEqual("34", self.ctx.substitutions["config_port.prop2"])
+        self.assertEqual("2.2", self.ctx.substitutions["key.version"])
+        self.ctx.add("config_port.prop4", "after")
+        self.assertEqual("after", self.ctx.substitutions["config_port.prop4"])
+        self.assertRaises(AttributeError, self.ctx.add, "config_port.prop3", "x")
+
+    def testAddDoesNotChangeResourceJson(self):
+        rc = {"id":"apache2", "key":{"name":"apache2", "version":"2.2"},
+              "config_port": { "prop1":"/foo/bar", "prop2":34 }}
+        ctx = Context(rc, self.ctx.logger, "./action.py")
+        ctx.add("config_port.prop3", "new value")
+        self.assertEqual("new value", ctx.props.config_port.prop3)
+        self.assertEqual({"prop1":"/foo/bar", "prop2":34}, rc["config_port"])
+
     def testSubstitute(self):
         self.ctx.add("prop3", os.path.join(self.ctx.props.config_port.prop1, "test"))
         tmpl_val = self.ctx.rv(get_template_subst, "test.txt")
@@ -1723,6 +1852,25 @@ class TestActions(unittest.TestCase):
             with open(f.name, "rb") as g:
                 self.assertEqual(_test_data_file_contents, g.read())
 
+    def testTemplateBatch(self):
+        self.ctx.add("prop3", os.path.join(self.ctx.props.config_port.prop1, "test"))
+        with fileutils.NamedTempFile() as f:
+            with fileutils.NamedTempFile() as g:
+                self.ctx.r(template_batch, [("test.txt", f.name),
+                                            ("test.txt", g.name)])
+                for name in [f.name, g.name]:
+                    with open(name, "rb") as h:
+                        self.assertEqual(_test_data_file_contents, h.read())
+
+    def testTemplateBatchError(self):
+        with fileutils.NamedTempFile() as f:
+            try:
+                self.ctx.r(template_batch, [("test.txt", f.name)])
+                self.assert_(0, "Should not get here")
+            except UserError, e:
+                self.assertEqual(ERR_TMPL_KEY, e.error_code)
+            self.assertEqual(0, os.path.getsize(f.name))
+
     def testCheckp(self):
         self.ctx.checkp("id").checkp("key.name").checkp("key.version")
         self.ctx.checkp("config_port.prop1").checkp("config_port.prop2", typ=int)
@@ -106,8 +106,9 @@ class BackupFileMixin(PasswordRepoMixin):
                 logger.info("Running backup via sudo for resource %s" % self.id)
                 backup.save_as_sudo_subprocess(files, backup_location,
                                                self._get_sudo_password(), move=False)
+                return (None, os.path.getsize(backup_location))
             else:
-                backup.save(files, backup_location, move=False)
+                return backup.save(files, backup_location, move=False)
         except:
             exc_info = (exc_tp, exc_v, ecx_tb) =  sys.exc_info()
             raise convert_exc_to_user_error(exc_info, errors[EXC_IN_BACKUP_CALL],
@@ -6,6 +6,8 @@ import os.path
 import sys
 import re
 import copy
+import threading
+import subprocess
 
 import engage.drivers.resource_manager as resource_manager
 import engage.drivers.resource_metadata as resource_metadata
@@ -71,6 +73,11 @@ def _get_env_for_aptget():
         env["PATH"] = "/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin"
     return env
 
+# apt-get and dpkg take an exclusive lock on the package database. If resources
+# are being installed in parallel, we serialize our own calls rather than
+# having them fail on the lock.
+dpkg_lock = threading.RLock()
+
 # We track whether this execution of Engage has run the apt-get update command.
 # If so, we don't run it for any subsequent requests. The update command is
 # slow and frequently fails due to server availability issues.
@@ -78,11 +85,12 @@ update_run_this_execution = False
 
 def run_update_if_not_already_run(sudo_password, env):
     global update_run_this_execution
-    if not update_run_this_execution:
-        logger.info("Running apt-get update...")
-        iuprocess.run_sudo_program([APT_GET_PATH, "-q", "-y", "update"], sudo_password,
-                                   logger, env=env)
-        update_run_this_execution=True
+    with dpkg_lock:
+        if not update_run_this_execution:
+            logger.info("Running apt-get update...")
+            iuprocess.run_sudo_program([APT_GET_PATH, "-q", "-y", "update"], sudo_password,
+                                       logger, env=env)
+            update_run_this_execution=True
 
 def apt_get_install(package_list, sudo_password):
     env = _get_env_for_aptget()
@@ -91,10 +99,11 @@ def apt_get_install(package_list, sudo_password):
                         msg_args={"path":APT_GET_PATH})
     
     try:
-        run_update_if_not_already_run(sudo_password, env)
-        iuprocess.run_sudo_program([APT_GET_PATH, "-q", "-y", "install"]+package_list, sudo_password,
-                                   logger,
-                                   env=env)
+        with dpkg_lock:
+            run_update_if_not_already_run(sudo_password, env)
+            iuprocess.run_sudo_program([APT_GET_PATH, "-q", "-y", "install"]+package_list, sudo_password,
+                                       logger,
+                                       env=env)
     except iuprocess.SudoError, e:
         exc_info = sys.exc_info()
         sys.exc_clear()
@@ -119,10 +128,11 @@ def dpkg_install(package_file, sudo_password, may_have_dependencies=True):
                         msg_args={"path":package_file})
     
     try:
-        if may_have_dependencies:
-            run_update_if_not_already_run(sudo_password, env)
-        iuprocess.run_sudo_program([DPKG_PATH, "-i", package_file], sudo_password,
-                                   logger, env=env)
+        with dpkg_lock:
+            if may_have_dependencies:
+                run_update_if_not_already_run(sudo_password, env)
+            iuprocess.run_sudo_program([DPKG_PATH, "-i", package_file], sudo_password,
+                                       logger, env=env)
     except iuprocess.SudoError, e:
         exc_info = sys.exc_info()
         sys.exc_clear()
@@ -172,15 +182,16 @@ def update(self, always_run=True):
     even be visible.
     """
     global update_run_this_execution
-    if always_run or (not update_run_this_execution):
-        self.ctx.logger.info("Running apt-get update...")
-        iuprocess.run_sudo_program([APT_GET_PATH, "-q", "-y", "update"],
-                                   self.ctx._get_sudo_password(self),
-                                   self.ctx.logger,
-                                   env=_get_env_for_aptget())
-        update_run_this_execution = True
-    else:
-        self.ctx.logger.info("ignoring request for apt-get update, as update was already run")
+    with dpkg_lock:
+        if always_run or (not update_run_this_execution):
+            self.ctx.logger.info("Running apt-get update...")
+            iuprocess.run_sudo_program([APT_GET_PATH, "-q", "-y", "update"],
+                                       self.ctx._get_sudo_password(self),
+                                       self.ctx.logger,
+                                       env=_get_env_for_aptget())
+            update_run_this_execution = True
+        else:
+            self.ctx.logger.info("ignoring request for apt-get update, as update was already run")
 
 
 def is_installed(package):
@@ -195,6 +206,32 @@ def is_installed(package):
     else:
         return False
 
+def get_installed_packages(package_list):
+    """Return the set of packages from package_list which are installed,
+    using a single dpkg-query call.
+    """
+    if not os.path.exists(DPKG_QUERY_PATH):
+        raise UserError(errors[ERR_DPKG_QUERY_NOT_FOUND],
+                        msg_args={"path":DPKG_QUERY_PATH})
+    if len(package_list)==0:
+        return set()
+    cmd = [DPKG_QUERY_PATH, "-W", "-f=${Package} ${Status}\\n"] + package_list
+    logger.debug(" ".join(cmd))
+    subproc = subprocess.Popen(cmd, env=_get_env_for_aptget(),
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    (output, err_output) = subproc.communicate()
+    # dpkg-query exits with 1 if any of the packages are unknown, but still
+    # prints the status of the others.
+    installed = set()
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields)==4 and fields[1:]==["install", "ok", "installed"]:
+            installed.add(fields[0])
+    logger.debug("dpkg-query rc=%d, installed packages: %s" %
+                 (subproc.returncode, sorted(installed)))
+    return installed
+
 @make_value_action
 def is_pkg_installed(self, package):
     """Value action to see whether the specified apt package is installed"""
@@ -239,6 +276,22 @@ class Config(resource_metadata.Config):
         resource_metadata.Config.__init__(self, props_in, types)
         
 
+class BatchInstaller(object):
+    """Installs the packages of several resources with a single apt-get
+    command. See resource_manager.Manager.get_batch_installer().
+    """
+    batch_key = "apt-get"
+
+    def __init__(self, sudo_password_fn):
+        self.sudo_password_fn = sudo_password_fn
+
+    def get_installed_packages(self, package_list):
+        return get_installed_packages(package_list)
+
+    def install_packages(self, package_list):
+        apt_get_install(package_list, self.sudo_password_fn())
+
+
 class Manager(resource_manager.Manager, PasswordRepoMixin):
     REQUIRES_ROOT_ACCESS = True
     def __init__(self, metadata):
@@ -266,6 +319,12 @@ class Manager(resource_manager.Manager, PasswordRepoMixin):
                             self._get_sudo_password())
         self.validate_post_install()
 
+    def get_batch_installer(self, package):
+        if isinstance(package, engage_utils.pkgmgr.Package):
+            return None # installed from a .deb file via dpkg
+        return (BatchInstaller(self._get_sudo_password),
+                self.config.output_ports.apt_cfg.package_name)
+
     def validate_post_install(self):
         if not self.is_installed():
             raise UserError(errors[ERR_INSTALL_PKG_QUERY],
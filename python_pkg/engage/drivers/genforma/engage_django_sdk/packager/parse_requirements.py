@@ -1,4 +1,6 @@
+import os.path
 import re
+from StringIO import StringIO
 
 # start = group(one_or_more(complement_char_set(">=<")))
 # comp = group(or_match(lit(">"), lit(">="), lit("==")))
@@ -61,13 +63,6 @@ def parse(fname, parse_version_constraints=False):
         files = files + deps
     return packages
 
-# Regexp for matching a file package
-# version = group(concat(one_or_more(character_set("0-9")), zero_or_more(concat(lit("."), one_or_more(character_set("0-9"))))))
-# file_ext = or_match(lit(".tar.gz"), lit(".tgz"), lit(".zip"))
-# pkg_file = concat(line_starts_with(lit(pkg_name)), lit("-"), version, line_ends_with(file_ext))
-def _get_pkg_file_re(pkg):
-    return re.compile('^(?:' + pkg + ')\\-([0-9]+(?:\\.[0-9]+)*)(?:(?:\\.tar\\.gz)|(?:\\.tgz)|(?:\\.zip))$')
-
 def compare_versions(v1, v2):
     """Compare two version numbers. If v1 > v2, return 1. If v1 < v2, return -1.
     If v1 == v2, return 0
@@ -89,61 +84,158 @@ def compare_versions(v1, v2):
     assert v2_length>v1_length, "problem in version compare(%s, %s)" % (v1, v2)
     return -1
 
+def normalize_project_name(name):
+    """Project names are compared case-insensitively, and wheel filenames
+    replace dashes with underscores, so we map runs of -, _, and . to a
+    single dash.
+    """
+    return re.sub(r'[\-_\.]+', '-', name.strip()).lower()
+
+# Regexps for archives in the package cache. We only index archives with
+# purely numeric versions, as those are the only ones compare_versions()
+# can handle.
+_sdist_file_re = re.compile('^(.+)\\-([0-9]+(?:\\.[0-9]+)*)(?:(?:\\.tar\\.gz)|(?:\\.tgz)|(?:\\.zip))$')
+_wheel_file_re = re.compile('^([^\\-]+)\\-([0-9]+(?:\\.[0-9]+)*)(?:\\-[0-9][^\\-]*)?\\-[^\\-]+\\-[^\\-]+\\-[^\\-]+\\.whl$')
+
+def version_satisfies(version, pkg_comp, pkg_version):
+    if not pkg_comp:
+        return True
+    try:
+        cv = compare_versions(version, pkg_version)
+    except ValueError:
+        return False # non-numeric version in the requirement
+    return (pkg_comp=='==' and cv==0) or \
+           (pkg_comp=='>=' and (cv==0 or cv==1)) or \
+           (pkg_comp=='>' and cv==1)
+
+def requirement_to_tuple(pkg):
+    """Convert an entry returned by parse() to a (name, comparison, version)
+    tuple. The comparison and version are None if unconstrained. Returns
+    None for entries we do not understand.
+    """
+    if isinstance(pkg, tuple):
+        assert(len(pkg)==3)
+        return pkg
+    elif isinstance(pkg, str) or isinstance(pkg, unicode):
+        return (pkg, None, None)
+    else:
+        return None
+
+
+class PackageCacheIndex(object):
+    """Index of the archives in a package cache, mapping normalized project
+    name and version to the archive file. We build the index once from the
+    directory listings and then resolve each requirement with a dictionary
+    lookup, rather than matching every file against every requirement.
+    If both a wheel and a source archive are present for a version, the
+    wheel is preferred, as it can be installed without a build.
+    """
+    def __init__(self, package_cache_files=[]):
+        self.by_name = {} # map from normalized name to {version: filename}
+        for f in package_cache_files:
+            self.add_file(f)
+
+    def add_file(self, filename):
+        """Add a file to the index. filename may include a directory, but
+        only the basename is parsed. Files which are not package archives
+        are ignored.
+        """
+        basename = os.path.basename(filename)
+        m = _wheel_file_re.match(basename)
+        is_wheel = m!=None
+        if not m:
+            m = _sdist_file_re.match(basename)
+            if not m:
+                return
+        versions = self.by_name.setdefault(normalize_project_name(m.group(1)), {})
+        version = m.group(2)
+        if is_wheel or not versions.has_key(version) or \
+           not versions[version].endswith(".whl"):
+            versions[version] = filename
+
+    def add_directory(self, directory):
+        if os.path.isdir(directory):
+            for f in os.listdir(directory):
+                self.add_file(os.path.join(directory, f))
+
+    def find_best_match(self, pkg_name, pkg_comp=None, pkg_version=None):
+        """Return a (version, filename) pair for the highest version in the
+        cache which satisfies the requirement, or None if there is no match.
+        """
+        versions = self.by_name.get(normalize_project_name(pkg_name), {})
+        best = None
+        for (version, filename) in versions.items():
+            if version_satisfies(version, pkg_comp, pkg_version) and \
+               (best==None or compare_versions(version, best[0])==1):
+                best = (version, filename)
+        return best
+
+
+def build_package_cache_index(directories):
+    """Build an index of the package archives in the specified directories.
+    The entries of the index are full paths.
+    """
+    index = PackageCacheIndex()
+    for directory in directories:
+        index.add_directory(directory)
+    return index
+
+
+def write_pinned_requirements_file(requirements_file, pins, dest_dir):
+    """Write a copy of the requirements file (and of any files it includes
+    with -r) to dest_dir, replacing each requirement whose normalized
+    project name is in pins with an exact requirement for the pinned
+    version. Editable and find-links entries are copied unchanged. Returns
+    the path of the copy of requirements_file, which has the same basename.
+    """
+    copies = {} # map from requirements file to its copy
+    def copy_file(fname):
+        if copies.has_key(fname):
+            return copies[fname]
+        if len(copies)==0:
+            dest = os.path.join(dest_dir, os.path.basename(fname))
+        else:
+            dest = os.path.join(dest_dir, "%d-%s" % (len(copies),
+                                                     os.path.basename(fname)))
+        copies[fname] = dest
+        with open(fname, 'r') as fp:
+            lines = fp.read().split('\n')
+        for (i, line) in enumerate(lines):
+            if re.match(r'\s*-r\s+', line):
+                # pip resolves included files relative to the including file
+                included = os.path.join(os.path.dirname(fname),
+                                        re.sub(r'\s*-r\s+', '', line).strip())
+                if os.path.exists(included):
+                    lines[i] = "-r " + copy_file(included)
+            elif not (re.match(r'(\s*#)|(\s*$)|(\s*-)', line)):
+                (reqs, deps) = parse_requirements(StringIO(line), True)
+                req = requirement_to_tuple(reqs[0]) if len(reqs)==1 else None
+                if req and pins.has_key(normalize_project_name(req[0])):
+                    lines[i] = "%s==%s" % (req[0].strip(),
+                                           pins[normalize_project_name(req[0])])
+        with open(dest, 'w') as fp:
+            fp.write('\n'.join(lines))
+        return dest
+    return copy_file(requirements_file)
+
+
 def get_local_files_matching_requirements(requirements_file, package_cache_files):
     """Give a requirements file and a list of files in a package cache,
     return the files from the list that best satisfy the requirements.
     """
     packages = parse(requirements_file, parse_version_constraints=True)
+    index = PackageCacheIndex(package_cache_files)
     matching_files = {}
-    files_by_prefix = {}
-    for f in package_cache_files:
-        prefix = f.split('-')[0]
-        if files_by_prefix.has_key(prefix):
-            files_by_prefix[prefix].append(f)
-        else:
-            files_by_prefix[prefix] = [f]
-        
     for pkg in packages:
-        if isinstance(pkg, tuple):
-            assert(len(pkg)==3)
-            pkg_name = pkg[0]
-            pkg_version = pkg[2]
-            pkg_comp = pkg[1]
-        elif isinstance(pkg, str) or isinstance(pkg, unicode):
-            pkg_name = pkg
-            pkg_version = None
-            pkg_comp = None
-        else:
+        req = requirement_to_tuple(pkg)
+        if req==None:
             continue
-        prefix = pkg_name.split("-")[0]
-        files = files_by_prefix[prefix] if files_by_prefix.has_key(prefix) else []
-        regexp = _get_pkg_file_re(pkg_name)
-        for f in files:
-            m = regexp.match(f)
-            if not m: continue
-            file_version = m.group(1)
-            # does f satisfy the requirement?
-            if pkg_comp:
-                cv = compare_versions(file_version, pkg_version)
-                if (pkg_comp=='==' and cv==0) or \
-                   (pkg_comp=='>=' and (cv==0 or cv==1)) or \
-                   (pkg_comp=='>' and cv==1):
-                    satisfied = True
-                else:
-                    satisfied = False
-            else:
-                satisfied = True
-            if satisfied:
-                if matching_files.has_key(pkg_name):
-                    v_other = regexp.match(matching_files[pkg_name]).group(1)
-                    if compare_versions(file_version, v_other)==1:
-                        matching_files[pkg_name] = f
-                else:
-                    matching_files[pkg_name] = f
+        match = index.find_best_match(*req)
+        if match:
+            matching_files[req[0]] = match[1]
     return matching_files.values()
-        
-        
-        
+
+
 if __name__ == '__main__':
     packages = parse('requirements.txt', parse_version_constraints=True) 
     print packages
@@ -92,6 +92,85 @@ class TestParseRequirements(unittest.TestCase):
         self.assertEqual(['Pygments-1.3.1.tar.gz', 'bar-0.2.tar.gz', 'Django-1.2.6.zip'],
                          matches)
 
+    def test_find_matching_files_prefers_wheels(self):
+        self._write_requirements_file("Django>=1.2.5\nsimple_json==2.1.2\n")
+        matches = get_local_files_matching_requirements(self.req_filename,
+                                                        _package_cache_files +
+                                                        ['Django-1.2.6-py2-none-any.whl',
+                                                         'simple_json-2.1.2.tar.gz',
+                                                         'README.txt'])
+        self.assertEqual(['Django-1.2.6-py2-none-any.whl', 'simple_json-2.1.2.tar.gz'],
+                         sorted(matches))
+
+    def test_package_cache_index(self):
+        index = PackageCacheIndex(_package_cache_files +
+                                  ['django_tagging-0.3.1-py2-none-any.whl'])
+        self.assertEqual(index.find_best_match('pygments', '>=', '1.3'),
+                         ('1.3.1', 'Pygments-1.3.1.tar.gz'))
+        self.assertEqual(index.find_best_match('Pygments', '==', '1.3'),
+                         ('1.3', 'Pygments-1.3.tar.gz'))
+        self.assertEqual(index.find_best_match('django-tagging'),
+                         ('0.3.1', 'django_tagging-0.3.1-py2-none-any.whl'))
+        self.assertEqual(index.find_best_match('python-twitter', '>=', '0.8.1'),
+                         None)
+        self.assertEqual(index.find_best_match('South'), None)
+
+    def test_write_pinned_requirements_file(self):
+        self._write_requirements_file("-r base.txt\n-e hg+http://example.com/foo#egg=foo\nSouth==0.7.3\n")
+        with open(os.path.join(self.temp_dir, "base.txt"), "w") as f:
+            f.write("# base\nDjango>=1.2.5\npython_twitter\n")
+        dest_dir = os.path.join(self.temp_dir, "pinned")
+        os.mkdir(dest_dir)
+        pinned = write_pinned_requirements_file(self.req_filename,
+                                                {"django":"1.2.6", "python-twitter":"0.8.0"},
+                                                dest_dir)
+        self.assertEqual(pinned, os.path.join(dest_dir, "requirements.txt"))
+        base = os.path.join(dest_dir, "1-base.txt")
+        with open(pinned) as f:
+            self.assertEqual("-r %s\n-e hg+http://example.com/foo#egg=foo\nSouth==0.7.3\n" % base,
+                             f.read())
+        with open(base) as f:
+            self.assertEqual("# base\nDjango==1.2.6\npython_twitter==0.8.0\n", f.read())
+
+
+_fake_pip = """#!/bin/sh
+# pip without wheel support, which records the requirements it installs
+if [ "$1" = "wheel" ]; then exit 1; fi
+while [ $# -gt 0 ]; do
+  if [ "$1" = "-r" ]; then cat "$2" > "$(dirname $0)/installed.txt"; fi
+  shift
+done
+"""
+
+class TestInstallRequirements(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.temp_dir = tempfile.mkdtemp()
+        bin_dir = os.path.join(self.temp_dir, "venv/bin")
+        os.makedirs(bin_dir)
+        with open(os.path.join(bin_dir, "pip"), "w") as f:
+            f.write(_fake_pip)
+        os.chmod(os.path.join(bin_dir, "pip"), 0755)
+        self.cache_dir = os.path.join(self.temp_dir, "cache")
+        os.mkdir(self.cache_dir)
+        for filename in _package_cache_files:
+            open(os.path.join(self.cache_dir, filename), "w").close()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.temp_dir)
+
+    def test_cache_hit_installs_cached_version(self):
+        from utils import install_requirements
+        req_filename = os.path.join(self.temp_dir, "requirements.txt")
+        with open(req_filename, "w") as f:
+            f.write("Django>=1.2.5\nSouth==0.7.3\n")
+        report = install_requirements(os.path.join(self.temp_dir, "venv"),
+                                      req_filename, self.cache_dir)
+        self.assertEqual(["Django>=1.2.5"], report["hits"])
+        with open(os.path.join(self.temp_dir, "venv/bin/installed.txt")) as f:
+            self.assertEqual("Django==1.2.6\nSouth==0.7.3\n", f.read())
+
 if __name__ == '__main__':
     unittest.main()
 
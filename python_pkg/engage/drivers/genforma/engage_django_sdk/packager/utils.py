@@ -9,10 +9,14 @@ import subprocess
 import traceback
 import logging
 import copy
+import tempfile
+import shutil
 
 logger = logging.getLogger(__name__)
 
-from parse_requirements import parse,  get_local_files_matching_requirements
+from parse_requirements import parse, requirement_to_tuple, \
+                               build_package_cache_index, normalize_project_name, \
+                               write_pinned_requirements_file
 from engage_django_components import get_additional_requirements
 import package_data
 from errors import RequestedPackageError, PipError
@@ -20,6 +24,12 @@ from errors import RequestedPackageError, PipError
 
 PIP_TIMEOUT=45
 
+# Subdirectory of the package cache where we keep the wheels we build
+WHEELHOUSE_DIR_NAME="wheelhouse"
+
+# Maximum number of concurrent wheel builds
+MAX_WHEEL_BUILD_PROCESSES=8
+
 def app_module_name_to_dir(app_directory_path, app_module_name, check_for_init_pys=True):
     """The application module could be a submodule, so we may need to split each level"""
     dirs = app_module_name.split(".")
@@ -212,14 +222,16 @@ def create_virtualenv(desired_python_dir, package_cache_dir=None):
 
 
 def run_pip(pip_exe_path, requirements_file_path, logger,
-            package_cache_dir=None):
+            package_cache_dir=None, find_links=[]):
     """Run pip to install the specified requirements file. This is similar to
     check_run_and_log_program(), except that we provide more specific error
-    messages and logging.
+    messages and logging. find_links is a list of local directories to be
+    searched for archives in addition to the package index.
     """
     cmd = [pip_exe_path, "install", "--use-mirrors",
-           "--timeout=%d" % PIP_TIMEOUT,
-           "-r", requirements_file_path]    
+           "--timeout=%d" % PIP_TIMEOUT] + \
+          ["--find-links=%s" % d for d in find_links] + \
+          ["-r", requirements_file_path]
     env = copy.deepcopy(os.environ)
     if package_cache_dir:
         env["PIP_DOWNLOAD_CACHE"] = package_cache_dir
@@ -256,8 +268,154 @@ def run_pip(pip_exe_path, requirements_file_path, logger,
                  reqfile_basename)
 
 
+def _pip_supports_wheel(pip_exe_path):
+    """pip wheel was added in pip 1.4 and also needs the wheel package"""
+    try:
+        subproc = subprocess.Popen([pip_exe_path, "wheel", "--help"],
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT)
+        subproc.communicate()
+    except OSError:
+        return False
+    if subproc.returncode!=0:
+        return False
+    try:
+        subproc = subprocess.Popen([os.path.join(os.path.dirname(pip_exe_path), "python"),
+                                    "-c", "import wheel"],
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT)
+        subproc.communicate()
+    except OSError:
+        return False
+    return subproc.returncode==0
+
+
+def _build_wheel(args):
+    """Build a wheel for a single requirement spec or archive path into the
+    wheelhouse. This runs in a worker process, so we return the output for
+    logging rather than logging it here.
+    """
+    (pip_exe_path, spec, wheel_dir, find_links) = args
+    cmd = [pip_exe_path, "wheel", "--no-deps", "--wheel-dir=%s" % wheel_dir,
+           "--timeout=%d" % PIP_TIMEOUT] + \
+          ["--find-links=%s" % d for d in find_links] + [spec]
+    try:
+        subproc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT)
+        (output, dummy) = subproc.communicate()
+        return (spec, subproc.returncode, output)
+    except Exception, e:
+        return (spec, -1, "Unable to run %s: %s" % (' '.join(cmd), str(e)))
+
+
+def build_wheels(pip_exe_path, specs, wheel_dir, find_links=[]):
+    """Build wheels for the list of requirement specs (or archive paths)
+    concurrently on a process pool. Returns the list of specs for which the
+    build failed. Failures are not fatal -- pip will retry the package from
+    the index when installing the requirements file.
+    """
+    if len(specs)==0:
+        return []
+    args = [(pip_exe_path, spec, wheel_dir, find_links) for spec in specs]
+    try:
+        import multiprocessing
+        num_procs = min(len(specs), multiprocessing.cpu_count(),
+                        MAX_WHEEL_BUILD_PROCESSES)
+    except (ImportError, NotImplementedError):
+        num_procs = 1
+    logger.debug("Building %d wheel(s) with %d process(es)" %
+                 (len(specs), num_procs))
+    if num_procs>1:
+        pool = multiprocessing.Pool(num_procs)
+        try:
+            results = pool.map(_build_wheel, args)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    else:
+        results = map(_build_wheel, args)
+    failed = []
+    for (spec, rc, output) in results:
+        for line in output.split("\n"):
+            logger.debug("pip wheel %s> %s" % (spec, line.rstrip()))
+        if rc!=0:
+            logger.warn("Unable to build wheel for %s, pip returned %d" %
+                        (spec, rc))
+            failed.append(spec)
+    return failed
+
+
+def _format_requirement(req):
+    (pkg_name, pkg_comp, pkg_version) = req
+    if pkg_comp:
+        return "%s%s%s" % (pkg_name.strip(), pkg_comp, pkg_version.strip())
+    else:
+        return pkg_name.strip()
+
+
+def prepare_package_cache(pip_exe_path, requirements_file, package_cache_dir):
+    """Resolve the requirements against an index of the package cache and
+    build wheels for the source archives found in the cache and for the
+    requirements which are not in the cache at all. Returns a report
+    dictionary with the lists of requirements which were hits and misses,
+    a map from the normalized project names of the hits to the cached
+    versions they resolved to, the number of wheels built, and the specs
+    whose wheel builds failed.
+    """
+    wheel_dir = os.path.join(package_cache_dir, WHEELHOUSE_DIR_NAME)
+    index = build_package_cache_index([package_cache_dir, wheel_dir])
+    report = {"hits":[], "misses":[], "pins":{}, "wheels_built":0,
+              "build_failures":[]}
+    to_build = []
+    for pkg in parse(requirements_file, parse_version_constraints=True):
+        req = requirement_to_tuple(pkg)
+        if req==None:
+            continue
+        spec = _format_requirement(req)
+        match = index.find_best_match(*req)
+        if match:
+            (version, path) = match
+            logger.debug("Package cache hit for %s: %s" %
+                         (spec, os.path.basename(path)))
+            report["hits"].append(spec)
+            report["pins"][normalize_project_name(req[0])] = version
+            if not path.endswith(".whl"):
+                to_build.append(path)
+        else:
+            logger.debug("Package cache miss for %s" % spec)
+            report["misses"].append(spec)
+            to_build.append(spec)
+    if len(to_build)>0:
+        if _pip_supports_wheel(pip_exe_path):
+            if not os.path.exists(wheel_dir):
+                os.makedirs(wheel_dir)
+            report["build_failures"] = \
+                build_wheels(pip_exe_path, to_build, wheel_dir,
+                             find_links=[package_cache_dir, wheel_dir])
+            report["wheels_built"] = len(to_build) - len(report["build_failures"])
+        else:
+            logger.debug("pip in virtualenv cannot build wheels, will install from source archives")
+    logger.info("Package cache %s: %d hit(s), %d miss(es), %d wheel(s) built" %
+                (package_cache_dir, len(report["hits"]), len(report["misses"]),
+                 report["wheels_built"]))
+    if len(report["misses"])>0:
+        logger.info("Packages not in cache: %s" % ", ".join(report["misses"]))
+    return report
+
+
 def install_requirements(python_virtualenv_dir, requirements_file,
                          package_cache_dir=None):
+    """Install the requirements file into the virtualenv using a single pip
+    run. If a package cache directory is provided, we first build wheels for
+    the requirements (see prepare_package_cache()) and then point pip at the
+    cache and its wheelhouse, with each requirement found in the cache pinned
+    to the cached version. Returns the package cache report, or None if
+    there is no package cache.
+    """
     if len(package_data.problem_packages)>0:
         # If there are packages known to cause problems, we check that list
         # against the requirements file and stop everything if a problematic
@@ -275,29 +433,37 @@ def install_requirements(python_virtualenv_dir, requirements_file,
     if not os.path.exists(pip):
         raise RequestedPackageError("Could not find pip executable")
     req_file_path = os.path.abspath(os.path.expanduser(requirements_file))
+    report = None
+    find_links = []
     if package_cache_dir:
-        # If the package cache is present, we read through the requirements file to see
-        # if we have any matches. If matches are found, we install them directly. We'll
-        # still run pip on the requirements file at the end to catch anything that is missing
-        # or the wrong version.
+        # If the package cache is present, we resolve the requirements against
+        # the cache and build any missing wheels before the pip run. pip then
+        # picks up the cached archives via --find-links and only goes to the
+        # index for anything that is missing. pip would pick a newer release
+        # from the index over a cached archive for a requirement like
+        # Django>=1.2.5, so we pin the cache hits to their cached versions.
         package_cache_dir = os.path.abspath(os.path.expanduser(package_cache_dir))
         logger.debug("Checking for packages in directory %s" % package_cache_dir)
         if os.path.exists(package_cache_dir):
-            cache_files = os.listdir(package_cache_dir)
-            package_files = get_local_files_matching_requirements(requirements_file,
-                                                                  cache_files)
-            for pkg_file in package_files:
-                pkg_path = os.path.join(package_cache_dir, pkg_file)
-                logger.debug("Installing %s from package cache" % pkg_file)
-                cmd = [pip, "install", pkg_path]
-                try:
-                    check_run_and_log_program(cmd, None, logger)
-                except Exception, e:
-                    logger.exception("Problem in running pip on package %s. Command was '%s', error was %s" % (pkg_file, ' '.join(cmd), str(e)))
-                    raise PipError("Problem in running pip on package %s. Command was '%s', error was %s" % (pkg_file, ' '.join(cmd), str(e)))
+            report = prepare_package_cache(pip, req_file_path, package_cache_dir)
+            find_links.append(package_cache_dir)
+            wheel_dir = os.path.join(package_cache_dir, WHEELHOUSE_DIR_NAME)
+            if os.path.exists(wheel_dir):
+                find_links.append(wheel_dir)
 
+    pinned_dir = None
+    if report and len(report["pins"])>0:
+        pinned_dir = tempfile.mkdtemp()
+        req_file_path = write_pinned_requirements_file(req_file_path,
+                                                       report["pins"],
+                                                       pinned_dir)
     # now, run pip on the requirements file.
-    run_pip(pip, req_file_path, logger, package_cache_dir)
+    try:
+        run_pip(pip, req_file_path, logger, package_cache_dir, find_links)
+    finally:
+        if pinned_dir:
+            shutil.rmtree(pinned_dir)
+    return report
 
 
 _platform_requirements = [
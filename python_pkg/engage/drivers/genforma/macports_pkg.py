@@ -10,6 +10,8 @@ import sys
 import re
 import copy
 import getpass
+import threading
+import subprocess
 
 import fixup_python_path
 
@@ -102,7 +104,55 @@ ENV = os.environ.copy()
 ENV["PATH"] = fixup_port_path()
 if not ENV.has_key("HOME"):
     ENV["HOME"] = os.path.join("/Users", getpass.getuser())
-    
+
+# MacPorts holds a registry lock while installing, so we only run one port
+# install at a time, even if resources are being installed in parallel.
+port_lock = threading.Lock()
+
+def install_ports(port_exe, package_list, sudo_password, resource_id,
+                  logger=logger):
+    """Install the specified port(s) with a single port install command.
+    """
+    try:
+        with port_lock:
+            iuprocess.run_sudo_program([port_exe, "install"]+package_list,
+                                       sudo_password, logger,
+                                       cwd=os.path.dirname(port_exe),
+                                       env=ENV)
+    except iuprocess.SudoError, e:
+        exc_info = sys.exc_info()
+        logger.exception("Port install for %s failed, unexpected exception" % package_list)
+        sys.exc_clear()
+        raise convert_exc_to_user_error(exc_info, errors[ERR_MACPORTS_INSTALL],
+                                        msg_args={"pkg":package_list.__repr__(),
+                                                  "id":resource_id},
+                                        nested_exc_info=e.get_nested_exc_info())
+
+
+def get_installed_ports(port_exe, package_list):
+    """Return the set of ports from package_list which are installed and
+    active, using a single 'port installed' query.
+    """
+    if len(package_list)==0:
+        return set()
+    subproc = subprocess.Popen([port_exe, "installed"] + package_list,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT,
+                               cwd=os.path.dirname(port_exe), env=ENV)
+    output = subproc.communicate()[0]
+    # The query fails if any of the ports are unknown. We just return the
+    # ones which were found - the caller checks the others individually.
+    installed = set()
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields)>=3 and fields[1].startswith("@") and \
+           line.rstrip().endswith("(active)"):
+            installed.add(fields[0])
+    logger.debug("port installed rc=%d, active ports: %s" %
+                 (subproc.returncode, sorted(installed)))
+    return installed
+
+
 class port_install(action.Action):
     NAME="macports_pkg.port_install"
     def __init__(self, ctx):
@@ -116,20 +166,8 @@ class port_install(action.Action):
         """
         port_exe = self.ctx.props.input_ports.macports.macports_exe
         action._check_file_exists(port_exe, self)
-        try:
-            iuprocess.run_sudo_program([port_exe, "install"]+package_list,
-                                       self.ctx._get_sudo_password(self),
-                                       self.ctx.logger,
-                                       cwd=os.path.dirname(port_exe),
-                                       env=ENV)
-        except iuprocess.SudoError, e:
-            exc_info = sys.exc_info()
-            self.ctx.logger.exception("Port install for %s failed, unexpected exception" % package_list)
-            sys.exc_clear()
-            raise convert_exc_to_user_error(exc_info, errors[ERR_MACPORTS_INSTALL],
-                                            msg_args={"pkg":package_list.__repr__(),
-                                                      "id":self.ctx.props.id},
-                                            nested_exc_info=e.get_nested_exc_info())
+        install_ports(port_exe, package_list, self.ctx._get_sudo_password(self),
+                      self.ctx.props.id, self.ctx.logger)
         
     def dry_run(self, package_list):
         port_exe = self.ctx.props.input_ports.macports.macports_exe
@@ -248,6 +286,24 @@ def make_context(resource_json, sudo_password_fn, dry_run=False):
     return ctx
 
 
+class BatchInstaller(object):
+    """Installs the ports of several resources with a single port install
+    command. See resource_manager.Manager.get_batch_installer().
+    """
+    def __init__(self, port_exe, sudo_password_fn, resource_id):
+        self.port_exe = port_exe
+        self.batch_key = ("port", port_exe)
+        self.sudo_password_fn = sudo_password_fn
+        self.resource_id = resource_id
+
+    def get_installed_packages(self, package_list):
+        return get_installed_ports(self.port_exe, package_list)
+
+    def install_packages(self, package_list):
+        install_ports(self.port_exe, package_list, self.sudo_password_fn(),
+                      self.resource_id)
+
+
 class Manager(resource_manager.Manager, PasswordRepoMixin):
     REQUIRES_ROOT_ACCESS = True
     def __init__(self, metadata, dry_run=False):
@@ -270,6 +326,13 @@ class Manager(resource_manager.Manager, PasswordRepoMixin):
                    [self.ctx.props.output_ports.port_cfg.package_name])
         self.validate_post_install()
 
+    def get_batch_installer(self, package):
+        if self.ctx.dry_run:
+            return None
+        return (BatchInstaller(self.ctx.props.input_ports.macports.macports_exe,
+                               self._get_sudo_password, self.id),
+                self.ctx.props.output_ports.port_cfg.package_name)
+
     def validate_post_install(self):
         if not self.is_installed() and not self.ctx.dry_run:
             raise UserError(errors[ERR_POST_INSTALL],
@@ -4,10 +4,24 @@ of the following:
  * A local archive file name
  * A package name and version constraint containing == or >=. This goes into
    a requirements file.
+
+Resources whose package is a reference to a package name or a requirement
+(but not a version control URL) can be installed in batches by the install
+engine (see engage.engine.package_batch). The packages of all the ready resources
+which use the same pip executable are first built into wheels in a shared
+wheelhouse under the engage cache directory, and then installed with a single
+pip install command from the wheelhouse (packages whose test module is
+already present are installed by a second command with --upgrade). Wheels
+are built once, and reused by later installs using the same cache directory.
+In offline mode (the --pip-offline option of the installer), we skip the
+build step, and the wheelhouse must already contain all the required
+packages. As for a single resource, a package counts as installed only if
+its test module (if any) can be imported at the resource's version.
 """
 
 import commands
 import os
+import re
 import tempfile
 
 import engage.drivers.resource_manager as resource_manager
@@ -40,6 +54,9 @@ ERR_POST_INSTALL = 2
 
 PIP_TIMEOUT=45
 
+# name of the shared wheelhouse directory, under the cache directory
+WHEELHOUSE_DIR_NAME = "wheelhouse"
+
 define_error(ERR_PKG,
              _("error installing %(pkg)s using pip"))
 define_error(ERR_POST_INSTALL,
@@ -57,9 +74,194 @@ def is_module_at_version(self, python_exe, test_module, version_property, expect
         data = iuproc.run_program_and_capture_results(cmd, None, self.ctx.logger,
                                                       cwd=os.path.dirname(python_exe)).rstrip()
     cmp = compare_versions(data, expected_version)
-    return (cmd==0) or (cmd==1) # true if data >= expected_version
+    return (cmp==0) or (cmp==1) # true if data >= expected_version
     
 
+_requirement_re = re.compile(r"^([A-Za-z0-9_.\-]+)\s*(?:(==|>=)\s*([A-Za-z0-9_.\-]+))?$")
+
+def parse_requirement(requirement):
+    """Return a (name, op, version) triple for a pip requirement. The op
+    and version are None if there is no version constraint. Returns None if
+    we cannot parse the requirement.
+
+    >>> parse_requirement("pytz>=2013b")
+    ('pytz', '>=', '2013b')
+    >>> parse_requirement("lxml")
+    ('lxml', None, None)
+    >>> parse_requirement("hg+http://bitbucket.org/chris1610/satchmo/#egg=satchmo")
+    ('satchmo', None, None)
+    >>> print parse_requirement("Django<1.5")
+    None
+    """
+    if "#egg=" in requirement:
+        return (requirement.split("#egg=")[1].split("&")[0], None, None)
+    mo = _requirement_re.match(requirement)
+    if mo==None:
+        return None
+    return (mo.group(1), mo.group(2), mo.group(3))
+
+
+def is_batchable_requirement(requirement):
+    """Return True if the requirement is a package name, optionally with a
+    version constraint. These can be built into the shared wheelhouse and
+    installed from it. For a version control or other URL, pip install
+    ignores the wheelhouse and fetches the URL again, so such resources are
+    not batched.
+
+    >>> is_batchable_requirement("pytz>=2013b")
+    True
+    >>> is_batchable_requirement("hg+http://bitbucket.org/chris1610/satchmo/#egg=satchmo")
+    False
+    """
+    return _requirement_re.match(requirement)!=None
+
+
+def _normalize_name(name):
+    return name.lower().replace("_", "-")
+
+
+def get_installed_distributions(pipbin, logger):
+    """Return a map from (normalized) project names to versions for the
+    packages installed by pip, using a single pip freeze call.
+    """
+    data = iuproc.run_program_and_capture_results([pipbin, "freeze"], None,
+                                                  logger,
+                                                  cwd=os.path.dirname(pipbin))
+    dists = {}
+    for line in data.splitlines():
+        line = line.strip()
+        if line.startswith("-") or ("==" not in line):
+            continue # editable or unversioned entry
+        (name, version) = line.split("==", 1)
+        dists[_normalize_name(name)] = version
+    return dists
+
+
+def is_requirement_satisfied(requirement, dists):
+    """Return True if the requirement is satisfied by the installed
+    distributions (as returned by get_installed_distributions()).
+
+    >>> is_requirement_satisfied("lxml", {"lxml":"2.3"})
+    True
+    >>> is_requirement_satisfied("Django", {"lxml":"2.3"})
+    False
+    >>> is_requirement_satisfied("django_celery", {"django-celery":"3.0.11"})
+    True
+    """
+    parsed = parse_requirement(requirement)
+    if parsed==None:
+        return False
+    (name, op, version) = parsed
+    name = _normalize_name(name)
+    if not dists.has_key(name):
+        return False
+    elif op==None:
+        return True
+    cmp = compare_versions(dists[name], version)
+    if op=="==":
+        return cmp==0
+    else:
+        return cmp==0 or cmp==1
+
+
+# map from pip executable to its BatchInstaller
+_batch_installers = {}
+
+class BatchInstaller(object):
+    """Installs the packages of several resources which use the same pip
+    executable (and thus the same Python interpreter). See
+    resource_manager.Manager.get_batch_installer(). There is one installer
+    per pip executable, which records the manager of each resource, so that
+    we can make the same test module and version checks as
+    Manager.is_installed().
+
+    Here is an example with fake managers: lxml is in the pip freeze output,
+    but the resource's test module is at an older version, so it still needs
+    to be installed.
+
+    >>> class FakeManager(object):
+    ...     def __init__(self, current):
+    ...         self.current = current
+    ...     def is_module_current(self):
+    ...         return self.current
+    >>> installer = BatchInstaller("/tmp/bin/pip", None, "/tmp/cache")
+    >>> installer.add_resource("lxml", FakeManager(False))
+    >>> installer.add_resource("Django>=1.4", FakeManager(True))
+    >>> installer.add_resource("pytz", FakeManager(True))
+    >>> sorted(installer.get_current_packages(["lxml", "Django>=1.4", "pytz"],
+    ...                                       {"lxml":"2.3", "django":"1.4.2"}))
+    ['Django>=1.4']
+    """
+    def __init__(self, pipbin, ctx, cache_directory, offline=False):
+        self.pipbin = pipbin
+        self.batch_key = ("pip", pipbin)
+        self.ctx = ctx
+        self.wheelhouse = os.path.join(cache_directory, WHEELHOUSE_DIR_NAME)
+        self.offline = offline
+        self.managers = {} # map from requirement to resource manager
+
+    def add_resource(self, requirement, mgr):
+        if not self.managers.has_key(requirement):
+            self.managers[requirement] = mgr
+
+    def get_current_packages(self, package_list, dists):
+        """Return the set of requirements which are satisfied by the
+        installed distributions and whose resource's test module (if any)
+        is present at the required version.
+        """
+        return set([requirement for requirement in package_list
+                    if is_requirement_satisfied(requirement, dists) and
+                       self.managers[requirement].is_module_current()])
+
+    def get_installed_packages(self, package_list):
+        dists = get_installed_distributions(self.pipbin, self.ctx.logger)
+        return self.get_current_packages(package_list, dists)
+
+    def install_packages(self, package_list):
+        cwd = os.path.dirname(self.pipbin)
+        # if there is already a module with the same name, we need to force
+        # an upgrade
+        upgrades = [requirement for requirement in package_list
+                    if self.managers[requirement].is_module_present()]
+        new_packages = [requirement for requirement in package_list
+                        if requirement not in upgrades]
+        if not os.path.exists(self.wheelhouse):
+            os.makedirs(self.wheelhouse)
+        if self.offline:
+            self.ctx.logger.info("Offline mode: installing %s from %s" %
+                                 (" ".join(package_list), self.wheelhouse))
+        else:
+            # Build wheels for the packages and their dependencies. Wheels
+            # already in the wheelhouse are reused.
+            rc = iuproc.run_and_log_program([self.pipbin, "wheel",
+                                             "--wheel-dir=%s" % self.wheelhouse,
+                                             "--find-links=%s" % self.wheelhouse,
+                                             "--timeout=%d" % PIP_TIMEOUT] +
+                                            package_list,
+                                            None, self.ctx.logger, cwd=cwd)
+            if rc!=0:
+                # This version of pip may not support wheels. Install
+                # directly from the index instead.
+                self.ctx.logger.warning("pip wheel failed with return code %d, installing %s without the wheelhouse" %
+                                        (rc, " ".join(package_list)))
+                self._run_install(["--timeout=%d" % PIP_TIMEOUT],
+                                  new_packages, upgrades)
+                return
+        self._run_install(["--no-index", "--find-links=%s" % self.wheelhouse],
+                          new_packages, upgrades)
+
+    def _run_install(self, options, new_packages, upgrades):
+        cwd = os.path.dirname(self.pipbin)
+        if len(new_packages)>0:
+            self.ctx.r(run_program,
+                       [self.pipbin, "install"] + options + new_packages,
+                       cwd=cwd)
+        if len(upgrades)>0:
+            self.ctx.r(run_program,
+                       [self.pipbin, "install", "--upgrade"] + options +
+                       upgrades, cwd=cwd)
+
+
 def make_context(resource_json, dry_run=False):
     ctx = Context(resource_json, logger, __file__,
                   sudo_password_fn=None,
@@ -118,26 +320,44 @@ class Manager(resource_manager.Manager):
             logger.debug("%s: metadata not present to tell if package is installed, so assuming not installed" % p.id)
             return False
         else:
-            # try importing the test module specified in the metadata
-            # to see if the package is installed
-            installed = self.ctx.rv(is_module_installed, p.test_module)
-            if installed and p.version_property!=None:
-                # we have a version property, compare it to the resource's
-                # version. If the installed version is older, we'll assume we
-                # need to reinstall.
-                return self.ctx.rv(is_module_at_version, p.python_exe,
-                                   p.test_module,
-                                   p.version_property,
-                                   self.metadata.key['version'])
-            else:
-                return installed
-            
+            return self.is_module_current()
+
+    def is_module_present(self):
+        """Return True if the resource has a test module and it can be
+        imported.
+        """
+        p = self.ctx.props
+        return bool(p.test_module) and \
+               self.ctx.rv(is_module_installed, p.test_module)
+
+    def is_module_current(self):
+        """Return True if the resource's test module (if specified in the
+        metadata) can be imported and is at least the resource's version
+        (if the metadata has a version property).
+        """
+        p = self.ctx.props
+        if (not p.python_exe) or (not p.test_module):
+            return True
+        # try importing the test module specified in the metadata
+        # to see if the package is installed
+        installed = self.ctx.rv(is_module_installed, p.test_module)
+        if installed and p.version_property!=None:
+            # we have a version property, compare it to the resource's
+            # version. If the installed version is older, we'll assume we
+            # need to reinstall.
+            return self.ctx.rv(is_module_at_version, p.python_exe,
+                               p.test_module,
+                               p.version_property,
+                               self.metadata.key['version'])
+        else:
+            return installed
+
 
     def install(self, package):
         p = self.ctx.props
         cmd = [self.pip, 'install', "--use-mirrors",
                "--timeout=%d" % PIP_TIMEOUT]
-        if p.test_module and self.ctx.rv(is_module_installed, p.test_module):
+        if self.is_module_present():
             # if there is already a module with the same name, we need to force
             # an upgrade
             cmd.append('--upgrade')
@@ -193,6 +413,22 @@ class Manager(resource_manager.Manager):
                 os.remove(req_file.name)
 
 
+    def get_batch_installer(self, package):
+        if self.editable or self.prefix_dir!=None or self.script_dir!=None or \
+           self.ctx.dry_run or package==None or \
+           isinstance(package, engage_utils.pkgmgr.Package) or \
+           package.type!=library.Package.REFERENCE_TYPE or \
+           not is_batchable_requirement(package.location):
+            return None
+        if not _batch_installers.has_key(self.pip):
+            cache_directory = self.install_context.engage_file_layout.get_cache_directory()
+            offline = getattr(self.install_context, "pip_offline", False)
+            _batch_installers[self.pip] = \
+                BatchInstaller(self.pip, self.ctx, cache_directory, offline)
+        installer = _batch_installers[self.pip]
+        installer.add_resource(package.location, self)
+        return (installer, package.location)
+
     def validate_post_install(self):
         p = self.ctx.props
         if (not p.python_exe) or (not p.test_module) or self.ctx.dry_run:
@@ -5,9 +5,9 @@ machine or a subdirectory within a given machine.
 """
 import os.path
 import shutil
-import json
 
 import resource_manager
+import engage.utils.json_backend as json_backend
 from engage.utils.log_setup import setup_engine_logger
 
 from engage.utils.user_error import InstErrInf, UserError
@@ -55,7 +55,7 @@ RESOURCE_FILENAME = "installed_resources.json"
 def write_resources_to_file(mgr_list, filename):
     resources = [mgr.metadata.to_json() for mgr in mgr_list]
     file = open(filename, "wb")
-    json.dump(resources, file, sort_keys=True, indent=2)
+    json_backend.dump(resources, file, sort_keys=True, indent=2)
     file.close()
 
 
@@ -51,6 +51,22 @@ class Manager(object):
     def install(self, library_package):
         raise UndefinedMethod(self, "install")
 
+    def get_batch_installer(self, library_package):
+        """Resources which just install a package via the system package
+        manager (e.g. apt-get or MacPorts) can be installed together in a
+        single package manager transaction. Such resources return a pair of
+        a batch installer and the name of the resource's package. The
+        install sequencer then installs the resource by calling the batch
+        installer instead of is_installed() and install().
+
+        A batch installer has an attribute batch_key (installers with equal
+        keys may be combined) and the methods get_installed_packages(package_list),
+        which returns the set of those packages already installed, and
+        install_packages(package_list). The default implementation returns
+        None, meaning that the resource cannot be batched.
+        """
+        return None
+
     def validate_post_install(self):
         """Validate that the install is correct. Called if the package
         is already installed and we want to see if it is really setup
@@ -77,6 +93,10 @@ class Manager(object):
         
         The compress flag is just a hint about whether we are more
         concerned about space vs. time.
+
+        May return a (bytes_in, bytes_out) pair giving the amount of data
+        backed up and the size written to the backup directory (either may
+        be None if unknown), which is used to report backup throughput.
         """
         pass
 
@@ -3,8 +3,13 @@
 #
 import json
 import sys
-    
+import copy
+import weakref
+import exceptions
+
 from engage.extensions import installed_extensions
+import engage.engine.driver_registry as driver_registry
+import engage.utils.json_backend as json_backend
 
 import logging
 logger = logging.getLogger(__name__)
@@ -27,6 +32,77 @@ def _serialized_json(obj):
     return json.dumps(obj, sort_keys=True, indent=1)
 
 
+class FrozenDict(dict):
+    """A dictionary which cannot be changed in place. Used for resource keys
+    and port mappings, which are shared between resource instances (see
+    intern_dict()). Copies are ordinary (mutable) dictionaries.
+
+    >>> d = FrozenDict({"name":"foo", "version":"1.0"})
+    >>> d["name"]
+    'foo'
+    >>> try:
+    ...     d["name"] = "bar"
+    ... except exceptions.TypeError, e:
+    ...     print e
+    FrozenDict is immutable
+    >>> c = copy.deepcopy(d)
+    >>> c["name"] = "bar"
+    >>> isinstance(c, FrozenDict), d["name"]
+    (False, 'foo')
+    """
+    __slots__ = ("__weakref__",)
+
+    def _immutable(self, *args, **kwargs):
+        raise exceptions.TypeError("%s is immutable" % self.__class__.__name__)
+
+    __setitem__ = _immutable
+    __delitem__ = _immutable
+    clear = _immutable
+    pop = _immutable
+    popitem = _immutable
+    setdefault = _immutable
+    update = _immutable
+
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(dict(self), memo)
+
+    def __reduce__(self):
+        return (self.__class__, (dict(self),))
+
+
+# map from the sorted items of a dictionary to its shared FrozenDict. Entries
+# go away when no resource instance references them.
+_interned_dicts = weakref.WeakValueDictionary()
+
+def intern_dict(d):
+    """Return a FrozenDict equal to d. If the values of d are hashable (as
+    for resource keys and port mappings), all equal dictionaries share one
+    FrozenDict instance.
+
+    >>> k1 = intern_dict({u"name":u"foo", u"version":u"1.0"})
+    >>> k2 = intern_dict({u"version":u"1.0", u"name":u"foo"})
+    >>> k1 is k2, k1==k2=={u"name":u"foo", u"version":u"1.0"}
+    (True, True)
+    >>> intern_dict({u"name":u"foo", u"version":{u"greater-than":u"1.0"}})=={u"name":u"foo", u"version":{u"greater-than":u"1.0"}}
+    True
+    """
+    if isinstance(d, FrozenDict):
+        return d
+    try:
+        items = tuple(sorted(d.items()))
+        hash(items)
+    except exceptions.TypeError:
+        return FrozenDict(d)
+    frozen = _interned_dicts.get(items, None)
+    if frozen==None:
+        frozen = FrozenDict(d)
+        _interned_dicts[items] = frozen
+    return frozen
+
+
 _type_err_msg = \
   "Configuration property '%s' has wrong type: was %s, expecting %s"
 
@@ -68,6 +144,31 @@ def _make_cfgobj_list(values, item_type, _parent_prop_name):
     return result
 
 
+def _check_config_types(props_in, types, _parent_prop_name):
+    """Check that props_in matches types, as done when constructing a Config
+    object, including any nested dictionaries. This lets us defer the
+    construction of nested Config objects without deferring type errors.
+    """
+    for prop_name in types:
+        if not props_in.has_key(prop_name):
+            if _parent_prop_name!=None:
+                qualified_name = _parent_prop_name + "." + prop_name
+            else:
+                qualified_name = prop_name
+            raise TypeError, \
+                "Configuration property '%s' missing" % qualified_name
+    for (prop_name, prop_val) in props_in.items():
+        if not types.has_key(prop_name):
+            continue
+        if _parent_prop_name!=None:
+            qualified_name = _parent_prop_name + "." + prop_name
+        else:
+            qualified_name = prop_name
+        _check_type(prop_val, types[prop_name], qualified_name)
+        if isinstance(prop_val, dict):
+            _check_config_types(prop_val, types[prop_name], qualified_name)
+
+
 def _back_to_json(value):
     if isinstance(value, Config):
         return value._to_json()
@@ -155,27 +256,25 @@ class Config:
            either str, int, float, or bool.
         """
         self.__dict__["_props"] = {}
+        # Nested dictionaries are only converted to Config objects when
+        # first accessed. Until then, we keep the dictionary in _props and
+        # map the property name to its (types, qualified name) here.
+        self.__dict__["_unconverted"] = {}
         if types!=None:
             # if we have types, first make sure all the required properties
-            # are present
-            for prop_name in types:
-                if not props_in.has_key(prop_name):
-                    if _parent_prop_name!=None:
-                        qualified_name = _parent_prop_name + "." + prop_name
-                    else:
-                        qualified_name = prop_name
-                    raise TypeError, \
-                        "Configuration property '%s' missing" % qualified_name
+            # are present and have the right types, including those
+            # of nested dictionaries
+            _check_config_types(props_in, types, _parent_prop_name)
         for (prop_name, prop_val) in props_in.items():
             if _parent_prop_name!=None:
                 qualified_name = _parent_prop_name + "." + prop_name
             else:
                 qualified_name = prop_name
             if types!=None and types.has_key(prop_name):
-                _check_type(prop_val, types[prop_name], qualified_name)
                 if isinstance(prop_val, dict):
-                    child = Config(prop_val, types[prop_name], qualified_name)
-                    self._props[prop_name] = child
+                    self._props[prop_name] = prop_val
+                    self._unconverted[prop_name] = (types[prop_name],
+                                                    qualified_name)
                 elif isinstance(prop_val, list):
                     self._props[prop_name] = \
                        _make_cfgobj_list(prop_val, types[prop_name][0],
@@ -184,8 +283,8 @@ class Config:
                     self._props[prop_name] = prop_val
             else: # no type information
                 if isinstance(prop_val, dict):
-                    self._props[prop_name] = Config(prop_val, None,
-                                                    qualified_name)
+                    self._props[prop_name] = prop_val
+                    self._unconverted[prop_name] = (None, qualified_name)
                 elif isinstance(prop_val, list):
                     self._props[prop_name] = \
                        _make_cfgobj_list(prop_val, None,
@@ -194,12 +293,27 @@ class Config:
                     self._props[prop_name] = prop_val
                 
 
+    def _get_prop(self, name):
+        """Return the value of the property, converting it to a Config
+        object if it is a dictionary which has not yet been converted.
+        """
+        value = self._props[name]
+        if self._unconverted.has_key(name):
+            (types, qualified_name) = self._unconverted[name]
+            value = Config(value, types, qualified_name)
+            self._props[name] = value
+            del self._unconverted[name]
+        return value
+
     def _to_json(self):
         """Return an in-memory json representation of this config object.
         """
         result = {}
         for (key, value) in self._props.items():
-            result[key] = _back_to_json(value)
+            if self._unconverted.has_key(key):
+                result[key] = copy.deepcopy(value)
+            else:
+                result[key] = _back_to_json(value)
         return result
 
     def _add_computed_prop(self, qualified_name, value, prop_type=None,
@@ -229,7 +343,7 @@ class Config:
             if not self._props.has_key(prop_name):
                 raise TypeError, \
                     "Unable to add computed property: property '%s' not present in configuration object" % _new_name_prefix
-            prop_val = self._props[prop_name]
+            prop_val = self._get_prop(prop_name)
             if not isinstance(prop_val, Config):
                 raise TypeError, \
                     "Unable to add computed property: property '%s' has wrong type: should be dict, was %s" % (_new_name_prefix, prop_val.__class__.__name__)
@@ -254,7 +368,7 @@ class Config:
             
 
     def __getattr__(self, name):
-        if self._props.has_key(name): return self._props[name]
+        if self._props.has_key(name): return self._get_prop(name)
         else: raise AttributeError, "%s not an attribute" % name
 
     def __setattr__(self, name, value):
@@ -274,12 +388,16 @@ def convert_resource_key_to_driver_module_names(key, prefix="engage.drivers."):
     return candidates
 
 
-class ResourceRef:
-    """Object representation of a resource reference"""
+class ResourceRef(object):
+    """Object representation of a resource reference. The key and port
+    mapping are interned, immutable dictionaries.
+    """
+    __slots__ = ("id", "key", "port_mapping")
+
     def __init__(self, id, key, port_mapping=None):
         self.id = id
-        self.key = key
-        self.port_mapping = _default_init_val(port_mapping, {})
+        self.key = intern_dict(key)
+        self.port_mapping = intern_dict(_default_init_val(port_mapping, {}))
 
     def to_json(self):
         """Returns an in-memory json representation of resource reference"""
@@ -291,15 +409,23 @@ class ResourceRef:
         return _serialized_json(self.to_json())
 
 
-class ResourceMD:
-    """Object representation of resource instance metadata"""
+class ResourceMD(object):
+    """Object representation of resource instance metadata. To keep the
+    metadata for large deployments compact, instances have no __dict__ and
+    the key is an interned, immutable dictionary shared with all other
+    instances of the same resource type.
+    """
+    __slots__ = ("id", "key", "properties", "config_port", "input_ports",
+                 "output_ports", "inside", "environment", "peers",
+                 "driver_module_name", "package")
+
     def __init__(self, id, key, properties=None, config_port=None,
                  input_ports=None, output_ports=None,
                  inside=None, environment=None, peers=None,
                  driver_module_name=None,
                  package=None):
         self.id = id
-        self.key = key
+        self.key = intern_dict(key)
         self.properties = _default_init_val(properties, {})
         self.config_port = _default_init_val(config_port, {})
         self.input_ports = _default_init_val(input_ports, {})
@@ -372,6 +498,12 @@ class ResourceMD:
             for comp in components[1:]:
                 mod = getattr(mod, comp)
             return getattr(mod, 'Manager')
+        driver_module_name = driver_registry.get_driver_module_name(self.key)
+        if driver_module_name:
+            # the driver was found when the resources were preprocessed
+            logger.debug("Importing %s (from driver registry)" % driver_module_name)
+            mod = __import__(driver_module_name, globals(), locals(), ['Manager',], -1)
+            return getattr(mod, 'Manager')
         else:
             # harder - using a key to infer a driver name.
             driver_module_names = convert_resource_key_to_driver_module_names(self.key)
@@ -555,7 +687,7 @@ def parse_install_soln(install_soln_filename):
     """Parse a json file containing a list of instances.
     """
     with open(install_soln_filename, "rb") as f:
-        resource_list_json = json.load(f)
+        resource_list_json = json_backend.load(f)
     return [parse_resource_from_json(resource_json) for
             resource_json in resource_list_json]
 
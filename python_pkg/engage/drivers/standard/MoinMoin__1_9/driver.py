@@ -146,8 +146,8 @@ def _setup_apache_config_files(ctx):
     rv = ctx.rv
     p = ctx.props
     # instantiate templates
-    r(template, "engage_logging.cfg", p.log_config_file)
-    r(template, "engage_moin.wsgi", p.wsgi_file)
+    r(template_batch, [("engage_logging.cfg", p.log_config_file),
+                       ("engage_moin.wsgi", p.wsgi_file)])
     if p.use_apache_authentication:
         apache_cfg_data = rv(get_template_subst, "moinmoin_apache_auth.conf")
     else:
@@ -7,12 +7,17 @@ import os.path
 import sys
 import json
 import shutil
+import time
+import threading
+import Queue
 
 import fixup_python_path
 
 import engage.utils.log_setup as log_setup
 import engage.utils.backup as backup
 import cmdline_script_utils
+import install_plan
+import state_cache
 
 from engage.utils.user_error import UserError, EngageErrInf
 
@@ -41,11 +46,100 @@ def _ends_with(s, suffix):
     else:
         return False
 
-def backup_resources(backup_directory, mgr_pkg_list, logger, compress):
+def _format_size(num_bytes):
+    if num_bytes==None:
+        return "?"
+    return "%.1f MB" % (float(num_bytes)/(1024*1024))
+
+def _log_backup_stats(resource_id, elapsed, stats, logger):
+    (bytes_in, bytes_out) = stats if stats else (None, None)
+    if bytes_in!=None and elapsed>0:
+        throughput = ", %.1f MB/s" % (float(bytes_in)/(1024*1024)/elapsed)
+    else:
+        throughput = ""
+    logger.info("Backed up resource %s in %.1f seconds: %s read, %s written%s" %
+                (resource_id, elapsed, _format_size(bytes_in),
+                 _format_size(bytes_out), throughput))
+
+def _get_backup_locks(mgr_pkg_list):
+    """Resources are backed up independently, except that a driver's backup
+    may start and stop the services it depends on (e.g. the MySQL connector
+    starts the server to dump its database). Thus, we do not run two backups
+    concurrently if they involve the same service: either both depend
+    directly on it, or one is the service itself. Returns a map from resource
+    id to the set of service ids it must hold while being backed up.
+    """
+    mgrs = dict([(m.id, m) for (m, p) in mgr_pkg_list])
+    dependencies = install_plan.get_resource_dependencies([m.metadata for (m, p)
+                                                           in mgr_pkg_list])
+    locks = {}
     for (m, p) in mgr_pkg_list:
-        logger.debug("backing up resource %s" % m.id)
-        m.backup(backup_directory, compress)
-    logger.info("Backup of deployed resources to %s completed successfully" % backup_directory)
+        locks[m.id] = set([dep_id for dep_id in dependencies[m.id]
+                           if mgrs.has_key(dep_id) and mgrs[dep_id].is_service()])
+        if m.is_service():
+            locks[m.id].add(m.id)
+    return locks
+
+def _backup_worker(m, backup_directory, compress, result_queue):
+    start_time = time.time()
+    try:
+        stats = m.backup(backup_directory, compress)
+        result_queue.put((m.id, time.time()-start_time, stats, None))
+    except:
+        result_queue.put((m.id, time.time()-start_time, None, sys.exc_info()))
+
+def backup_resources(backup_directory, mgr_pkg_list, logger, compress,
+                     num_workers=1):
+    """Backup the resources, running up to num_workers backups concurrently
+    (see _get_backup_locks() for which resources may run together). If a
+    backup fails, we wait for the running backups to finish and then
+    re-raise the first error.
+    """
+    locks = _get_backup_locks(mgr_pkg_list)
+    held = set()
+    pending = [m for (m, p) in mgr_pkg_list]
+    result_queue = Queue.Queue()
+    in_flight = 0
+    error = None
+    start_time = time.time()
+    total_in = 0
+    while (len(pending)>0 and error==None) or in_flight>0:
+        if error==None:
+            still_pending = []
+            for m in pending:
+                if in_flight<num_workers and held.isdisjoint(locks[m.id]):
+                    logger.debug("backing up resource %s" % m.id)
+                    held.update(locks[m.id])
+                    t = threading.Thread(target=_backup_worker,
+                                         args=(m, backup_directory, compress,
+                                               result_queue),
+                                         name="backup-%s" % m.id)
+                    t.daemon = True
+                    t.start()
+                    in_flight += 1
+                else:
+                    still_pending.append(m)
+            pending = still_pending
+        try:
+            # use a bounded wait so that we remain interruptable from the console
+            (resource_id, elapsed, stats, exc_info) = result_queue.get(True, 1.0)
+        except Queue.Empty:
+            continue
+        in_flight -= 1
+        held.difference_update(locks[resource_id])
+        if exc_info:
+            logger.error("Backup of resource %s failed" % resource_id)
+            if error==None:
+                error = exc_info
+        else:
+            _log_backup_stats(resource_id, elapsed, stats, logger)
+            if stats and stats[0]!=None:
+                total_in += stats[0]
+    if error:
+        raise error[0], error[1], error[2]
+    elapsed = time.time() - start_time
+    logger.info("Backup of deployed resources to %s completed successfully: %s in %.1f seconds" %
+                (backup_directory, _format_size(total_in), elapsed))
 
 def uninstall_resources(mgr_pkg_list, logger):
     for (m, p) in mgr_pkg_list:
@@ -64,7 +158,9 @@ def save_engage_files(backup_directory, deployment_home, logger, compress):
     else:
         backup_archive = os.path.join(backup_directory, "engage_files.tar")
     logger.info("Saving engage files to %s" % backup_archive)
-    backup.save(files, backup_archive, move=False)
+    start_time = time.time()
+    stats = backup.save(files, backup_archive, move=False)
+    _log_backup_stats("engage files", time.time()-start_time, stats, logger)
     # installed resources and config choices are used in upgrade,
     # so have convenience copies that aren't tarred
     installed_resources_file = os.path.join(deployment_home, "config/installed_resources.json")
@@ -97,11 +193,16 @@ def main(argv):
 
     parser.add_option("--compress", "-c", action="store_true", dest="compress",
                       default=False, help="If specified, compress backup files")
+    parser.add_option("--parallel", dest="parallel", type="int", default=1,
+                      metavar="N",
+                      help="Number of resources to back up concurrently (defaults to 1). Compression always uses all the cores.")
     cmdline_script_utils.add_standard_cmdline_options(parser,
                                                       running_deployment=False)
     (options, args) = parser.parse_args()
     if not (len(args)==2 or (len(args)==1 and args[0]=="uninstall")):
         parser.error("Wrong number of args, expecting 1 or 2")
+    if options.parallel<1:
+        parser.error("Value for --parallel must be at least 1")
     cmd = args[0]
     valid_commands = ["backup", "uninstall", "restore", "restore-engage"]
     if not (cmd in valid_commands):
@@ -124,6 +225,9 @@ def main(argv):
         restore_engage_files(backup_directory)
         return 0 # skip the rest
 
+    # The commands below change the state of the resources, so we remove
+    # svcctl's state cache, and don't use one for our own probes.
+    state_cache.remove_cache_file(file_layout.get_state_cache_file(dh))
     mgr_pkg_list = cmdline_script_utils.get_mgrs_and_pkgs(file_layout, dh, options)
 
     logger = log_setup.setup_engine_logger(__name__)
@@ -133,7 +237,8 @@ def main(argv):
             if m.is_service() and m.is_running():
                 logger.info("stopping resource %s" % m.id)
                 m.stop()
-        backup_resources(backup_directory, mgr_pkg_list, logger, options.compress)
+        backup_resources(backup_directory, mgr_pkg_list, logger, options.compress,
+                         num_workers=options.parallel)
         save_engage_files(backup_directory, dh, logger, options.compress)
     elif cmd=="uninstall":
         for (m, p) in reversed(mgr_pkg_list):
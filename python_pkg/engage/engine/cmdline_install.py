@@ -16,6 +16,7 @@ from engage.utils.user_error import UserError, EngageErrInf, convert_exc_to_user
 from engage.engine.installer_config import parse_installer_config, \
      ValidationResults, LocalFileType, ConfigProperty, PasswordType
 import engage.utils.log_setup as log_setup
+import engage.utils.trace as tracing
 import engage.engine.install_engine as install_engine
 from engage.engine.engage_file_layout import get_engine_layout_mgr
 from engage.utils.file import subst_utf8_template_file
@@ -516,8 +517,9 @@ def run(req, logger):
     req.config_choices.save_history_file(os.path.join(req.installer_file_layout.get_config_choices_file(req.deployment_home)))
     
     # run the configuration engine
-    preprocess_and_run_config_engine(req.installer_file_layout,
-        req.installer_file_layout.get_install_spec_file(install_spec_option_no))
+    with tracing.span("config_engine", "phase"):
+        preprocess_and_run_config_engine(req.installer_file_layout,
+            req.installer_file_layout.get_install_spec_file(install_spec_option_no))
 
     if not req.upgrade_from: # this is a fresh install
         for host in hosts:
@@ -1,11 +1,13 @@
 """Common functionality for the various command line scripts that need to instantiate resources.
 """
-import json
 import os.path
 
 import fixup_python_path
 import engage.utils.log_setup as log_setup
+import engage.utils.trace as tracing
+import engage.utils.json_backend as json_backend
 from engage.engine.engage_file_layout import get_engine_layout_mgr
+from engage.engine.package_prefetch import DEFAULT_PREFETCH_WORKERS
 from engage.drivers.resource_metadata import parse_resource_from_json
 
 
@@ -15,6 +17,7 @@ def add_standard_cmdline_options(parser, uses_pw_file=True,
     """These are the command line options used by 
     """
     log_setup.add_log_option(parser, default=default_log_level)
+    tracing.add_trace_option(parser)
     parser.add_option("--deployment-home", "-d", dest="deployment_home",
                       default=None,
                       help="Location of deployed application - can figure this out automatically unless installing from source")
@@ -46,6 +49,22 @@ def add_standard_cmdline_options(parser, uses_pw_file=True,
         parser.add_option("-n", "--dry-run", action="store_true",
                           default=False,
                           help="If specified, just do a dry run and exit")
+        parser.add_option("--parallel", dest="parallel", type="int",
+                          default=1, metavar="N",
+                          help="Install up to N independent resources in parallel. Default is 1 (install resources one at a time).")
+        parser.add_option("--resume", dest="resume", default=False,
+                          action="store_true",
+                          help="If specified, resume a failed install: skip resources recorded as completed in the install journal (<deployment_home>/config/install_journal.log) whose metadata has not changed.")
+        parser.add_option("--prefetch-workers", dest="prefetch_workers",
+                          type="int", default=DEFAULT_PREFETCH_WORKERS, metavar="N",
+                          help="Download packages in the background using N worker threads while the install runs. Use 0 to download each package only when it is needed. Default is %d." %
+                               DEFAULT_PREFETCH_WORKERS)
+        parser.add_option("--no-batch-packages", dest="batch_packages",
+                          default=True, action="store_false",
+                          help="If specified, install apt-get, MacPorts, and pip packages one resource at a time, rather than combining the packages of ready resources into a single package manager command.")
+        parser.add_option("--pip-offline", dest="pip_offline", default=False,
+                          action="store_true",
+                          help="If specified, install pip packages only from the wheelhouse in the package cache directory, without accessing the network. Use on hosts without internet access, after copying a wheelhouse built by another install.")
 
 
 def get_deployment_home(options, parser, file_layout, allow_overrides=False):
@@ -69,11 +88,16 @@ def process_standard_options(options, parser, precreated_file_layout=None, insta
     dh = get_deployment_home(options, parser, file_layout, allow_overrides=allow_overrides_of_dh)
     log_setup.parse_log_options(options, file_layout.get_log_directory(),
                                 rotate_logfiles=rotate_logfiles)
+    tracing.parse_trace_options(options, file_layout.get_log_directory())
     if hasattr(options, "master_password_file") and \
        options.master_password_file and \
        (not os.path.exists(options.master_password_file)):
         parser.error("Master password file %s does not exist" %
                      options.master_password_file)
+    if hasattr(options, "parallel") and options.parallel<1:
+        parser.error("Value for --parallel must be at least 1")
+    if hasattr(options, "prefetch_workers") and options.prefetch_workers<0:
+        parser.error("Value for --prefetch-workers cannot be negative")
     return (file_layout, dh)
 
 
@@ -101,15 +125,28 @@ def extract_standard_options(options):
         args.append("--suppress-master-password-file")
     if options.dry_run:
         args.append("--dry-run")
+    if hasattr(options, "parallel") and options.parallel>1:
+        args.extend(["--parallel", str(options.parallel)])
+    if hasattr(options, "resume") and options.resume:
+        args.append("--resume")
+    if hasattr(options, "prefetch_workers") and options.prefetch_workers!=DEFAULT_PREFETCH_WORKERS:
+        args.extend(["--prefetch-workers", str(options.prefetch_workers)])
+    if hasattr(options, "batch_packages") and not options.batch_packages:
+        args.append("--no-batch-packages")
+    if hasattr(options, "pip_offline") and options.pip_offline:
+        args.append("--pip-offline")
     ## if options.generate_password_file:
     ##     args.append("--generate-password-file")
     args.extend(log_setup.extract_log_options_from_options_obj(options))
+    args.extend(tracing.extract_trace_options_from_options_obj(options))
     return args
     
 def get_mgrs_and_pkgs(file_layout, deployment_home, options,
-                      resource_file=None):
+                      resource_file=None, state_cache=None):
     """Perform common initialization operations, returning
-    a list of (mgr, pkg) pairs sorted in dependency order.
+    a list of (mgr, pkg) pairs sorted in dependency order. If state_cache
+    is provided, the managers are wrapped so that their is_installed() and
+    is_running() results are cached.
     """
     import library
     import install_plan
@@ -135,10 +172,13 @@ def get_mgrs_and_pkgs(file_layout, deployment_home, options,
         mgr = resource_manager_class(resource)
         import install_context
         mgr.install_context = install_context
+        if state_cache:
+            import state_cache as state_cache_mod
+            mgr = state_cache_mod.CachedStateManager(mgr, state_cache)
         return (mgr, package)
         
     with open(resource_file, "rb") as f:
-        resource_list_json = json.load(f)
+        resource_list_json = json_backend.load(f)
     rlist =  [parse_resource_from_json(resource_json) for
               resource_json in resource_list_json]
     return [get_manager_and_pkg(r) for r in install_plan.create_install_plan(rlist)]
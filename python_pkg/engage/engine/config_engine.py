@@ -8,6 +8,8 @@ import fixup_python_path
 
 import engage_utils.process as procutils
 import preprocess_resources
+import config_solution_cache
+import engage.utils.rdef as rdef
 from engage.utils.user_error import UserError, EngageErrInf, convert_exc_to_user_error, UserErrorParseExc, parse_user_error, AREA_CONFIG
 
 from engage.utils.log_setup import setup_engine_logger
@@ -17,9 +19,52 @@ def get_config_error_file(installer_file_layout):
     return os.path.join(os.path.dirname(
                           installer_file_layout.get_install_script_file()),
                             "config_error.json")
-    
 
-def run_config_engine(installer_file_layout, install_spec_file):
+def get_pruned_resource_file(installer_file_layout):
+    return os.path.join(os.path.dirname(
+                          installer_file_layout.get_preprocessed_resource_file()),
+                        "pruned_resource_definitions.json")
+
+
+def prune_resource_definitions(installer_file_layout, install_spec_file):
+    """The config engine only needs the resource definitions reachable from
+    the keys in the install spec (via inside, environment, and peer
+    constraints). We write those to a separate file and return its name. If
+    pruning fails for any reason, we return the full preprocessed resource
+    file and let the config engine report any problems.
+    """
+    ifl = installer_file_layout
+    resource_file = ifl.get_preprocessed_resource_file()
+    pruned_file = get_pruned_resource_file(ifl)
+    try:
+        with open(install_spec_file, "rb") as f:
+            spec = json.load(f)
+        keys = []
+        seen = set()
+        for inst in spec:
+            k = rdef.hash_key_for_res_key(inst["key"])
+            if k not in seen:
+                seen.add(k)
+                keys.append(inst["key"])
+        (kept, total) = rdef.prune_resource_file(resource_file, keys,
+                                                 pruned_file)
+    except Exception, e:
+        logger.warning("Unable to prune resource definitions, using all definitions: %s" % e)
+        return resource_file
+    logger.info("Pruned resource definitions to those reachable from install spec: kept %d of %d (%.0f%% pruned)" %
+                (kept, total,
+                 100.0*(total-kept)/total if total>0 else 0.0))
+    return pruned_file
+
+
+def run_config_engine(installer_file_layout, install_spec_file,
+                      use_solution_cache=True, prune_resources=True):
+    """Run the config engine to generate the install script. If
+    use_solution_cache is True, we first check the config solution cache
+    for a result from the same inputs. If prune_resources is True, the
+    config engine is only given the resource definitions reachable from
+    the install spec.
+    """
     ifl = installer_file_layout
     config_error_file = get_config_error_file(installer_file_layout)
     preprocess_resources.validate_install_spec(install_spec_file)
@@ -28,11 +73,22 @@ def run_config_engine(installer_file_layout, install_spec_file):
         logger.debug("moving old %s to %s before running config engine" %
                      (install_script_file, install_script_file + ".prev"))
         os.rename(install_script_file, install_script_file + ".prev")
+    if prune_resources:
+        resource_file = prune_resource_definitions(ifl, install_spec_file)
+    else:
+        resource_file = ifl.get_preprocessed_resource_file()
+    if use_solution_cache:
+        cache = config_solution_cache.ConfigSolutionCache(
+                    ifl.get_config_solution_cache_directory())
+        cache_key = config_solution_cache.compute_key(
+                        [resource_file, install_spec_file, ifl.get_configurator_exe()])
+        if cache.lookup(cache_key, install_script_file):
+            return
     # we run the config engine from the same directory as where we want
     # the install script file, as it write the file to the current
     # directory.
     rc = procutils.run_and_log_program([ifl.get_configurator_exe(),
-                                           ifl.get_preprocessed_resource_file(),
+                                           resource_file,
                                            install_spec_file], None, logger,
                                           cwd=os.path.dirname(install_script_file))
     if rc != 0:
@@ -51,15 +107,20 @@ def run_config_engine(installer_file_layout, install_spec_file):
         raise Exception("Configuration engine returned an error")
     if not os.path.exists(install_script_file):
         raise Exception("Configuration engine must have encountered a problem: install script %s was not generated" % install_script_file)
+    if use_solution_cache:
+        cache.store(cache_key, install_script_file)
 
 
-def preprocess_and_run_config_engine(installer_file_layout, install_spec_file):
+def preprocess_and_run_config_engine(installer_file_layout, install_spec_file,
+                                     use_solution_cache=True,
+                                     prune_resources=True):
     ifl = installer_file_layout
     preprocess_resources.preprocess_resource_file(
         ifl.get_resource_def_file(),
         ifl.get_extension_resource_files(),
         ifl.get_preprocessed_resource_file(),
-        logger)
-    run_config_engine(ifl, install_spec_file)
+        logger, incremental=True)
+    run_config_engine(ifl, install_spec_file, use_solution_cache,
+                      prune_resources)
     logger.info("Configuration successful.")
     
@@ -0,0 +1,128 @@
+"""Cache of configuration engine results. The config engine is a pure
+function of the preprocessed resource definitions, the install spec, and
+the configurator itself, so we key its results by a digest of those three
+files. On a hit, we write the cached install script instead of running the
+configurator.
+
+The cache is a directory (under the package cache, so that it is shared by
+all deployment homes) containing one <digest>.script file per entry and a
+stats.json file with the hit and miss counts. Entries are evicted in least
+recently used order (using the file modification time, which we update on
+each hit) when the total size exceeds a bound.
+"""
+
+import os
+import os.path
+import json
+import hashlib
+import tempfile
+import shutil
+
+import fixup_python_path
+from engage.utils.log_setup import setup_engine_logger
+
+logger = setup_engine_logger(__name__)
+
+DEFAULT_MAX_BYTES = 20*1024*1024
+ENTRY_SUFFIX = ".script"
+STATS_FILE = "stats.json"
+
+
+def compute_key(input_files):
+    """Return a digest of the contents of the input files. We include the
+    lengths, so that content cannot shift between files.
+    """
+    h = hashlib.sha256()
+    for filename in input_files:
+        with open(filename, "rb") as f:
+            data = f.read()
+        h.update("%d\n" % len(data))
+        h.update(data)
+    return h.hexdigest()
+
+
+class ConfigSolutionCache(object):
+    def __init__(self, cache_directory, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_directory = cache_directory
+        self.max_bytes = max_bytes
+
+    def _get_entry_file(self, key):
+        return os.path.join(self.cache_directory, key + ENTRY_SUFFIX)
+
+    def _update_stats(self, hit):
+        """Update and return the (hits, misses) counts. This is best effort:
+        concurrent runs may lose an update.
+        """
+        stats_file = os.path.join(self.cache_directory, STATS_FILE)
+        stats = {"hits":0, "misses":0}
+        try:
+            if not os.path.isdir(self.cache_directory):
+                os.makedirs(self.cache_directory)
+            if os.path.exists(stats_file):
+                with open(stats_file, "rb") as f:
+                    stats.update(json.load(f))
+            stats["hits" if hit else "misses"] += 1
+            with open(stats_file, "wb") as f:
+                json.dump(stats, f)
+        except (IOError, OSError, ValueError), e:
+            logger.debug("Unable to update config solution cache stats: %s" % e)
+        return (stats["hits"], stats["misses"])
+
+    def lookup(self, key, install_script_file):
+        """If there is an entry for the key, copy it to install_script_file
+        and return True. Otherwise, return False.
+        """
+        entry_file = self._get_entry_file(key)
+        if not os.path.exists(entry_file):
+            (hits, misses) = self._update_stats(False)
+            logger.info("Config solution cache miss (%d hits, %d misses)" %
+                        (hits, misses))
+            return False
+        try:
+            shutil.copyfile(entry_file, install_script_file)
+            os.utime(entry_file, None) # mark as recently used
+        except (IOError, OSError), e:
+            logger.warning("Unable to read config solution cache entry %s: %s" %
+                           (entry_file, e))
+            return False
+        (hits, misses) = self._update_stats(True)
+        logger.info("Config solution cache hit, using cached install script (%d hits, %d misses)" %
+                    (hits, misses))
+        return True
+
+    def store(self, key, install_script_file):
+        """Add the install script to the cache and evict old entries if we
+        are over the size bound. Errors are logged and otherwise ignored.
+        """
+        try:
+            if not os.path.isdir(self.cache_directory):
+                os.makedirs(self.cache_directory)
+            (fd, tmpname) = tempfile.mkstemp(dir=self.cache_directory,
+                                             prefix=".tmp-")
+            os.close(fd)
+            shutil.copyfile(install_script_file, tmpname)
+            os.rename(tmpname, self._get_entry_file(key))
+            self.evict()
+        except (IOError, OSError), e:
+            logger.warning("Unable to store config solution in cache %s: %s" %
+                           (self.cache_directory, e))
+
+    def evict(self):
+        """Remove the least recently used entries until the total size of the
+        cache is within the bound.
+        """
+        entries = []
+        total = 0
+        for name in os.listdir(self.cache_directory):
+            if not name.endswith(ENTRY_SUFFIX):
+                continue
+            path = os.path.join(self.cache_directory, name)
+            st = os.stat(path)
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+        entries.sort()
+        while total>self.max_bytes and len(entries)>1:
+            (mtime, size, path) = entries.pop(0)
+            logger.debug("Evicting config solution cache entry %s" % path)
+            os.remove(path)
+            total -= size
@@ -0,0 +1,148 @@
+"""Run a set of tasks with dependencies between them using a pool of worker
+threads. This is used by the install sequencer to install independent
+resources in parallel and by svcctl to start and stop services in parallel.
+
+We keep a ready queue of the tasks whose predecessors have all completed.
+Ready tasks are handed out in order of priority (highest first), if a
+priority map is provided, and then in the order of the task list. If a task
+fails, we stop handing out new work, wait for the in-flight tasks to
+complete, and then re-raise the first error.
+
+>>> import time
+>>> tasks = ["a", "b", "c", "d"]
+>>> predecessors = {"a":[], "b":["a"], "c":["a"], "d":["b", "c"]}
+>>> completed = []
+>>> def fn(task):
+...     time.sleep(0.01)
+...     return task.upper()
+>>> run_in_dependency_order(tasks, tasks, predecessors, fn, num_workers=2,
+...                         on_complete=lambda i, r: completed.append(tasks[i]))
+['A', 'B', 'C', 'D']
+>>> completed[0], sorted(completed[1:3]), completed[3]
+('a', ['b', 'c'], 'd')
+>>> def fail_b(task):
+...     if task=="b":
+...         raise Exception("b failed")
+...     return task
+>>> run_in_dependency_order(tasks, tasks, predecessors, fail_b, num_workers=2)
+Traceback (most recent call last):
+...
+Exception: b failed
+"""
+
+import sys
+import threading
+import Queue
+
+import fixup_python_path
+from engage.utils.log_setup import setup_engine_logger
+
+logger = setup_engine_logger(__name__)
+
+
+def _worker(fn, task_queue, result_queue):
+    while True:
+        item = task_queue.get()
+        if item==None:
+            return
+        (idx, task) = item
+        try:
+            result_queue.put((idx, fn(task), None))
+        except:
+            result_queue.put((idx, None, sys.exc_info()))
+
+
+def run_in_dependency_order(tasks, task_ids, predecessors, fn, num_workers=1,
+                            priorities=None, on_complete=None, on_error=None,
+                            thread_name="dag-worker"):
+    """Call fn on each task in tasks, which should be in a valid order for
+    running serially. task_ids is the list of ids of the tasks, and
+    predecessors is a map from each task id to the ids of the tasks whose
+    calls must complete first. Up to num_workers calls are run concurrently.
+    priorities is an optional map from task ids to numbers, used to choose
+    between ready tasks. on_complete(idx, result) and on_error(idx) are called
+    from the calling thread as each task completes or fails. Returns a list
+    of the results of fn, in the same order as tasks.
+    """
+    if num_workers<=1:
+        results = []
+        for (idx, task) in enumerate(tasks):
+            try:
+                results.append(fn(task))
+            except:
+                if on_error:
+                    on_error(idx)
+                raise
+            if on_complete:
+                on_complete(idx, results[idx])
+        return results
+    index = {}
+    waiting_on = {}
+    successors = {}
+    for (idx, task_id) in enumerate(task_ids):
+        index[task_id] = idx
+        waiting_on[task_id] = len(predecessors[task_id])
+        successors[task_id] = []
+    for task_id in task_ids:
+        for pred_id in predecessors[task_id]:
+            successors[pred_id].append(task_id)
+    ready = [index[task_id] for task_id in task_ids if waiting_on[task_id]==0]
+    if priorities:
+        def ready_order(idx):
+            return (-priorities.get(task_ids[idx], 0.0), idx)
+    else:
+        def ready_order(idx):
+            return idx
+    results = [None for task in tasks]
+
+    task_queue = Queue.Queue()
+    result_queue = Queue.Queue()
+    workers = []
+    for i in range(min(num_workers, len(tasks))):
+        t = threading.Thread(target=_worker,
+                             args=(fn, task_queue, result_queue),
+                             name="%s-%d" % (thread_name, i))
+        t.daemon = True
+        t.start()
+        workers.append(t)
+
+    in_flight = 0
+    first_error = None
+    try:
+        while True:
+            if first_error==None:
+                ready.sort(key=ready_order)
+                while len(ready)>0 and in_flight<len(workers):
+                    idx = ready.pop(0)
+                    logger.debug("Scheduling task %s" % task_ids[idx])
+                    task_queue.put((idx, tasks[idx]))
+                    in_flight += 1
+            if in_flight==0:
+                break
+            # use a timeout so that we remain interruptable from the console
+            while True:
+                try:
+                    (idx, result, exc_info) = result_queue.get(True, 1.0)
+                    break
+                except Queue.Empty:
+                    pass
+            in_flight -= 1
+            if exc_info!=None:
+                if on_error:
+                    on_error(idx)
+                if first_error==None:
+                    first_error = exc_info
+                continue
+            results[idx] = result
+            if on_complete:
+                on_complete(idx, result)
+            for succ_id in successors[task_ids[idx]]:
+                waiting_on[succ_id] -= 1
+                if waiting_on[succ_id]==0:
+                    ready.append(index[succ_id])
+    finally:
+        for t in workers:
+            task_queue.put(None)
+    if first_error!=None:
+        raise first_error[0], first_error[1], first_error[2]
+    return results
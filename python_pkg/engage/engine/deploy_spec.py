@@ -4,7 +4,6 @@ import os
 import sys
 import os.path
 from optparse import OptionParser
-import json
 
 # fix path if necessary (if running from source or running as test)
 import fixup_python_path
@@ -17,6 +16,7 @@ import install_engine
 from engage.utils.file import NamedTempFile
 import engage_utils.process as procutils
 import engage.utils.log_setup as log_setup
+import engage.utils.json_backend as json_backend
 from engage.utils.user_error import UserError, EngageErrInf, convert_exc_to_user_error, UserErrorParseExc, parse_user_error
 
 import gettext
@@ -104,15 +104,15 @@ class DeployRequest(object):
                                    if orig_spec_file.endswith('.json') \
                                    else orig_spec_file + '.merged'
             with open(orig_spec_file, 'rb') as f:
-                install_spec_resources = json.load(f)
+                install_spec_resources = json_backend.load(f)
             irf = self.efl.get_installed_resources_file(self.deployment_home)
             with open(irf, 'rb') as f:
-                installed_resources = json.load(f)
+                installed_resources = json_backend.load(f)
             merged_spec = merge_new_install_spec_into_existing(install_spec_resources,
                                                                installed_resources,
                                                                logger)
             with open(self.input_spec_file, 'wb') as f:
-                json.dump(merged_spec, f)
+                json_backend.dump(merged_spec, f)
             # Rename the old installed resource file so we don't lose it if
             # things fail.
             os.rename(irf, irf + '.prev') 
@@ -0,0 +1,149 @@
+"""Registry of the drivers for new-style resources. Without the registry, we
+find the driver for a resource key by trying to import each of the candidate
+module names from convert_resource_key_to_driver_module_names() until one
+succeeds, and then import the driver just to find its packages.json file.
+Each miss is a failed search of the import path.
+
+When the resource definitions are preprocessed, we generate the registry
+alongside the preprocessed file (as driver_registry.json). For each resource
+key, it records the driver module name, the path of the driver's
+packages.json file, and the contents of that file. The registry is loaded
+by parse_library_files() with one file read. Keys not in the registry (e.g.
+for drivers added since the last preprocessing) fall back to searching for
+the driver module.
+"""
+
+import os
+import os.path
+
+import fixup_python_path
+from engage.utils.file import mangle_resource_key
+from engage.extensions import installed_extensions
+import engage.utils.json_backend as json_backend
+from engage.utils.log_setup import setup_engine_logger
+
+logger = setup_engine_logger(__name__)
+
+REGISTRY_FILE_NAME = "driver_registry.json"
+REGISTRY_VERSION = 1
+
+DRIVERS_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                           "../drivers"))
+
+# the currently loaded registry: a map from mangled resource key to entry
+_registry = None
+
+
+def get_registry_file(preprocessed_resource_file):
+    """The registry is stored in the same directory as the preprocessed
+    resource definitions.
+    """
+    return os.path.join(os.path.dirname(preprocessed_resource_file),
+                        REGISTRY_FILE_NAME)
+
+
+def _find_driver(mangled_key, drivers_dir):
+    """Find the driver module for a key in the filesystem, checking the
+    same locations (in the same order) as
+    convert_resource_key_to_driver_module_names(). Returns (module name,
+    driver directory) or (None, None) if there is no driver.
+    """
+    for submodule in (["standard",] + installed_extensions):
+        driver_dir = os.path.join(drivers_dir, submodule, mangled_key)
+        if os.path.exists(os.path.join(driver_dir, "driver.py")) or \
+           os.path.exists(os.path.join(driver_dir, "driver.pyc")):
+            return ("engage.drivers.%s.%s.driver" % (submodule, mangled_key),
+                    driver_dir)
+    return (None, None)
+
+
+def build_registry(resource_keys, drivers_dir=DRIVERS_DIR):
+    """Return a registry (in json form) for the specified resource keys.
+    Keys without a driver are omitted.
+    """
+    drivers = {}
+    for key in resource_keys:
+        mangled_key = mangle_resource_key(key)
+        if drivers.has_key(mangled_key):
+            continue
+        (module_name, driver_dir) = _find_driver(mangled_key, drivers_dir)
+        if module_name==None:
+            continue
+        entry = {u"key":key, u"module":module_name, u"packages_file":None,
+                 u"packages_mtime":None, u"packages":None}
+        packages_file = os.path.join(driver_dir, "packages.json")
+        if os.path.exists(packages_file):
+            with open(packages_file, "rb") as pf:
+                entry[u"packages"] = json_backend.load(pf)
+            entry[u"packages_file"] = packages_file
+            entry[u"packages_mtime"] = os.path.getmtime(packages_file)
+        drivers[mangled_key] = entry
+    return {u"version":REGISTRY_VERSION, u"drivers":drivers}
+
+
+def write_registry(resource_keys, registry_file, drivers_dir=DRIVERS_DIR):
+    registry = build_registry(resource_keys, drivers_dir)
+    with open(registry_file, "wb") as f:
+        json_backend.dump(registry, f, compact=True)
+    logger.debug("Wrote driver registry with %d entries to %s" %
+                 (len(registry[u"drivers"]), registry_file))
+
+
+def load_registry(registry_file):
+    """Load the registry file, replacing any previously loaded registry.
+    If the file is missing or unreadable, we clear the registry, so all
+    lookups fall back to searching for drivers.
+    """
+    global _registry
+    _registry = None
+    if not os.path.exists(registry_file):
+        logger.debug("No driver registry at %s" % registry_file)
+        return
+    try:
+        with open(registry_file, "rb") as f:
+            registry = json_backend.load(f)
+        if registry.get(u"version")!=REGISTRY_VERSION:
+            logger.warning("Ignoring driver registry %s: unsupported version %s" %
+                           (registry_file, registry.get(u"version")))
+            return
+        _registry = registry[u"drivers"]
+    except (ValueError, KeyError, IOError), e:
+        logger.warning("Unable to read driver registry %s, ignoring: %s" %
+                       (registry_file, e))
+
+
+def get_driver_module_name(key):
+    """Return the driver module name for the resource key, or None if the key
+    is not in the registry.
+    """
+    if _registry==None:
+        return None
+    entry = _registry.get(mangle_resource_key(key), None)
+    if entry==None:
+        return None
+    return entry[u"module"]
+
+
+def get_packages(key):
+    """Return (driver module name, packages file, package list json) for the
+    resource key, or None if the key is not in the registry or has no
+    packages.json file. If the packages file has changed since the registry
+    was generated, we re-read it.
+    """
+    if _registry==None:
+        return None
+    entry = _registry.get(mangle_resource_key(key), None)
+    if entry==None or entry[u"packages_file"]==None:
+        return None
+    packages_file = entry[u"packages_file"]
+    try:
+        mtime = os.path.getmtime(packages_file)
+    except OSError:
+        return None
+    if mtime!=entry[u"packages_mtime"]:
+        logger.debug("Packages file %s changed since driver registry was generated, rereading" %
+                     packages_file)
+        with open(packages_file, "rb") as pf:
+            entry[u"packages"] = json_backend.load(pf)
+        entry[u"packages_mtime"] = mtime
+    return (entry[u"module"], packages_file, entry[u"packages"])
@@ -180,6 +180,33 @@ class BaseFileLayout(object):
         """
         return os.path.join(deployment_home_directory, "config/installed_resources.json")
 
+    def get_install_costs_file(self, deployment_home_directory):
+        """The install engine records how long each resource took to install,
+        for use in planning future installs. Like get_installed_resources_file(),
+        we need the deployment home.
+        """
+        return os.path.join(deployment_home_directory, "config/install_costs.json")
+
+    def get_install_journal_file(self, deployment_home_directory):
+        """The install engine journals each completed resource, so that a
+        failed install can be resumed. Like get_installed_resources_file(),
+        we need the deployment home.
+        """
+        return os.path.join(deployment_home_directory, "config/install_journal.log")
+
+    def get_state_cache_file(self, deployment_home_directory):
+        """Management tools cache the results of the is_installed() and
+        is_running() checks for resources here (see state_cache.py).
+        """
+        return os.path.join(deployment_home_directory, "config/state_cache.json")
+
+    def get_config_solution_cache_directory(self):
+        """Results of the config engine are cached here (see
+        config_solution_cache.py). This is under the package cache, so that
+        it is shared across deployment homes.
+        """
+        return os.path.join(self.get_cache_directory(), ".config_solutions")
+
     def get_config_choices_file(self, deployment_home_directory):
         """The interactive installer will write the users config choices to a file,
         for use in future upgrades. Like get_installed_resources_file(), we need
@@ -0,0 +1,166 @@
+"""Content-addressed cache of extracted archives. Decompressing large archive
+packages is often the dominant cost when installing many instances of an
+application on one host. The first extraction of an archive goes into the
+cache, in a directory named for the sha256 digest of the archive file. Later
+extractions of the same archive (from any deployment home using the same
+package cache) are served by copying the cached tree.
+
+The cache lives in the .extracted subdirectory of the package cache. Each
+entry is a directory containing:
+  tree/       - the extracted contents of the archive
+  info.json   - results of validating the archive's file names
+
+The copy mode is set via the extraction_cache property in the
+package_properties of the resource library:
+  copy     - copy the tree (the default). On Linux, we use cp --reflink=auto,
+             which shares the file data on filesystems that support it
+             (e.g. btrfs and xfs).
+  hardlink - hard link the files of the tree. This is the fastest, but
+             the installed files share inodes with the cache, so it should
+             only be used if the installed files are never modified in place.
+  off      - do not use the cache.
+"""
+
+import os
+import os.path
+import sys
+import json
+import errno
+import shutil
+import hashlib
+import tempfile
+import subprocess
+
+from engage.utils.log_setup import setup_engine_logger
+
+logger = None
+def get_logger():
+    global logger
+    if logger == None:
+        logger = setup_engine_logger(__name__)
+    return logger
+
+COPY_MODE = "copy"
+HARDLINK_MODE = "hardlink"
+OFF_MODE = "off"
+VALID_MODES = [COPY_MODE, HARDLINK_MODE, OFF_MODE]
+
+CACHE_SUBDIR = ".extracted"
+INFO_FILE = "info.json"
+TREE_SUBDIR = "tree"
+
+# map from (path, size, mtime) to digest, so that we only hash an archive
+# once per process.
+_digest_memo = {}
+
+
+def get_archive_digest(filepath):
+    st = os.stat(filepath)
+    memo_key = (os.path.abspath(filepath), st.st_size, st.st_mtime)
+    if _digest_memo.has_key(memo_key):
+        return _digest_memo[memo_key]
+    h = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        while True:
+            data = f.read(1024*1024)
+            if not data:
+                break
+            h.update(data)
+    digest = h.hexdigest()
+    _digest_memo[memo_key] = digest
+    return digest
+
+
+def _link_or_copy_tree(src, dest, hardlink):
+    """Recreate the tree rooted at src under dest (which may already exist),
+    either hard linking or copying the files.
+    """
+    if not os.path.isdir(dest):
+        os.makedirs(dest)
+    for name in os.listdir(src):
+        src_path = os.path.join(src, name)
+        dest_path = os.path.join(dest, name)
+        if os.path.islink(src_path):
+            if os.path.lexists(dest_path):
+                os.remove(dest_path)
+            os.symlink(os.readlink(src_path), dest_path)
+        elif os.path.isdir(src_path):
+            _link_or_copy_tree(src_path, dest_path, hardlink)
+        else:
+            if os.path.lexists(dest_path):
+                os.remove(dest_path)
+            if hardlink:
+                os.link(src_path, dest_path)
+            else:
+                shutil.copy2(src_path, dest_path)
+    shutil.copystat(src, dest)
+
+
+def copy_tree(src, dest, mode=COPY_MODE):
+    """Copy (or hard link) the tree at src to dest, merging with the
+    contents of dest if it already exists.
+    """
+    if mode==HARDLINK_MODE:
+        _link_or_copy_tree(src, dest, True)
+        return
+    if sys.platform.startswith("linux"):
+        if not os.path.isdir(dest):
+            os.makedirs(dest)
+        try:
+            subprocess.check_call(["cp", "-a", "--reflink=auto",
+                                   os.path.join(src, "."), dest])
+            return
+        except (OSError, subprocess.CalledProcessError), e:
+            get_logger().debug("cp --reflink failed, falling back to copying in python: %s" % e)
+    _link_or_copy_tree(src, dest, False)
+
+
+class ExtractionCache(object):
+    def __init__(self, cache_root, mode=COPY_MODE):
+        assert mode in VALID_MODES, "Invalid extraction cache mode %s" % mode
+        self.cache_root = cache_root
+        self.mode = mode
+
+    def _get_entry_dir(self, digest):
+        return os.path.join(self.cache_root, digest)
+
+    def get_or_create(self, archive_file, extract_fn):
+        """Return (tree_dir, info) for the archive, extracting it into the
+        cache if needed. extract_fn is called as extract_fn(tree_dir) and
+        should extract the archive and return a json-serializable info
+        value. Entries are created in a temporary directory and renamed into
+        place, so concurrent extractions of the same archive are safe.
+        """
+        digest = get_archive_digest(archive_file)
+        entry_dir = self._get_entry_dir(digest)
+        info_file = os.path.join(entry_dir, INFO_FILE)
+        if os.path.exists(info_file):
+            get_logger().debug("Extraction cache hit for %s (%s)" %
+                               (archive_file, digest))
+            with open(info_file, "rb") as f:
+                return (os.path.join(entry_dir, TREE_SUBDIR), json.load(f))
+        if not os.path.isdir(self.cache_root):
+            os.makedirs(self.cache_root)
+        tmp_dir = tempfile.mkdtemp(prefix=".tmp-" + digest,
+                                   dir=self.cache_root)
+        try:
+            info = extract_fn(os.path.join(tmp_dir, TREE_SUBDIR))
+            with open(os.path.join(tmp_dir, INFO_FILE), "wb") as f:
+                json.dump(info, f)
+            try:
+                os.rename(tmp_dir, entry_dir)
+            except OSError, e:
+                if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                    raise
+                # another process created the entry first, use that one
+                get_logger().debug("Extraction cache entry %s created concurrently" %
+                                   digest)
+                with open(info_file, "rb") as f:
+                    info = json.load(f)
+        finally:
+            if os.path.exists(tmp_dir):
+                shutil.rmtree(tmp_dir)
+        return (os.path.join(entry_dir, TREE_SUBDIR), info)
+
+    def copy_tree(self, src, dest):
+        copy_tree(src, dest, self.mode)
@@ -20,6 +20,10 @@ engage_file_layout = None
 # additional packages (e.g. patches) during the install
 package_library = None
 
+# if True, pip packages are only installed from the local wheelhouse, without
+# accessing the network (see engage.drivers.genforma.pip)
+pip_offline = False
+
 
 
 def setup_context(engage_file_layout_, subprocess_mode, package_library_, pw_database):
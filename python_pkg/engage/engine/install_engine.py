@@ -98,6 +98,7 @@ class InstallEngine(object):
     def _run_worker(self, multi_node=False):
         import install_plan
         import install_sequencer
+        import install_journal
         import install_context as ctx
         efl = self.engage_file_layout
         install_script_file = efl.get_install_script_file()
@@ -122,6 +123,7 @@ class InstallEngine(object):
             # object
             self.pw_database = pw_repository.PasswordRepository("")
         ctx.setup_context(efl, self.options.subproc, library, self.pw_database)
+        ctx.pip_offline = self.options.pip_offline
         if self.options.dry_run:
             self.logger.info("Dry run complete.")
             return
@@ -131,6 +133,11 @@ class InstallEngine(object):
         ##                       efl.get_password_salt_file()))
         ##     return
 
+        # the install will change the state of resources, so we remove any
+        # cached state
+        import state_cache
+        state_cache.remove_cache_file(efl.get_state_cache_file(self.deployment_home))
+
         if multi_node:
             install_sequencer.run_multi_node_install(install_plan.create_multi_node_install_plan(resource_list),
                                                      library,
@@ -138,9 +145,52 @@ class InstallEngine(object):
             # TODO: need to consider whether we need to make any calls to the management API
             # for the master node in multi-node. Is there a way to register cross-node dependencies?
         else: # single node or slave
+            costs_file = efl.get_install_costs_file(self.deployment_home)
+            costs = install_plan.load_install_costs(costs_file)
+            if self.options.parallel>1:
+                # with parallel workers, start the longest chains of
+                # dependent resources first
+                cost_plan = install_plan.create_critical_path_plan(resource_list, costs)
+                plan = cost_plan.resources
+                priorities = cost_plan.priority
+                self.logger.info("Predicted install time is %.1f seconds with %d workers." %
+                                 (cost_plan.predict_makespan(self.options.parallel),
+                                  self.options.parallel))
+            else:
+                plan = install_plan.create_install_plan(resource_list)
+                priorities = None
             mgr_pkg_list = [install_sequencer.get_manager_and_package(instance_md, library)
-                            for instance_md in install_plan.create_install_plan(resource_list)]
-            install_sequencer.run_install(mgr_pkg_list, library, self.options.force_stop_on_error)
+                            for instance_md in plan]
+            journal = install_journal.InstallJournal(efl.get_install_journal_file(self.deployment_home))
+            if self.options.resume:
+                cnt = journal.load()
+                self.logger.info("Resuming install: %d resource(s) completed by previous install." % cnt)
+            else:
+                journal.start_new_install()
+            prefetcher = None
+            if self.options.prefetch_workers>0:
+                import package_prefetch
+                prefetcher = package_prefetch.PackagePrefetcher(mgr_pkg_list,
+                                                                efl.get_cache_directory(),
+                                                                self.options.prefetch_workers)
+                prefetcher.start()
+            batcher = None
+            if self.options.batch_packages:
+                import package_batch
+                batcher = package_batch.PackageBatcher(mgr_pkg_list)
+            install_times = {}
+            try:
+                install_sequencer.run_install(mgr_pkg_list, library, self.options.force_stop_on_error,
+                                              num_workers=self.options.parallel,
+                                              priorities=priorities,
+                                              install_times=install_times,
+                                              journal=journal,
+                                              prefetcher=prefetcher,
+                                              batcher=batcher)
+            finally:
+                if len(install_times)>0:
+                    install_plan.update_install_costs(costs, resource_list, install_times)
+                    install_plan.save_install_costs(costs_file, costs)
             if self.options.mgt_backends:
                 import mgt_registration
                 mgt_registration.register_with_mgt_backends(self.options.mgt_backends,
@@ -0,0 +1,118 @@
+"""Write-ahead journal of completed resource installs. The install sequencer
+appends a record to the journal as each resource completes, flushing and
+fsync'ing the file so that the record survives a crash. If an install fails
+part way through, it can then be rerun with --resume: resources recorded in
+the journal are skipped without calling their is_installed() checks, as long
+as their metadata is unchanged.
+
+The journal is a text file with one JSON object per line. We append a
+"start" record when a new (non-resumed) install begins, and a "completed"
+record for each resource, including a fingerprint of the resource's
+metadata.
+"""
+
+import os
+import os.path
+import json
+import hashlib
+import time
+import threading
+
+import fixup_python_path
+from engage.utils.log_setup import setup_engine_logger
+
+logger = setup_engine_logger(__name__)
+
+
+def get_fingerprint(resource_md):
+    """Return a fingerprint of the resource metadata. We exclude the installed
+    property, which is changed by the install itself.
+
+    >>> import engage.drivers.resource_metadata as resource_metadata
+    >>> r1 = resource_metadata.ResourceMD("r1", {"name":"r1_type", "version":"1"},
+    ...                                   properties={"x":1})
+    >>> f1 = get_fingerprint(r1)
+    >>> r1.set_installed()
+    >>> get_fingerprint(r1)==f1
+    True
+    >>> r1.properties["x"] = 2
+    >>> get_fingerprint(r1)==f1
+    False
+    """
+    resource_json = resource_md.to_json()
+    properties = resource_json[u"properties"].copy()
+    if properties.has_key(u"installed"):
+        del properties[u"installed"]
+    resource_json[u"properties"] = properties
+    return hashlib.sha1(json.dumps(resource_json, sort_keys=True)).hexdigest()
+
+
+class InstallJournal(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.completed = {} # map from resource id to fingerprint
+        self.lock = threading.Lock()
+
+    def _append(self, record):
+        with self.lock:
+            f = open(self.filename, "ab")
+            try:
+                f.write(json.dumps(record, sort_keys=True) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            finally:
+                f.close()
+
+    def start_new_install(self):
+        """Start a fresh journal, forgetting any previous install.
+        """
+        self.completed = {}
+        with self.lock:
+            f = open(self.filename, "wb")
+            f.close()
+        self._append({"event":"start", "time":time.time()})
+
+    def load(self):
+        """Read the records of completed resources from a previous
+        install. A missing journal is treated as empty. If the last line was
+        only partially written (e.g. due to a crash), we ignore it.
+        Returns the number of completed resources found.
+        """
+        self.completed = {}
+        if not os.path.exists(self.filename):
+            logger.info("No install journal found at %s, starting from the beginning" %
+                        self.filename)
+            return 0
+        with open(self.filename, "rb") as f:
+            for (lineno, line) in enumerate(f):
+                line = line.strip()
+                if line=="":
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logger.warning("Ignoring unreadable line %d in install journal %s" %
+                                   (lineno+1, self.filename))
+                    continue
+                if record.get("event")=="completed":
+                    self.completed[record["id"]] = record["fingerprint"]
+        return len(self.completed)
+
+    def is_completed(self, resource_md):
+        """Return True if the resource was completed by a previous install
+        and its metadata has not changed since.
+        """
+        if not self.completed.has_key(resource_md.id):
+            return False
+        elif self.completed[resource_md.id]!=get_fingerprint(resource_md):
+            logger.info("Metadata for resource %s has changed since it was journaled, will not skip it" %
+                        resource_md.id)
+            return False
+        else:
+            return True
+
+    def record_completed(self, resource_md):
+        fingerprint = get_fingerprint(resource_md)
+        self._append({"event":"completed", "id":resource_md.id,
+                      "fingerprint":fingerprint, "time":time.time()})
+        self.completed[resource_md.id] = fingerprint
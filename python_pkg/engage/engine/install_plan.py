@@ -3,12 +3,18 @@ solution. The plan is just a list of resource instances, sorted by
 dependency order. Thus, if resource r1 appears in the plan before r2, then
 r1 has no dependencies for r2. Note that this is an over-specification of the
 plan - one could instead return a a list of sets, where each resource in a
-set can be installed in parallel. This could be accomodated pretty easily,
-but we'll keep things simple for now.
+set can be installed in parallel. Rather than grouping the resources this
+way, get_resource_dependencies() returns the underlying dependency map,
+which the install sequencer uses to start each resource as soon as its own
+dependencies have completed. create_critical_path_plan() uses recorded
+install times to order the plan so that the longest chain of dependent
+resources is started first.
 """
 
 import sys
 import os.path
+import json
+import heapq
 
 # fix path if necessary (if running from source or running as test)
 import fixup_python_path
@@ -203,6 +209,289 @@ def create_install_plan(resource_list):
     return result_list
 
 
+# Estimated install time, in seconds, for a resource which has no recorded
+# install history.
+DEFAULT_INSTALL_COST = 10.0
+
+# When updating the recorded cost of a resource, we average over at most this
+# many samples, so that the estimate tracks changes in the package.
+MAX_COST_SAMPLES = 10
+
+def get_cost_key(resource_key):
+    """Return the key used to store install costs for a resource key. We
+    track costs by resource type rather than resource id, so that history
+    can be shared across install specs.
+    """
+    return "%s %s" % (resource_key["name"], resource_key.get("version", "*"))
+
+
+def load_install_costs(filename):
+    """Read the map of recorded install costs from filename. Each entry maps
+    a cost key (see get_cost_key()) to a dict with "average" (seconds) and
+    "samples" properties. If the file does not exist or cannot be parsed,
+    we return an empty map - the costs are only used to order the install,
+    so they should never cause an install to fail.
+    """
+    if not os.path.exists(filename):
+        return {}
+    try:
+        with open(filename, "rb") as f:
+            costs = json.load(f)
+        if not isinstance(costs, dict):
+            raise ValueError("Expecting a JSON object")
+        return costs
+    except Exception, e:
+        logger.warning("Unable to read install costs file %s: %s" %
+                       (filename, e))
+        return {}
+
+
+def save_install_costs(filename, costs):
+    """Write the costs map to filename. Like load_install_costs(), we just
+    log a warning if there is a problem.
+    """
+    try:
+        f = open(filename, "wb")
+        json.dump(costs, f, sort_keys=True, indent=2)
+        f.close()
+    except IOError, e:
+        logger.warning("Unable to write install costs file %s: %s" %
+                       (filename, e))
+
+
+def update_install_costs(costs, resource_list, install_times):
+    """Update the costs map with the durations in install_times, which maps
+    resource ids to the number of seconds their install took. Resources
+    not in install_times (e.g. ones that were already installed) are left
+    unchanged.
+
+    >>> import engage.drivers.resource_metadata as resource_metadata
+    >>> r1 = resource_metadata.ResourceMD("r1", {"name":"r1_type", "version":"1.0"})
+    >>> costs = {}
+    >>> update_install_costs(costs, [r1], {"r1":30.0})
+    >>> update_install_costs(costs, [r1], {"r1":60.0})
+    >>> costs
+    {'r1_type 1.0': {'average': 45.0, 'samples': 2}}
+    """
+    for resource in resource_list:
+        if not install_times.has_key(resource.id):
+            continue
+        cost_key = get_cost_key(resource.key)
+        elapsed = float(install_times[resource.id])
+        if costs.has_key(cost_key):
+            entry = costs[cost_key]
+            samples = min(entry["samples"] + 1, MAX_COST_SAMPLES)
+            entry["average"] = entry["average"] + \
+                               (elapsed - entry["average"])/samples
+            entry["samples"] = samples
+        else:
+            costs[cost_key] = {"average":elapsed, "samples":1}
+
+
+class CostedInstallPlan(object):
+    """An install plan annotated with estimated install costs. Attributes:
+     resources      - the resources in install order (a valid topological
+                      order, where ties are broken in favor of the resource
+                      with the longest remaining path)
+     dependencies   - map from resource id to the ids it depends on
+     cost           - map from resource id to its estimated install time
+     has_history    - set of resource ids whose cost came from recorded
+                      installs rather than DEFAULT_INSTALL_COST
+     priority       - map from resource id to the length of the longest
+                      (most expensive) path from that resource to the end of
+                      the install, including the resource's own cost
+     critical_path  - list of resource ids on the longest path
+    """
+    def __init__(self, resources, dependencies, cost, has_history, priority,
+                 critical_path):
+        self.resources = resources
+        self.dependencies = dependencies
+        self.cost = cost
+        self.has_history = has_history
+        self.priority = priority
+        self.critical_path = critical_path
+
+    def get_critical_path_length(self):
+        return sum([self.cost[r_id] for r_id in self.critical_path])
+
+    def get_serial_length(self):
+        return sum(self.cost.values())
+
+    def predict_makespan(self, num_workers=1):
+        """Simulate a list-scheduled install with num_workers workers, where
+        each worker picks the ready resource with the highest priority.
+        Returns the predicted elapsed time for the install.
+        """
+        waiting_on = {}
+        dependents = {}
+        for r in self.resources:
+            waiting_on[r.id] = len(self.dependencies[r.id])
+            dependents[r.id] = []
+        for r in self.resources:
+            for dep_id in self.dependencies[r.id]:
+                dependents[dep_id].append(r.id)
+        ready = [r.id for r in self.resources if waiting_on[r.id]==0]
+        running = [] # heap of (finish time, resource id)
+        now = 0.0
+        while len(ready)>0 or len(running)>0:
+            ready.sort(key=lambda r_id: (-self.priority[r_id], r_id))
+            while len(ready)>0 and len(running)<num_workers:
+                r_id = ready.pop(0)
+                heapq.heappush(running, (now + self.cost[r_id], r_id))
+            (now, r_id) = heapq.heappop(running)
+            for dep_id in dependents[r_id]:
+                waiting_on[dep_id] -= 1
+                if waiting_on[dep_id]==0:
+                    ready.append(dep_id)
+        return now
+
+    def explain(self, num_workers=1):
+        """Return a list of lines describing the plan, its estimated costs,
+        and the predicted makespan.
+        """
+        lines = ["Install plan for %d resources, assuming %d worker(s):" %
+                 (len(self.resources), num_workers),
+                 "  Predicted makespan:   %8.1fs" % self.predict_makespan(num_workers),
+                 "  Critical path length: %8.1fs" % self.get_critical_path_length(),
+                 "  Serial install time:  %8.1fs" % self.get_serial_length(),
+                 "",
+                 "  %-4s %-30s %9s %9s  %s" % ("#", "Resource", "Estimate", "Path", "Key")]
+        critical = set(self.critical_path)
+        for (i, r) in enumerate(self.resources):
+            if r.id in self.has_history:
+                estimate = "%8.1fs" % self.cost[r.id]
+            else:
+                estimate = "%8.1f?" % self.cost[r.id]
+            lines.append("%s %-4d %-30s %9s %8.1fs  %s" %
+                         ("*" if r.id in critical else " ", i+1, r.id,
+                          estimate, self.priority[r.id], get_cost_key(r.key)))
+        lines.append("")
+        lines.append("  * = on the critical path, ? = no install history (using default estimate)")
+        return lines
+
+
+def create_critical_path_plan(resource_list, costs,
+                              default_cost=DEFAULT_INSTALL_COST):
+    """Given a resource list representing an install solution and a map of
+    recorded install costs (see load_install_costs()), return a
+    CostedInstallPlan. The resources are ordered using Kahn's algorithm,
+    but when several resources are ready, we take the one with the longest
+    remaining path first. If the plan is run with parallel workers, this
+    gets the slow resources on the critical path started as early as
+    possible.
+
+    >>> import engage.drivers.resource_metadata as resource_metadata
+    >>> # r1 is the machine, r2 and r3 are independent and inside r1, and
+    >>> # r4 depends on r3. r3 is fast, but leads to the slow r4, so it
+    >>> # should be scheduled before r2.
+    >>> r1_key = {"name":"r1_type", "version":"1"}
+    >>> r1 = resource_metadata.ResourceMD("r1", r1_key)
+    >>> r2 = resource_metadata.ResourceMD("r2", {"name":"r2_type", "version":"1"},
+    ...        inside=resource_metadata.ResourceRef("r1", r1_key))
+    >>> r3_key = {"name":"r3_type", "version":"1"}
+    >>> r3 = resource_metadata.ResourceMD("r3", r3_key,
+    ...        inside=resource_metadata.ResourceRef("r1", r1_key))
+    >>> r4 = resource_metadata.ResourceMD("r4", {"name":"r4_type", "version":"1"},
+    ...        inside=resource_metadata.ResourceRef("r1", r1_key),
+    ...        peers=[resource_metadata.ResourceRef("r3", r3_key)])
+    >>> costs = {"r1_type 1":{"average":1.0, "samples":1},
+    ...          "r2_type 1":{"average":50.0, "samples":1},
+    ...          "r3_type 1":{"average":5.0, "samples":1},
+    ...          "r4_type 1":{"average":100.0, "samples":1}}
+    >>> plan = create_critical_path_plan([r1, r2, r3, r4], costs)
+    >>> [r.id for r in plan.resources]
+    ['r1', 'r3', 'r4', 'r2']
+    >>> plan.critical_path
+    ['r1', 'r3', 'r4']
+    >>> plan.predict_makespan(1)
+    156.0
+    >>> plan.predict_makespan(2)
+    106.0
+    >>> # resources without any history get the default cost
+    >>> plan = create_critical_path_plan([r1, r2, r3, r4], {})
+    >>> [r.id for r in plan.resources]
+    ['r1', 'r3', 'r2', 'r4']
+    >>> plan.predict_makespan(4)
+    30.0
+    """
+    graph = _DepGraph()
+    for resource in resource_list:
+        graph.create_node(resource)
+    graph.add_all_dependencies()
+    if graph.is_start_set_empty():
+        raise InstallPlanError, "Install solution contains cycles: all resources have dependencies"
+
+    cost = {}
+    has_history = set()
+    dependencies = {}
+    for node in graph.all_nodes():
+        r_id = node.resource.id
+        cost_key = get_cost_key(node.resource.key)
+        if costs.has_key(cost_key):
+            cost[r_id] = float(costs[cost_key]["average"])
+            has_history.add(r_id)
+        else:
+            cost[r_id] = float(default_cost)
+        dependencies[r_id] = sorted(node.depends_on_set)
+
+    # Order the resources by Kahn's algorithm. We compute the priorities
+    # in reverse topological order afterward, so we take nodes in id order
+    # here.
+    topo_order = []
+    ready = sorted(graph.starting_nodes)
+    while len(ready)>0:
+        node = graph.get_node(ready.pop(0))
+        topo_order.append(node.resource.id)
+        for dep_node_id in sorted(node.dependent_set):
+            dep_node = graph.get_node(dep_node_id)
+            node.remove_dependency(dep_node)
+            if len(dep_node.depends_on_set)==0:
+                ready.append(dep_node_id)
+    if graph.total_links > 0:
+        raise InstallPlanError, "Install solution contains a cycle"
+
+    dependents = {}
+    for r_id in topo_order:
+        dependents[r_id] = []
+    for r_id in topo_order:
+        for dep_id in dependencies[r_id]:
+            dependents[dep_id].append(r_id)
+    priority = {}
+    for r_id in reversed(topo_order):
+        longest_tail = 0.0
+        for dep_id in dependents[r_id]:
+            longest_tail = max(longest_tail, priority[dep_id])
+        priority[r_id] = cost[r_id] + longest_tail
+
+    def by_priority(r_id):
+        return (-priority[r_id], r_id)
+
+    # Now, rerun Kahn's algorithm, this time taking the ready resource with
+    # the longest remaining path first.
+    resources = []
+    waiting_on = {}
+    for r_id in topo_order:
+        waiting_on[r_id] = len(dependencies[r_id])
+    ready = [r_id for r_id in topo_order if waiting_on[r_id]==0]
+    while len(ready)>0:
+        ready.sort(key=by_priority)
+        r_id = ready.pop(0)
+        resources.append(graph.get_node(r_id).resource)
+        for dep_id in dependents[r_id]:
+            waiting_on[dep_id] -= 1
+            if waiting_on[dep_id]==0:
+                ready.append(dep_id)
+
+    critical_path = []
+    candidates = [r_id for r_id in topo_order if len(dependencies[r_id])==0]
+    while len(candidates)>0:
+        r_id = sorted(candidates, key=by_priority)[0]
+        critical_path.append(r_id)
+        candidates = dependents[r_id]
+    return CostedInstallPlan(resources, dependencies, cost, has_history,
+                             priority, critical_path)
+
+
 def create_multi_node_install_plan(resource_list):
     """Install plan for multiple machines
     """
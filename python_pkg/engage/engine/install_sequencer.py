@@ -6,10 +6,12 @@ import os
 import os.path
 import sys
 import json
+import time
 
 import fixup_python_path
 
 from engage.utils.log_setup import setup_engine_logger
+import engage.utils.trace as tracing
 import install_context
 import engage_utils.process
 
@@ -86,38 +88,156 @@ def get_install_target_mgr(mgr_pkg_list):
                     developer_msg="Exactly one resource instance must have the property use_as_install_target set. This is usually the resource corresponding to the physical machine.")
 
 
-def run_install(mgr_pkg_list, library, force_stop_on_error=False):
+def _install_resource(mgr, pkg, journal=None, prefetcher=None, batcher=None):
+    """Install (if needed) and start (if a service) a single resource.
+    The resource's dependencies must already be installed and running.
+    Returns the number of seconds taken by the install if the resource was
+    actually installed, or None if it was already present.
+
+    If a journal is provided, resources it records as completed are not
+    checked with is_installed(), and newly completed resources are added to it.
+    If a prefetcher (package_prefetch.PackagePrefetcher) is provided, we wait
+    for any download of the resource's package before installing it.
+    If a batcher (package_batch.PackageBatcher) is provided, resources
+    which are system packages are installed through it.
+    """
+    with tracing.span(mgr.id, "resource", key=mgr.package_name):
+        return _install_resource_worker(mgr, pkg, journal, prefetcher, batcher)
+
+
+def _install_resource_worker(mgr, pkg, journal, prefetcher, batcher):
+    get_logger().info("Processing resource '%s'." % mgr.id)
+    elapsed = None
+    journaled = journal!=None and journal.is_completed(mgr.metadata)
+    if journaled:
+        # We still check that services are running below, as they may have
+        # been stopped after the failure of the previous install.
+        mgr.metadata.set_installed()
+        get_logger().info("Resource %s completed by previous install, skipping install checks." %
+                          mgr.package_name)
+    elif batcher!=None and batcher.handles(mgr):
+        elapsed = batcher.install_resource(mgr)
+        mgr.metadata.set_installed()
+        if elapsed==None:
+            get_logger().info("Resource %s already installed." % mgr.package_name)
+        else:
+            get_logger().info("Install of %s successful (batched)." % mgr.package_name)
+    elif mgr.is_installed():
+        mgr.validate_post_install()
+        # we force the installed_bit to true
+        mgr.metadata.set_installed()
+        get_logger().info("Resource %s already installed." % mgr.package_name)
+    else:
+        if pkg == None:
+            raise UserError(errors[ERR_NO_PACKAGE_FOR_RESOURCE_INST],
+                            msg_args={"inst": mgr.metadata.id,
+                                      "name":mgr.metadata.key["name"],
+                                      "ver":mgr.metadata.key["version"]})
+        if prefetcher!=None:
+            prefetcher.wait_for_resource(mgr.id)
+        start_time = time.time()
+        mgr.validate_pre_install()
+        mgr.install(pkg)
+        mgr.metadata.set_installed()
+        elapsed = time.time() - start_time
+        get_logger().info("Install of %s successful." % mgr.package_name)
+    if mgr.is_service():
+        if mgr.is_running():
+            get_logger().info("Service %s already running." % mgr.package_name)
+        else:
+            mgr.start()
+            get_logger().info("Service %s started successfully." % mgr.package_name)
+    if journal!=None and not journaled:
+        journal.record_completed(mgr.metadata)
+    if batcher!=None:
+        batcher.record_completed(mgr.id)
+    return elapsed
+
+
+def _run_install_serial(mgr_pkg_list, installed_list, installed_resource_ids,
+                        install_times, journal, prefetcher, batcher):
+    for (mgr, pkg) in mgr_pkg_list:
+        elapsed = _install_resource(mgr, pkg, journal, prefetcher, batcher)
+        if elapsed!=None:
+            install_times[mgr.id] = elapsed
+        installed_list.append(mgr)
+        installed_resource_ids.add(mgr.id)
+
+
+def _run_install_parallel(mgr_pkg_list, num_workers, installed_list,
+                          installed_resource_ids, install_times,
+                          priorities=None, journal=None, prefetcher=None,
+                          batcher=None):
+    """Install the resources using a pool of num_workers threads (see
+    dag_runner). Ready resources are handed out in order of priority
+    (highest first) if a priority map is provided (see
+    install_plan.create_critical_path_plan()) and then in plan order.
+    """
+    import install_plan
+    import dag_runner
+    dependencies = \
+        install_plan.get_resource_dependencies([mgr.metadata for (mgr, pkg)
+                                                in mgr_pkg_list])
+    def on_complete(idx, elapsed):
+        mgr = mgr_pkg_list[idx][0]
+        if elapsed!=None:
+            install_times[mgr.id] = elapsed
+        installed_list.append(mgr)
+        installed_resource_ids.add(mgr.id)
+    def on_error(idx):
+        get_logger().error("Install of resource %s failed" %
+                           mgr_pkg_list[idx][0].id)
+    get_logger().info("Running install with %d parallel workers." %
+                      min(num_workers, len(mgr_pkg_list)))
+    plan_index = {}
+    for (i, (mgr, pkg)) in enumerate(mgr_pkg_list):
+        plan_index[mgr.id] = i
+    try:
+        dag_runner.run_in_dependency_order(
+            mgr_pkg_list, [mgr.id for (mgr, pkg) in mgr_pkg_list],
+            dependencies,
+            lambda (mgr, pkg): _install_resource(mgr, pkg, journal,
+                                                 prefetcher, batcher),
+            num_workers, priorities=priorities, on_complete=on_complete,
+            on_error=on_error, thread_name="install-worker")
+    finally:
+        # keep the installed list in plan order, as in the serial case
+        installed_list.sort(key=lambda mgr: plan_index[mgr.id])
+
+
+def run_install(mgr_pkg_list, library, force_stop_on_error=False,
+                num_workers=1, priorities=None, install_times=None,
+                journal=None, prefetcher=None, batcher=None):
+    """Install and start the resources in mgr_pkg_list, which should be in
+    dependency order. If num_workers is greater than one, independent
+    resources are installed in parallel by a pool of that many workers,
+    using priorities (a map from resource ids to numbers) to choose between
+    ready resources. If install_times is provided, it is updated with
+    the number of seconds taken by each resource that was installed, even if
+    the overall install fails. If journal is provided (an
+    install_journal.InstallJournal), each completed resource is recorded
+    in it, and resources already completed according to the journal are
+    not rechecked. If prefetcher is provided (a
+    package_prefetch.PackagePrefetcher which has been started), resources
+    whose packages are still downloading wait for them before installing.
+    If batcher is provided (a package_batch.PackageBatcher created from
+    mgr_pkg_list), the resources which are system packages are installed in
+    batches, with one package manager command per batch.
+    """
     install_target_mgr = get_install_target_mgr(mgr_pkg_list)
     installed_list = []
     installed_resource_ids = set()
+    if install_times==None:
+        install_times = {}
     try:
-        for (mgr, pkg) in mgr_pkg_list:
-            get_logger().info("Processing resource '%s'." % mgr.id)
-            if mgr.is_installed():
-                mgr.validate_post_install()
-                # we force the installed_bit to true
-                mgr.metadata.set_installed()
-                installed_list.append(mgr)
-                installed_resource_ids.add(mgr.id)
-                get_logger().info("Resource %s already installed." % mgr.package_name)
-            else:
-                if pkg == None:
-                    raise UserError(errors[ERR_NO_PACKAGE_FOR_RESOURCE_INST],
-                                    msg_args={"inst": mgr.metadata.id,
-                                              "name":mgr.metadata.key["name"],
-                                              "ver":mgr.metadata.key["version"]})
-                mgr.validate_pre_install()
-                mgr.install(pkg)
-                mgr.metadata.set_installed()
-                installed_list.append(mgr)
-                installed_resource_ids.add(mgr.id)
-                get_logger().info("Install of %s successful." % mgr.package_name)
-            if mgr.is_service():
-                if mgr.is_running():
-                    get_logger().info("Service %s already running." % mgr.package_name)
-                else:
-                    mgr.start()
-                    get_logger().info("Service %s started successfully." % mgr.package_name)
+        if num_workers>1:
+            _run_install_parallel(mgr_pkg_list, num_workers, installed_list,
+                                  installed_resource_ids, install_times,
+                                  priorities, journal, prefetcher, batcher)
+        else:
+            _run_install_serial(mgr_pkg_list, installed_list,
+                                installed_resource_ids, install_times,
+                                journal, prefetcher, batcher)
         install_target_mgr.write_resources_to_file([mgr for (mgr, pkg) in mgr_pkg_list])
         get_logger().info("Install completed successfully.")
     except Exception, e:
@@ -128,14 +248,14 @@ def run_install(mgr_pkg_list, library, force_stop_on_error=False):
             if (mgr.id not in installed_resource_ids) and (mgr.metadata.is_installed()):
                 installed_list.append(mgr)
                 installed_resource_ids.add(mgr.id)
-                logger.debug('Adding resouce %s to installed list -- it was in the original installed set'
-                             % mgr.id)
+                get_logger().debug('Adding resouce %s to installed list -- it was in the original installed set'
+                                   % mgr.id)
         install_target_mgr.write_resources_to_file(installed_list)
         if not force_stop_on_error:
             raise # leave in the error state
         else:
-            logger.error("Got exception: %s, will attempt to force stop all services" % e)
-            undo_list = filter(installed_list, lambda mgr: mgr.is_service())
+            get_logger().error("Got exception: %s, will attempt to force stop all services" % e)
+            undo_list = filter(lambda mgr: mgr.is_service(), installed_list)
             undo_list.reverse()
             for mgr in undo_list:
                 get_logger().info("Attempting to force stop resource %s" % mgr.id)
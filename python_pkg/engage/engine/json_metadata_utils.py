@@ -82,6 +82,127 @@ def _is_valid_for_resource(target_key, target_match_properties, resource_md):
             assert 0, "Unexpected port type in resource: %s" % prop_list[0]
     return True # key matches and no mismatched properties
 
+def _tuple_for_key(key_map):
+    """Convert a resource key to a hashable tuple, for use as a dict key.
+    If any of the key values are not hashable, we fall back to the string
+    form from _hash_string_for_key().
+
+    >>> _tuple_for_key({u"version":u"1.0", u"name":u"p1"})
+    ((u'name', u'p1'), (u'version', u'1.0'))
+    """
+    items = key_map.items()
+    items.sort()
+    t = tuple(items)
+    try:
+        hash(t)
+        return t
+    except TypeError:
+        return _hash_string_for_key(key_map)
+
+
+_PORT_TYPES = ("config_port", "input_ports", "output_ports")
+
+# marker for a property missing from a resource
+_MISSING = object()
+
+
+def _compile_match_properties(match_properties):
+    """Convert a match property map to a list of (port attribute,
+    property path, value) triples, sorted by qualified property name.
+
+    >>> _compile_match_properties({u"config_port.os":u"mac-osx",
+    ...                            u"input_ports.host.arch":u"x86"})
+    [('config_port', (u'os',), u'mac-osx'), ('input_ports', (u'host', u'arch'), u'x86')]
+    """
+    compiled = []
+    for property in sorted(match_properties.keys()):
+        prop_list = property.split(".")
+        assert prop_list[0] in _PORT_TYPES, \
+               "Unexpected port type in resource: %s" % prop_list[0]
+        compiled.append((str(prop_list[0]), tuple(prop_list[1:]),
+                         match_properties[property]))
+    return compiled
+
+
+def _get_resource_value(resource_md, port, path):
+    """Return the value of a (compiled) property in the resource metadata,
+    or _MISSING if it is not present.
+    """
+    value = getattr(resource_md, port)
+    for prop in path:
+        if not (hasattr(value, "has_key") and value.has_key(prop)):
+            return _MISSING
+        value = value[prop]
+    return value
+
+
+def _matches_compiled(compiled, resource_md):
+    for (port, path, value) in compiled:
+        if not (_get_resource_value(resource_md, port, path)==value):
+            return False
+    return True
+
+
+class _KeyBucket(object):
+    """The entries for a single resource key, in the order they were added.
+    Entries are grouped by the set of properties they match on (usually
+    there are only one or two such groups for a key, e.g. entries matching
+    on config_port.os and a fallback entry with no match properties). Within
+    a group, we index the entries by the tuple of values they require, so
+    finding the matching entry of a group is a single dict lookup. Entries
+    with unhashable match values are checked linearly.
+    """
+    def __init__(self):
+        self.entries = [] # list of (seq, entry, compiled match properties)
+        # list of (property paths, map from value tuple to (seq, entry))
+        self.groups = []
+        self.groups_by_paths = {}
+        self.unindexed = [] # list of (seq, entry, compiled match properties)
+
+    def add(self, seq, entry, compiled):
+        self.entries.append((seq, entry, compiled))
+        paths = tuple([(port, path) for (port, path, value) in compiled])
+        values = tuple([value for (port, path, value) in compiled])
+        try:
+            hash(values)
+        except TypeError:
+            self.unindexed.append((seq, entry, compiled))
+            return
+        if not self.groups_by_paths.has_key(paths):
+            self.groups_by_paths[paths] = {}
+            self.groups.append((paths, self.groups_by_paths[paths]))
+        index = self.groups_by_paths[paths]
+        # if an earlier entry requires the same values, it always wins
+        if not index.has_key(values):
+            index[values] = (seq, entry)
+
+    def get_entry(self, resource_md):
+        best = None
+        for (paths, index) in self.groups:
+            values = tuple([_get_resource_value(resource_md, port, path)
+                            for (port, path) in paths])
+            try:
+                match = index.get(values, None)
+            except TypeError: # unhashable value in the resource
+                match = None
+                for (seq, entry, compiled) in self.entries:
+                    if _matches_compiled(compiled, resource_md):
+                        match = (seq, entry)
+                        break
+            if match!=None and (best==None or match[0]<best[0]):
+                best = match
+        for (seq, entry, compiled) in self.unindexed:
+            if best!=None and seq>best[0]:
+                break
+            if _matches_compiled(compiled, resource_md):
+                best = (seq, entry)
+                break
+        if best!=None:
+            return best[1]
+        else:
+            return None
+
+
 class MetadataContainer:
     """This class implements a container for metadata objects which are
     identified by a resource key and a set of properties which match have
@@ -110,40 +231,58 @@ class MetadataContainer:
     1
     >>> print container.get_entry(rmd2).id
     3
+
+    Entries are indexed by the values of their match properties. The first
+    matching entry (in the order they were added) is still returned, even
+    when entries for a key match on different properties:
+
+    >>> for i in range(10):
+    ...     container.add_entry(Entry(10+i, {u"name":u"p3"},
+    ...                               {u"config_port.os":u"os%d" % i}))
+    >>> container.add_entry(Entry(20, {u"name":u"p3"}, {}))
+    >>> container.add_entry(Entry(21, {u"name":u"p3"},
+    ...                           {u"config_port.os":u"os5"}))
+    >>> print container.get_entry(ResourceMD(u"r3", {u"name":u"p3"},
+    ...                                      config_port={u"os":u"os5"})).id
+    15
+    >>> print container.get_entry(ResourceMD(u"r3", {u"name":u"p3"},
+    ...                                      config_port={u"os":u"os99"})).id
+    20
+    >>> len(list(container.entries()))
+    15
     """
     def __init__(self):
-        """We store the entries in a map, where the key is a stringified
-        version of the resource key and the value is a list of entries with
-        that key."""
-        self.entries = {}
+        """We store the entries in a map, where the key is a tuple
+        version of the resource key and the value is a _KeyBucket of entries
+        with that key."""
+        self.buckets = {}
+        self.num_entries = 0
 
     def add_entry(self, entry):
         """Add an etry to the table. Note that, for a given key, we could have
         multiple entries, even with overlapping match properties. We always
         add new entries to the end of the list and get_entry() returns the
-        first match with the resource metadata.
+        first match with the resource metadata. The match properties are
+        compiled here, so they should not be changed after the entry is added.
         """
-        key_hash = _hash_string_for_key(entry.key)
-        if self.entries.has_key(key_hash):
-            self.entries[key_hash].append(entry)
-        else:
-            self.entries[key_hash] = [entry]
+        key_tuple = _tuple_for_key(entry.key)
+        if not self.buckets.has_key(key_tuple):
+            self.buckets[key_tuple] = _KeyBucket()
+        self.buckets[key_tuple].add(self.num_entries, entry,
+                                    _compile_match_properties(entry.match_properties))
+        self.num_entries += 1
 
     def get_entry(self, resource_md):
-        key_hash = _hash_string_for_key(resource_md.key)
-        if not self.entries.has_key(key_hash):
+        bucket = self.buckets.get(_tuple_for_key(resource_md.key), None)
+        if bucket==None:
             return None
-        for entry in self.entries[key_hash]:
-            if _is_valid_for_resource(entry.key, entry.match_properties,
-                                      resource_md):
-                return entry
-        return None
+        return bucket.get_entry(resource_md)
 
     def entries(self):
         """Generator which enumerates all the entries"""
-        for k in self.entries.keys():
-            for e in self.entries[k]:
-                yield e
+        for bucket in self.buckets.values():
+            for (seq, entry, compiled) in bucket.entries:
+                yield entry
 
 
 class UnionType(object):
@@ -49,12 +49,16 @@ present:
  downloader: Name of downloader class to obtain the package from the location.
              If downloader is not present, defaults to one which always requires
              the package to be in the local cache
+ sha256:     Optional hex digest of the file. If present, HTTPDownloader
+             verifies downloads against it.
 
 
 In some cases, packages may need some extra configuration data (e.g. API keys).
 To accomodate this, the resource library file may contain a top level property
 called "package_properties". If present, this property's value should be a
 map. The map is passed to the constructor of each package object and downloader.
+The extraction_cache property of this map controls the caching of extracted
+archives (see engage.engine.extraction_cache).
 
 Supported package classes:
 GzippedTarArchive (Archive)
@@ -73,7 +77,7 @@ import os.path
 import tarfile
 import zipfile
 import shutil
-import urllib
+import tempfile
 import re
 import copy
 
@@ -81,8 +85,14 @@ from engage.engine.json_metadata_utils import MetadataContainer, get_json_proper
                                               get_opt_json_property, UnionType
 import engage.utils.file as fileutils
 import engage.utils.path
+import engage.utils.http_download as http_download
+import engage.utils.trace as tracing
+import engage.utils.json_backend as json_backend
 import engage.utils.system_info_bootstrap as system_info
 from engage.extensions import installed_extensions
+import engage.engine.driver_registry as driver_registry
+import engage.engine.preprocess_manifest as preprocess_manifest
+import engage.engine.extraction_cache as extraction_cache
 from engage.utils.log_setup import setup_engine_logger
 from engage.utils.user_error import UserError, InstErrInf, convert_exc_to_user_error
 
@@ -202,25 +212,40 @@ def register_downloader_class(classname, constructor):
 import engage.utils.socktime as socktime
 
 class HTTPDownloader(Downloader):
+    """Download a package via http(s). If the package properties include a
+    sha256 property (e.g. from the package's entry in packages.json), the
+    download is verified against it. See engage.utils.http_download for
+    details on resuming and retrying of downloads.
+    """
+    tries = http_download.DEFAULT_TRIES
+
     def __init__(self, location, target_filepath, package_properties=None):
         if not isinstance(location, basestring):
             elapsed, url = socktime.fastest(location)
             get_logger().debug('Using fastest (%s) mirror: %s' % (elapsed, url))
             location = url
         Downloader.__init__(self, location, target_filepath, package_properties)
+        if package_properties:
+            self.sha256 = package_properties.get(u"sha256", None)
+        else:
+            self.sha256 = None
 
     def is_available(self):
-        try:
-            get_logger().debug("Trying to get %s" % self.location)
-            f = urllib.urlopen(self.location)
-            return int(f.info().getheader('content-length')) > 0
-        except:
-            get_logger().exception('%s is unavailable' % self.location)
+        get_logger().debug("Checking for %s" % self.location)
+        info = http_download.get_url_info(self.location)
+        if info==None:
+            get_logger().debug("%s is unavailable" % self.location)
             return False
+        # some servers omit the length for a HEAD request
+        return info.length==None or info.length>0
 
     def download_to_cache(self):
         get_logger().info('downloading %s via HTTP' % self.location)
-        urllib.urlretrieve(self.location, self.target_filepath)
+        with tracing.span(os.path.basename(self.target_filepath), "download",
+                          url=self.location):
+            http_download.download(self.location, self.target_filepath,
+                                   sha256=self.sha256, tries=self.tries,
+                                   logger=get_logger())
 
 register_downloader_class("HTTPDownloader", HTTPDownloader)
 
@@ -327,24 +352,87 @@ class ArchivePackage(FilePackage):
         assert type == Package.ARCHIVE_TYPE
         FilePackage.__init__(self, type, location, filepath, downloader_class,
                              platforms, package_properties)
+        if package_properties:
+            self.extraction_cache_mode = \
+                package_properties.get(u"extraction_cache",
+                                       extraction_cache.COPY_MODE)
+        else:
+            self.extraction_cache_mode = extraction_cache.COPY_MODE
+
+
+
+class _ArchiveNameValidator(object):
+    """Incrementally validate the file names in an archive, as they are
+    extracted. See GenericExtractor._validate_archive_files() for details.
+    """
+    def __init__(self, format, filepath, expecting_common_subdir):
+        self.format = format
+        self.filepath = filepath
+        self.expecting_common_subdir = expecting_common_subdir
+        self.common_dirname = None
+        self.has_common_dir = True
+        # first file name which was not under the common directory
+        self.invalid_name = None
+
+    def check(self, name):
+        if os.path.isabs(name):
+            raise PackageReadError, \
+                  "%s archive %s not valid for install: contains absolute file path %s" % (self.format, self.filepath, name)
+        if self.has_common_dir:
+            if name.find(os.sep): # contains a directory component
+                subdir = engage.utils.path.get_first_subdir_component(name)
+                if self.common_dirname == None:
+                    self.common_dirname = subdir
+                elif self.common_dirname != subdir:
+                    if self.expecting_common_subdir:
+                        raise PackageReadError, \
+                            "%s archive %s not valid for install: contains invalid file path %s" % (self.format, self.filepath, name)
+                    else:
+                        self.has_common_dir = False
+                        self.common_dirname = None
+                        self.invalid_name = name
+            else:
+                self.has_common_dir = False
+                self.common_dirname = None
+                self.invalid_name = name
+
 
+def _move_tree(src, dest):
+    """Move the tree at src to dest, merging with the contents of dest if it
+    already exists.
+    """
+    if not os.path.isdir(dest):
+        os.rename(src, dest)
+        return
+    for name in os.listdir(src):
+        src_path = os.path.join(src, name)
+        dest_path = os.path.join(dest, name)
+        if os.path.isdir(src_path) and not os.path.islink(src_path):
+            _move_tree(src_path, dest_path)
+        else:
+            if os.path.lexists(dest_path):
+                os.remove(dest_path)
+            os.rename(src_path, dest_path)
 
 
 class GenericExtractor(object):
     """This is a base class for packages which extract themselves using the extract() method. We
     provide a common implementation of extract() that deals with validation, directory renaming,
-    etc.
+    etc. Extracted archives are kept in an extraction cache (see engage.engine.extraction_cache),
+    unless the extraction_cache property of the package properties is "off".
 
     Subclasses must provide the following:
         self.filepath - full path to the archive file
         self.format - user-readable name of the archive format (e.g. Zip, gzipped-tar)
+        self.extraction_cache_mode - one of the extraction_cache modes
         self.get_file() - download the file if necessary. returns the path, which should be the same as self.filepath
         self._create_archive_object() - Return an archive object for the associated archive file
         self._get_extract_action_logmsg(extract_dir, archive_file) - return a log message string for extracting the archive
 
     The archive object should provide the following methods:
-        archive_obj.namelist() - return a list of files in the archive
-        archive_obj.extractall(path) - extract all the files in the archive to the specified location
+        archive_obj.extractall(path, check_name) - extract all the files in the archive to the specified
+                                                   location, calling check_name on each file name before
+                                                   extracting that file
         archive_obj.close() - close the archive object
     """
     def _validate_archive_files(self, namelist, expecting_common_subdir=False):
@@ -377,41 +465,50 @@ class GenericExtractor(object):
         >>> testfn(list3, False)
         None
         """
-        common_dirname = None
-        has_common_dir = True
+        validator = _ArchiveNameValidator(self.format, self.filepath,
+                                          expecting_common_subdir)
         for name in namelist:
-            if os.path.isabs(name):
-                raise PackageReadError, \
-                      "%s archive %s not valid for install: contains absolute file path %s" % (self.format, self.filepath, name)
-            if has_common_dir:
-                if name.find(os.sep): # contains a directory component
-                    subdir = engage.utils.path.get_first_subdir_component(name)
-                    if common_dirname == None:
-                        common_dirname = subdir
-                    elif common_dirname != subdir:
-                        if expecting_common_subdir:
-                            raise PackageReadError, \
-                                "%s archive %s not valid for install: contains invalid file path %s" % (self.format, self.filepath, name)
-                        else:
-                            has_common_dir = False
-                            common_dirname = None
-                else:
-                    has_common_dir = False
-                    common_dirname = None
-        return common_dirname
+            validator.check(name)
+        return validator.common_dirname
+
+    def _extract_to_dir(self, extract_dir, expecting_common_subdir):
+        """Extract the archive into extract_dir in a single pass, validating
+        the file names as we go. Returns the validator.
+        """
+        validator = _ArchiveNameValidator(self.format, self.filepath,
+                                          expecting_common_subdir)
+        get_logger().action(self._get_extract_action_logmsg(extract_dir, self.filepath))
+        z = self._create_archive_object()
+        try:
+            z.extractall(extract_dir, validator.check)
+        finally:
+            z.close()
+        return validator
+
+    def _get_extraction_cache(self):
+        mode = getattr(self, "extraction_cache_mode", extraction_cache.OFF_MODE)
+        if mode==extraction_cache.OFF_MODE:
+            return None
+        return extraction_cache.ExtractionCache(
+                   os.path.join(os.path.dirname(self.filepath),
+                                extraction_cache.CACHE_SUBDIR), mode)
 
     def extract(self, parent_dir, desired_common_dirname=None):
         """Extract the archive into the specified parent directory. All files should go into a single subdirectory.
         This common subdirectory may optionally be specified using desired_common_dirname.
 
+        >>> import tempfile
         >>> class TestArchiveObject(object):
         ...     def __init__(self, filename, namelist_val):
         ...         self.filepath = filename
         ...         self.namelist_val = namelist_val
-        ...     def namelist(self):
-        ...         return self.namelist_val
-        ...     def extractall(self, parent_dir):
-        ...         print 'Extracting to %s: %s' % (self.filepath, self.namelist_val)
+        ...     def extractall(self, parent_dir, check_name):
+        ...         print 'Extracting %s: %s' % (self.filepath, self.namelist_val)
+        ...         for name in self.namelist_val:
+        ...             check_name(name)
+        ...             path = os.path.join(parent_dir, name)
+        ...             if name.endswith('/'): os.makedirs(path)
+        ...             else: open(path, 'w').close()
         ...     def close(self):
         ...         pass
         >>> class TestExtractor(GenericExtractor):
@@ -425,10 +522,24 @@ class GenericExtractor(object):
         ...         return TestArchiveObject(self.filepath, self.namelist)
         ...     def _get_extract_action_logmsg(self, extract_dir, archive_file):
         ...         return "zip -d %s %s" % (extract_dir, archive_file)
+        >>> parent_dir = tempfile.mkdtemp()
         >>> extractor = TestExtractor(['test/', 'test/foo.txt', 'test/bar.txt'])
-        >>> extractor.extract("/Users/test_parent")
-        Extracting to foo.zip: ['test/', 'test/foo.txt', 'test/bar.txt']
+        >>> extractor.extract(parent_dir)
+        Extracting foo.zip: ['test/', 'test/foo.txt', 'test/bar.txt']
         'test'
+        >>> sorted(os.listdir(os.path.join(parent_dir, 'test')))
+        ['bar.txt', 'foo.txt']
+        >>> extractor = TestExtractor(['x/', 'x/foo.txt', 'y/', 'y/bar.txt'])
+        >>> umask = os.umask(022)
+        >>> extractor.extract(parent_dir, desired_common_dirname='z')
+        Extracting foo.zip: ['x/', 'x/foo.txt', 'y/', 'y/bar.txt']
+        'z'
+        >>> _ = os.umask(umask)
+        >>> sorted(os.listdir(parent_dir)), sorted(os.listdir(os.path.join(parent_dir, 'z')))
+        (['test', 'z'], ['x', 'y'])
+        >>> oct(os.stat(os.path.join(parent_dir, 'z')).st_mode & 0777)
+        '0755'
+        >>> shutil.rmtree(parent_dir)
         """
         # first download the file
         actual_path = self.get_file()
@@ -439,45 +550,106 @@ class GenericExtractor(object):
         if desired_common_dirname == None: expecting_common_subdir = True
         else: expecting_common_subdir = False
 
-        z = self._create_archive_object()
-        common_dirname = self._validate_archive_files(z.namelist(), expecting_common_subdir)
-
-        if common_dirname != None:
-            get_logger().action(self._get_extract_action_logmsg(parent_dir, self.filepath))
-            z.extractall(parent_dir)
-            z.close()
-            if (desired_common_dirname != None) and (common_dirname != desired_common_dirname):
-                # if the actual common directory name is different from the desired one, rename the directory
-                from_path = os.path.join(parent_dir, common_dirname)
-                to_path = os.path.join(parent_dir, desired_common_dirname)
-                get_logger().action("mv %s %s" % (from_path, to_path))
-                shutil.move(from_path, to_path)
-                return desired_common_dirname
+        cache = self._get_extraction_cache()
+        if cache:
+            def extract_fn(tree_dir):
+                # validate without expecting a common subdirectory, as the
+                # entry may be used by callers with either expectation
+                v = self._extract_to_dir(tree_dir, False)
+                return {"common_dirname":v.common_dirname,
+                        "invalid_name":v.invalid_name}
+            try:
+                (tree_dir, info) = cache.get_or_create(self.filepath, extract_fn)
+            except (OSError, IOError), e:
+                get_logger().warning("Unable to use extraction cache at %s, extracting directly: %s" %
+                                     (cache.cache_root, e))
+                cache = None
+        if cache:
+            common_dirname = info["common_dirname"]
+            if expecting_common_subdir and common_dirname == None:
+                raise PackageReadError, \
+                    "%s archive %s not valid for install: contains invalid file path %s" % (self.format, self.filepath, info["invalid_name"])
+            if common_dirname != None:
+                src = os.path.join(tree_dir, common_dirname)
+                dest = os.path.join(parent_dir, desired_common_dirname or common_dirname)
             else:
-                return common_dirname
-        else:
-            assert desired_common_dirname != None # if no common dir and one not specified, validation should have raised an error
-            full_child_path = os.path.join(parent_dir, desired_common_dirname)
-            if not os.path.exists(full_child_path):
-                get_logger().action("mkdir %s" % full_child_path)
-                os.makedirs(full_child_path)
-            get_logger().action(self._get_extract_action_logmsg(full_child_path, self.filepath))
-            z.extractall(full_child_path)
-            z.close()
-            return desired_common_dirname
-        
+                src = tree_dir
+                dest = os.path.join(parent_dir, desired_common_dirname)
+            get_logger().action("%s %s %s (from extraction cache)" %
+                                ("cp -al" if cache.mode==extraction_cache.HARDLINK_MODE else "cp -a",
+                                 src, dest))
+            cache.copy_tree(src, dest)
+            return desired_common_dirname or common_dirname
+
+        # Not caching: extract to a staging directory in the parent and then
+        # move into place, so that we don't leave a partial extraction behind
+        # if validation fails part way through the archive. mkdtemp() creates
+        # the staging directory with mode 0700, so we extract into a
+        # subdirectory created with the usual mode (from the umask), as this
+        # subdirectory becomes dest if the archive has no common directory.
+        if not os.path.isdir(parent_dir):
+            os.makedirs(parent_dir)
+        staging_dir = tempfile.mkdtemp(prefix=".extract-", dir=parent_dir)
+        try:
+            extract_dir = os.path.join(staging_dir, "tree")
+            os.mkdir(extract_dir)
+            validator = self._extract_to_dir(extract_dir, expecting_common_subdir)
+            common_dirname = validator.common_dirname
+            if common_dirname != None:
+                src = os.path.join(extract_dir, common_dirname)
+                dest = os.path.join(parent_dir, desired_common_dirname or common_dirname)
+            else:
+                assert desired_common_dirname != None # if no common dir and one not specified, validation should have raised an error
+                src = extract_dir
+                dest = os.path.join(parent_dir, desired_common_dirname)
+            if (desired_common_dirname != None) and (common_dirname != desired_common_dirname):
+                get_logger().action("mv %s %s" % (src, dest))
+            _move_tree(src, dest)
+            return desired_common_dirname or common_dirname
+        finally:
+            if os.path.exists(staging_dir):
+                shutil.rmtree(staging_dir)
+
+
 class TarFile(object):
+    """Tar archives are read as a stream, so that we validate and extract the
+    files in a single pass over the (possibly compressed) archive.
+    """
     def __init__(self, filename):
-        self.tarobj = tarfile.open(filename)
+        self.filename = filename
 
     def namelist(self):
-        return self.tarobj.getnames()
+        tarobj = tarfile.open(self.filename)
+        try:
+            return tarobj.getnames()
+        finally:
+            tarobj.close()
 
-    def extractall(self, dir):
-        self.tarobj.extractall(dir)
+    def extractall(self, dir, check_name=None):
+        tarobj = tarfile.open(self.filename, "r|*")
+        try:
+            directories = []
+            for tarinfo in tarobj:
+                if check_name:
+                    check_name(tarinfo.name)
+                if tarinfo.isdir():
+                    # as in TarFile.extractall(), set the directory
+                    # permissions after extracting their contents
+                    directories.append(tarinfo)
+                    tarinfo = copy.copy(tarinfo)
+                    tarinfo.mode = 0700
+                tarobj.extract(tarinfo, dir)
+            directories.sort(key=lambda a: a.name, reverse=True)
+            for tarinfo in directories:
+                dirpath = os.path.join(dir, tarinfo.name)
+                tarobj.chown(tarinfo, dirpath)
+                tarobj.utime(tarinfo, dirpath)
+                tarobj.chmod(tarinfo, dirpath)
+        finally:
+            tarobj.close()
 
     def close(self):
-        self.tarobj.close()
+        pass
 
     
 class GzippedTarFilePackage(ArchivePackage, GenericExtractor):
@@ -507,11 +679,15 @@ class ZipFile(zipfile.ZipFile):
     def __init__(self, filename):
         zipfile.ZipFile.__init__(self, filename)
 
-    def extractall(self, parent_dir):
+    def extractall(self, parent_dir, check_name=None):
         """This is a workaround for a bug in Python's ZipFile.extractall() method implementation.
         It does not handle extracting subdirectories correctly, so we extract the files individually,
-        creating subdirectories by hand.
+        creating subdirectories by hand. The zip directory is cheap to read, so we check all the
+        names before extracting anything.
         """
+        if check_name:
+            for name in self.namelist():
+                check_name(name)
         for name in self.namelist():
             if _is_zip_direntry(name):
                 subdir = os.path.join(parent_dir, name)
@@ -879,7 +1055,18 @@ def _parse_entry(json_repr, err_msg, cache_directory, package_properties):
 
 def _load_newstyle_entry(key, err_msg, cache_directory, package_properties):
     """This is for library entries that are stored along with the drivers.
+    We use the driver registry if it has an entry for the key. Otherwise,
+    we search for the driver module and ask it for its packages file.
     """
+    registry_entry = driver_registry.get_packages(key)
+    if registry_entry!=None:
+        (driver_module_name, package_file, package_list_json) = registry_entry
+        err_msg = "%s resource %s" % (err_msg, key)
+        package_list = [_parse_package(package_json, err_msg,
+                                       cache_directory, package_properties)
+                        for package_json in package_list_json]
+        assert len(package_list)>0
+        return LibraryEntry(key, {}, driver_module_name, package_list)
     _mod = None
     driver_module_names = convert_resource_key_to_driver_module_names(key)
     for driver_module_name in driver_module_names:
@@ -911,7 +1098,7 @@ def _load_newstyle_entry(key, err_msg, cache_directory, package_properties):
     err_msg = "%s resource %s" % (err_msg, key)
 
     with open(package_file, "rb") as pf:
-        package_list_json = json.load(pf)
+        package_list_json = json_backend.load(pf)
         
     package_list = [_parse_package(package_json, err_msg,
                                    cache_directory, package_properties)
@@ -921,33 +1108,54 @@ def _load_newstyle_entry(key, err_msg, cache_directory, package_properties):
                         package_list)
 
 
+def _load_library_file(library_file):
+    with open(library_file, "rb") as lf:
+        return json_backend.load(lf)
+
+
 def preprocess_library_file(primary_library_file, extension_library_files,
-                            target_library_file):
+                            target_library_file, incremental=False):
     """Combine the primary library file with extension library files, generating
     target_library_file. This is done at the json level without doing any kind
     of semantic parsing of the library files. Extension files can either be a
     dict with an "entries" member (like the master file) or just a list of entries.
+
+    If incremental is True, we skip the merge when none of the input files
+    have changed since the last run (see preprocess_manifest.py).
     """
-    with open(primary_library_file, "rb") as plf:
-        library_file = json.load(plf)
-    entries = library_file['entries']
+    input_files = [primary_library_file] + \
+                  [f for f in extension_library_files if os.path.exists(f)]
+    if incremental:
+        manifest = preprocess_manifest.InputManifest(target_library_file)
+        if manifest.is_up_to_date(input_files, [target_library_file]):
+            get_logger().debug("Preprocessed library file %s is up to date" %
+                               target_library_file)
+            return
+        (fragments, changed) = manifest.load_fragments(input_files,
+                                                       _load_library_file)
+    else:
+        manifest = None
+        fragments = preprocess_manifest.load_json_files(input_files,
+                                                        _load_library_file)
+    library_file = copy.copy(fragments[primary_library_file])
+    entries = list(library_file['entries'])
     # append the entries from each extension file
-    for extn_file in extension_library_files:
-        if not os.path.exists(extn_file):
-            continue
+    for extn_file in input_files[1:]:
         get_logger().debug("Adding library entries from %s/%s to master library" %
                            (os.path.basename(os.path.dirname(extn_file)),
                             os.path.basename(extn_file)))
-        with open(extn_file, "rb") as ef:
-            extn_file_json = json.load(ef)
+        extn_file_json = fragments[extn_file]
         if isinstance(extn_file_json, list):
             entries.extend(extn_file_json)
-        elif isintance(extn_file_json, dict) and extn_file_json.has_key("entries"):
+        elif isinstance(extn_file_json, dict) and extn_file_json.has_key("entries"):
             entries.extend(extn_file_json["entries"])
         else:
             raise Exception("Library file %s not in correct format" % extn_file)
+    library_file['entries'] = entries
     with open(target_library_file, "wb") as tf:
-        json.dump(library_file, tf)
+        json_backend.dump(library_file, tf, compact=True)
+    if manifest:
+        manifest.save(input_files, fragments, [target_library_file])
 
  
 _unit_test_library = u"""
@@ -1104,16 +1312,18 @@ def parse_library_files(file_layout, use_temporary_file=False):
     FileLibrary.
     """
     fl = file_layout
+    driver_registry.load_registry(driver_registry.get_registry_file(fl.get_preprocessed_resource_file()))
     perm_file_name = fl.get_preprocessed_library_file() \
                      if not use_temporary_file \
                      else None
     with fileutils.OptNamedTempFile(perm_file_name=perm_file_name) as of:
         preprocess_library_file(fl.get_software_library_file(),
                                 fl.get_extension_library_files(),
-                                of.name)
+                                of.name,
+                                incremental=not use_temporary_file)
         try:
             with open(of.name, "rb") as lf:
-                json_repr = json.load(lf)
+                json_repr = json_backend.load(lf)
             return parse_library(json_repr, of.name,
                                  cache_directory_override=fl.get_cache_directory())
         except UserError, e:
@@ -0,0 +1,210 @@
+"""Batch the installs of resources which are just packages from a package
+manager (apt-get, MacPorts, or pip). Installing these one resource at a time
+means a separate sudo call, package database lock, and dependency resolution
+(or for pip, a separate download and build) for each package. The
+PackageBatcher scans the install plan for resources whose managers provide a
+batch installer (see resource_manager.Manager.get_batch_installer()) and
+groups them by package manager.
+
+When the install sequencer reaches the first pending resource of a group,
+the batcher installs it together with every other pending resource of the
+group whose dependencies have all completed (or are themselves in the
+batch), using one query for the packages already present, one install
+command, and one query to verify the results. The remaining resources of the
+group are picked up by later batches, once their dependencies are in place.
+Thus, we have a transaction for each dependency "wave" of packages, rather
+than one per resource. When the sequencer reaches the other members of a
+completed batch, they are just marked as installed.
+"""
+
+import time
+import threading
+
+import fixup_python_path
+from engage.utils.log_setup import setup_engine_logger
+import engage.utils.trace as tracing
+import install_plan
+
+logger = setup_engine_logger(__name__)
+
+
+class _Member(object):
+    def __init__(self, mgr, installer, package_name):
+        self.mgr = mgr
+        self.installer = installer
+        self.package_name = package_name
+
+
+class PackageBatcher(object):
+    """Here is an example, using fake managers and a fake package manager.
+    Resource b depends on a resource which is not a package (tool), so it is
+    installed in a second batch, and pkg-c is already installed.
+
+    >>> import engage.drivers.resource_metadata as resource_metadata
+    >>> class FakeInstaller(object):
+    ...     batch_key = "fake"
+    ...     installed = set(["pkg-c"])
+    ...     commands = []
+    ...     def get_installed_packages(self, package_list):
+    ...         return set([p for p in package_list if p in self.installed])
+    ...     def install_packages(self, package_list):
+    ...         self.commands.append(package_list)
+    ...         self.installed.update(package_list)
+    >>> class FakeManager(object):
+    ...     def __init__(self, metadata, package_name=None):
+    ...         self.metadata = metadata
+    ...         self.id = metadata.id
+    ...         self.package_name = package_name
+    ...     def get_batch_installer(self, pkg):
+    ...         if self.package_name:
+    ...             return (FakeInstaller(), self.package_name)
+    ...     def validate_pre_install(self):
+    ...         pass
+    ...     def validate_post_install(self):
+    ...         pass
+    >>> def make_mgr(id, package_name=None, env=[]):
+    ...     key = {"name":id, "version":"1"}
+    ...     if id=="host":
+    ...         return FakeManager(resource_metadata.ResourceMD(id, key))
+    ...     md = resource_metadata.ResourceMD(id, key,
+    ...            inside=resource_metadata.ResourceRef("host", {"name":"host", "version":"1"}),
+    ...            environment=[resource_metadata.ResourceRef(e, {"name":e, "version":"1"})
+    ...                         for e in env])
+    ...     return FakeManager(md, package_name)
+    >>> mgrs = [make_mgr("host"), make_mgr("a", "pkg-a"), make_mgr("c", "pkg-c"),
+    ...         make_mgr("d", "pkg-d", env=["a"]), make_mgr("tool"),
+    ...         make_mgr("b", "pkg-b", env=["tool"])]
+    >>> batcher = PackageBatcher([(mgr, None) for mgr in mgrs])
+    >>> [mgr.id for mgr in mgrs if batcher.handles(mgr)]
+    ['a', 'c', 'd', 'b']
+    >>> batcher.record_completed("host")
+    >>> batcher.install_resource(mgrs[1])!=None
+    True
+    >>> FakeInstaller.commands
+    [['pkg-a', 'pkg-d']]
+    >>> print batcher.install_resource(mgrs[2])
+    None
+    >>> batcher.install_resource(mgrs[3])!=None
+    True
+    >>> batcher.record_completed("tool")
+    >>> batcher.install_resource(mgrs[5])!=None
+    True
+    >>> FakeInstaller.commands
+    [['pkg-a', 'pkg-d'], ['pkg-b']]
+    """
+    def __init__(self, mgr_pkg_list):
+        """mgr_pkg_list should be the full install plan, in install order.
+        We skip resources which are already marked as installed in their
+        metadata.
+        """
+        self.members = {} # map from resource id to _Member
+        self.groups = {} # map from batch key to list of pending resource ids
+        for (mgr, pkg) in mgr_pkg_list:
+            if mgr.metadata.is_installed():
+                continue
+            batch = mgr.get_batch_installer(pkg)
+            if batch==None:
+                continue
+            (installer, package_name) = batch
+            self.members[mgr.id] = _Member(mgr, installer, package_name)
+            if not self.groups.has_key(installer.batch_key):
+                self.groups[installer.batch_key] = []
+            self.groups[installer.batch_key].append(mgr.id)
+        self.dependencies = \
+            install_plan.get_resource_dependencies([mgr.metadata for (mgr, pkg)
+                                                    in mgr_pkg_list])
+        self.completed = set()
+        self.results = {} # map from resource id to seconds or None
+        # protects completed and results
+        self.lock = threading.Lock()
+        # held while installing a batch of the group, so that we run only one
+        # package manager command at a time for each group
+        self.group_locks = dict([(key, threading.Lock()) for key in self.groups.keys()])
+        for (key, ids) in self.groups.items():
+            logger.debug("Package batch group %s: %s" % (key, ", ".join(ids)))
+
+    def handles(self, mgr):
+        return self.members.has_key(mgr.id)
+
+    def record_completed(self, resource_id):
+        """Called by the sequencer when a resource has been installed (and
+        started, if a service).
+        """
+        with self.lock:
+            self.completed.add(resource_id)
+
+    def install_resource(self, mgr):
+        """Ensure that the resource's package is installed, installing it in
+        a batch with any other ready resources of its group if needed.
+        Returns the resource's share of the batch install time in seconds,
+        or None if the package was already installed.
+        """
+        first = self.members[mgr.id]
+        with self.group_locks[first.installer.batch_key]:
+            with self.lock:
+                if self.results.has_key(mgr.id):
+                    return self.results[mgr.id]
+                batch = self._select_batch(first)
+            results = self._run_batch(first, batch)
+            with self.lock:
+                self.results.update(results)
+                return self.results[mgr.id]
+
+    def _select_batch(self, first):
+        group = self.groups[first.installer.batch_key]
+        selected = [first.mgr.id]
+        selected_set = set(selected)
+        changed = True
+        while changed:
+            changed = False
+            for resource_id in group:
+                if resource_id in selected_set or self.results.has_key(resource_id):
+                    continue
+                ready = True
+                for dep_id in self.dependencies[resource_id]:
+                    if dep_id not in self.completed and dep_id not in selected_set:
+                        ready = False
+                        break
+                if ready:
+                    selected.append(resource_id)
+                    selected_set.add(resource_id)
+                    changed = True
+        return [self.members[resource_id] for resource_id in selected]
+
+    def _run_batch(self, first, batch):
+        """Install the batch, returning a map from resource id to its share
+        of the install time (or None). Called without holding self.lock.
+        """
+        installer = first.installer
+        package_names = []
+        for member in batch:
+            if member.package_name not in package_names:
+                package_names.append(member.package_name)
+        with tracing.span(first.mgr.id, "package_batch",
+                          packages=len(package_names)):
+            already_installed = installer.get_installed_packages(package_names)
+            to_install = [name for name in package_names
+                          if name not in already_installed]
+            elapsed = None
+            if len(to_install)>0:
+                logger.info("Installing %d package(s) for %d resource(s) in one batch: %s" %
+                            (len(to_install), len(batch), " ".join(to_install)))
+                for member in batch:
+                    if member.package_name in to_install:
+                        member.mgr.validate_pre_install()
+                start_time = time.time()
+                installer.install_packages(to_install)
+                elapsed = (time.time() - start_time)/len(to_install)
+                installed = installer.get_installed_packages(to_install)
+                for member in batch:
+                    if member.package_name in to_install and \
+                       member.package_name not in installed:
+                        # let the driver report the error
+                        member.mgr.validate_post_install()
+        results = {}
+        for member in batch:
+            if member.package_name in to_install:
+                results[member.mgr.id] = elapsed
+            else:
+                results[member.mgr.id] = None
+        return results
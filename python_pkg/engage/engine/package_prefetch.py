@@ -0,0 +1,146 @@
+"""Prefetch the packages for an install. Without prefetching, each package
+is only downloaded when its driver's install() method calls get_file() (or
+download(), for new-style packages), putting every download on the critical
+path of the install. The PackagePrefetcher downloads all the packages in the
+plan into the cache directory using a pool of worker threads, while the
+install sequencer works through the resources. Before installing a resource,
+the sequencer calls wait_for_resource(), which only blocks if that resource's
+package is still being downloaded.
+
+Prefetch failures are logged, but otherwise ignored: the driver will then
+attempt the download itself and report any errors in the usual way.
+"""
+
+import os
+import os.path
+import time
+import threading
+import Queue
+
+import fixup_python_path
+from engage.utils.log_setup import setup_engine_logger
+import engage.utils.trace as tracing
+import library
+
+logger = setup_engine_logger(__name__)
+
+DEFAULT_PREFETCH_WORKERS = 4
+
+
+def _needs_prefetch(package):
+    """Return True if the package is one we know how to download ahead of
+    time and is not already in the cache.
+    """
+    if isinstance(package, library.FilePackage):
+        return (not os.path.exists(package.filepath)) and \
+               package.downloader.__class__!=library.Downloader
+    try:
+        import engage_utils.pkgmgr
+    except ImportError:
+        return False
+    return isinstance(package, engage_utils.pkgmgr.Package)
+
+
+def _get_download_key(package):
+    """Packages may be shared by several resources, so we key downloads by
+    their target file (or the package object for new-style packages).
+    """
+    if isinstance(package, library.FilePackage):
+        return package.filepath
+    else:
+        return id(package)
+
+
+def _download(package, cache_directory):
+    """Download the package to the cache, returning the local path."""
+    if isinstance(package, library.FilePackage):
+        return package.get_file()
+    else:
+        return package.download([], cache_directory, dry_run=False)
+
+
+class PackagePrefetcher(object):
+    def __init__(self, mgr_pkg_list, cache_directory,
+                 num_workers=DEFAULT_PREFETCH_WORKERS):
+        """mgr_pkg_list should be in the order the resources will be
+        installed, so that we fetch the earliest needed packages first.
+        We skip resources which are already marked as installed in their
+        metadata.
+        """
+        self.cache_directory = cache_directory
+        self.num_workers = num_workers
+        self.events = {} # map from resource id to event set when done
+        self.tasks = []
+        events_by_key = {}
+        for (mgr, pkg) in mgr_pkg_list:
+            if pkg==None or mgr.metadata.is_installed() or \
+               not _needs_prefetch(pkg):
+                continue
+            key = _get_download_key(pkg)
+            if not events_by_key.has_key(key):
+                events_by_key[key] = threading.Event()
+                self.tasks.append((mgr.id, pkg, events_by_key[key]))
+            self.events[mgr.id] = events_by_key[key]
+        self.task_queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.completed = 0
+        self.total_bytes = 0
+        self.start_time = None
+        self.workers = []
+
+    def start(self):
+        if len(self.tasks)==0:
+            return
+        logger.info("Prefetching %d package(s) using %d worker(s)" %
+                    (len(self.tasks), min(self.num_workers, len(self.tasks))))
+        self.start_time = time.time()
+        for task in self.tasks:
+            self.task_queue.put(task)
+        for i in range(min(self.num_workers, len(self.tasks))):
+            self.task_queue.put(None)
+            t = threading.Thread(target=self._worker,
+                                 name="prefetch-worker-%d" % i)
+            t.daemon = True
+            t.start()
+            self.workers.append(t)
+
+    def _worker(self):
+        while True:
+            task = self.task_queue.get()
+            if task==None:
+                return
+            (resource_id, package, event) = task
+            try:
+                start_time = time.time()
+                with tracing.span(resource_id, "prefetch"):
+                    path = _download(package, self.cache_directory)
+                elapsed = time.time() - start_time
+                size = 0
+                if path and os.path.isfile(path):
+                    size = os.path.getsize(path)
+                with self.lock:
+                    self.completed += 1
+                    self.total_bytes += size
+                    completed = self.completed
+                    total_elapsed = time.time() - self.start_time
+                    total_bytes = self.total_bytes
+                logger.info("Prefetched package for %s: %.1f KB in %.1fs (%d of %d packages, %.1f KB/s overall)" %
+                            (resource_id, size/1024.0, elapsed, completed,
+                             len(self.tasks),
+                             (total_bytes/1024.0)/max(total_elapsed, 0.001)))
+            except Exception, e:
+                logger.warning("Prefetch of package for %s failed, will retry at install time: %s" %
+                               (resource_id, e))
+            event.set()
+
+    def wait_for_resource(self, resource_id):
+        """Block until any prefetch of the resource's package has completed
+        (successfully or not).
+        """
+        if self.events.has_key(resource_id) and \
+           not self.events[resource_id].is_set():
+            logger.info("Waiting for prefetch of package for %s" % resource_id)
+            with tracing.span(resource_id, "prefetch_wait"):
+                # use a timeout so that we remain interruptable from the console
+                while not self.events[resource_id].wait(1.0):
+                    pass
@@ -0,0 +1,188 @@
+"""Manifests for incremental preprocessing. The resource definitions and
+software library are preprocessed on every install and deploy run, by
+merging many small json files (one per driver) into a single target file.
+The input files rarely change between runs, so we keep a manifest of the
+inputs next to the target (<target>.manifest), recording the size,
+modification time, and digest of each input file. If the inputs and their
+order are unchanged and the targets have not been touched since we wrote
+them, the preprocessing can be skipped entirely.
+
+We also keep the parsed json of each input in a fragment cache
+(<target>.fragments), so that when some inputs have changed, only those
+need to be re-read. The fragment cache is only read when regenerating, so
+the up-to-date check stays cheap.
+"""
+
+import os
+import os.path
+import hashlib
+import tempfile
+import threading
+import Queue
+
+import engage.utils.json_backend as json_backend
+
+MANIFEST_SUFFIX = ".manifest"
+FRAGMENTS_SUFFIX = ".fragments"
+MANIFEST_VERSION = 1
+
+# maximum number of threads used to load changed input files
+MAX_LOAD_THREADS = 8
+
+
+def _stat_signature(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime]
+
+
+def _file_digest(path):
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def _write_json_atomic(filename, data):
+    (fd, tmpname) = tempfile.mkstemp(dir=os.path.dirname(filename),
+                                     prefix="." + os.path.basename(filename))
+    f = os.fdopen(fd, "wb")
+    try:
+        json_backend.dump(data, f, compact=True)
+    finally:
+        f.close()
+    os.rename(tmpname, filename)
+
+
+def load_json_files(files, load_fn, max_threads=MAX_LOAD_THREADS):
+    """Call load_fn on each file, using up to max_threads threads. Returns a
+    map from file name to result. If any call raises an exception, the first
+    one (in file order) is re-raised.
+    """
+    results = {}
+    errors = {}
+    if len(files)<=1 or max_threads<=1:
+        for f in files:
+            results[f] = load_fn(f)
+        return results
+    q = Queue.Queue()
+    for f in files:
+        q.put(f)
+    def worker():
+        while True:
+            try:
+                f = q.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[f] = load_fn(f)
+            except Exception, e:
+                errors[f] = e
+    threads = [threading.Thread(target=worker, name="preprocess-load-%d" % i)
+               for i in range(min(max_threads, len(files)))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    for f in files:
+        if errors.has_key(f):
+            raise errors[f]
+    return results
+
+
+class InputManifest(object):
+    def __init__(self, target_file, params=None):
+        """params is a json-serializable value for any other settings which
+        affect the output (e.g. the installed extensions). If it changes,
+        the target is regenerated.
+        """
+        self.manifest_file = target_file + MANIFEST_SUFFIX
+        self.fragments_file = target_file + FRAGMENTS_SUFFIX
+        self.params = params
+        self.inputs = [] # list of input file names, in merge order
+        self.signatures = {} # map from input file to [size, mtime, digest]
+        self.targets = {} # map from target file to [size, mtime]
+        if os.path.exists(self.manifest_file):
+            try:
+                with open(self.manifest_file, "rb") as f:
+                    data = json_backend.load(f)
+                if data.get("version")==MANIFEST_VERSION and \
+                   data.get("params")==params:
+                    self.inputs = data["inputs"]
+                    self.signatures = data["signatures"]
+                    self.targets = data["targets"]
+            except (ValueError, KeyError, IOError):
+                pass # just regenerate
+
+    def is_unchanged(self, input_file):
+        """Return True if the input file is the same as when the manifest
+        was written. If only the modification time has changed, we compare
+        digests.
+        """
+        if not self.signatures.has_key(input_file):
+            return False
+        try:
+            sig = _stat_signature(input_file)
+        except OSError:
+            return False
+        (size, mtime, digest) = self.signatures[input_file]
+        if sig==[size, mtime]:
+            return True
+        elif sig[0]!=size:
+            return False
+        else:
+            return _file_digest(input_file)==digest
+
+    def is_up_to_date(self, input_files, target_files):
+        if list(input_files)!=self.inputs:
+            return False
+        for target in target_files:
+            if not self.targets.has_key(target) or \
+               not os.path.exists(target) or \
+               _stat_signature(target)!=self.targets[target]:
+                return False
+        for input_file in input_files:
+            if not self.is_unchanged(input_file):
+                return False
+        return True
+
+    def load_fragments(self, input_files, load_fn):
+        """Return a map from input file to its parsed contents, calling
+        load_fn only for the files which have changed since the manifest
+        was written. The changed files are loaded in parallel. Returns
+        (fragments, list of changed files).
+        """
+        cached = {}
+        if len(self.signatures)>0 and os.path.exists(self.fragments_file):
+            try:
+                with open(self.fragments_file, "rb") as f:
+                    cached = json_backend.load(f)
+            except (ValueError, IOError):
+                cached = {}
+        fragments = {}
+        changed = []
+        for input_file in input_files:
+            if cached.has_key(input_file) and self.is_unchanged(input_file):
+                fragments[input_file] = cached[input_file]
+            else:
+                changed.append(input_file)
+        fragments.update(load_json_files(changed, load_fn))
+        return (fragments, changed)
+
+    def save(self, input_files, fragments, target_files):
+        """Record the inputs and targets after regenerating the targets.
+        Problems writing the manifest are ignored, as it just means we will
+        regenerate next time.
+        """
+        signatures = {}
+        for input_file in input_files:
+            sig = _stat_signature(input_file)
+            signatures[input_file] = sig + [_file_digest(input_file)]
+        try:
+            _write_json_atomic(self.fragments_file, fragments)
+            _write_json_atomic(self.manifest_file,
+                               {"version":MANIFEST_VERSION,
+                                "params":self.params,
+                                "inputs":list(input_files),
+                                "signatures":signatures,
+                                "targets":dict([(t, _stat_signature(t))
+                                                for t in target_files])})
+        except (IOError, OSError):
+            pass
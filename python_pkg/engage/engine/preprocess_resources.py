@@ -22,6 +22,10 @@ from engage.utils.file import mangle_resource_key
 from engage.utils.user_error import UserError, EngageErrInf, convert_exc_to_user_error
 
 import engage_utils.resource_utils as ru
+import driver_registry
+import preprocess_manifest
+import engage.utils.json_backend as json_backend
+from engage.extensions import installed_extensions
 
 errors = { }
 
@@ -69,11 +73,57 @@ preinstalled_resource_checks = [
 ]
 
 
+def _load_resource_file(res_file):
+    """Read a resource definitions file, returning the parsed json.
+    """
+    with open(res_file, "rb") as rf:
+        try:
+            return json_backend.load(rf)
+        except ValueError, e:
+            raise Exception("JSON parsing error in %s: %s" % (res_file, e))
+
+
+def _get_fragment_resources(res_file, fragment):
+    """Extension and driver resource files can be a list of resource definitions
+    or a dict with a resource_definitions property.
+    """
+    if isinstance(fragment, list):
+        return fragment
+    elif isinstance(fragment, dict) and \
+         fragment.has_key('resource_definitions'):
+        return fragment['resource_definitions']
+    else:
+        raise Exception("Invalid format for resource file %s" % res_file)
+
+
+def get_resource_input_files(primary_resource_file, extension_resource_files,
+                             drivers_dir):
+    """Return the list of resource files to be merged, in order.
+    """
+    input_files = [primary_resource_file]
+    for f in extension_resource_files:
+        if os.path.exists(f):
+            input_files.append(f)
+    resource_group_dirs = ifilter(lambda f: \
+                                      os.path.isdir(os.path.join(drivers_dir, f)) and \
+                                      f!='genforma' and f!='data',
+                                  os.listdir(drivers_dir))
+    for group_dir in resource_group_dirs:
+        group_path = os.path.join(drivers_dir, group_dir)
+        for f in os.listdir(group_path):
+            res_file = os.path.join(os.path.join(group_path, f),
+                                    "resources.json")
+            if os.path.exists(res_file):
+                input_files.append(res_file)
+    return input_files
+
+
 def preprocess_resource_file(primary_resource_file, extension_resource_files,
                              target_resource_file, logger,
                              drivers_dir=os.path.abspath(
                                              os.path.join(os.path.dirname(__file__),
-                                                          "../drivers"))):
+                                                          "../drivers")),
+                             incremental=False):
     """Combine primary resource file with extension resource files and any resource
     files from individual drivers, generating target_resource_file. Resource files for
     individual drivers will be in grandchild directories of engage.drivers and will be
@@ -82,57 +132,65 @@ def preprocess_resource_file(primary_resource_file, extension_resource_files,
 
     Extension and driver-specific resource files can either be a list of resource
     definitions or can be a dict containig a resource_definitions property.
-    """
-    with open(primary_resource_file, "rb") as prf:
-        try:
-            resource_file = json.load(prf)
-        except ValueError, e:
-            raise Exception("JSON parsing error in %s: %s" % (primary_resource_file, e))
-    resources = resource_file['resource_definitions']
-    assert isinstance(resources, list)
 
-    def add_resources_in_file(res_file):
-        if os.path.exists(res_file):
-            logger.debug("Adding resources from %s/%s to master file." %
-                         (os.path.basename(os.path.dirname(res_file)),
-                          os.path.basename(res_file)))
-            with open(res_file, "rb") as rf:
-                try:
-                    driver_resources = json.load(rf)
-                except ValueError, e:
-                    raise Exception("JSON parsing error in %s: %s" % (res_file, e))
-            if isinstance(driver_resources, list):
-                resources.extend(driver_resources)
-            elif isinstance(driver_resources, dict) and \
-                 driver_resources.has_key('resource_definitions'):
-                resources.extend(driver_resources['resource_definitions'])
-            else:
-                raise Exception("Invalid format for resource file %s" % ref_file)
+    We also write the driver registry (see driver_registry.py) for the
+    resources to the same directory as target_resource_file.
 
-    for f in extension_resource_files:
-        add_resources_in_file(f)
-    resource_group_dirs = ifilter(lambda f: \
-                                      os.path.isdir(os.path.join(drivers_dir, f)) and \
-                                      f!='genforma' and f!='data',
-                                  os.listdir(drivers_dir))
-    for group_dir in resource_group_dirs:
-        group_path = os.path.join(drivers_dir, group_dir)
-        for f in os.listdir(group_path):
-            add_resources_in_file(os.path.join(os.path.join(group_path, f),
-                                               "resources.json"))
+    If incremental is True, we keep a manifest of the input files (see
+    preprocess_manifest.py). If no input has changed since the last run, we
+    leave the target alone. Otherwise, only the changed inputs are re-read.
+    """
+    input_files = get_resource_input_files(primary_resource_file,
+                                           extension_resource_files,
+                                           drivers_dir)
+    registry_file = driver_registry.get_registry_file(target_resource_file)
+    if incremental:
+        manifest = preprocess_manifest.InputManifest(
+                       target_resource_file,
+                       params={"drivers_dir":drivers_dir,
+                               "extensions":installed_extensions})
+        if manifest.is_up_to_date(input_files,
+                                  [target_resource_file, registry_file]):
+            logger.debug("Preprocessed resource file %s is up to date." %
+                         target_resource_file)
+            return
+        (fragments, changed) = manifest.load_fragments(input_files,
+                                                       _load_resource_file)
+    else:
+        manifest = None
+        fragments = preprocess_manifest.load_json_files(input_files,
+                                                        _load_resource_file)
+        changed = input_files
+    for f in changed:
+        if f==primary_resource_file:
+            continue
+        logger.debug("Adding resources from %s/%s to master file." %
+                     (os.path.basename(os.path.dirname(f)),
+                      os.path.basename(f)))
+
+    resource_file = fragments[primary_resource_file]
+    resources = list(resource_file['resource_definitions'])
+    assert isinstance(resources, list)
+    for f in input_files[1:]:
+        resources.extend(_get_fragment_resources(f, fragments[f]))
 
     with open(target_resource_file, "wb") as trf:
         trf.write(ru.pp_resource_defs([ru.ResourceDef.from_json(r) for r in resources],
                                       resource_file['resource_def_version']))
         trf.write("\n")
-                                  
+    driver_registry.write_registry([r['key'] for r in resources],
+                                   registry_file, drivers_dir)
+    if manifest:
+        manifest.save(input_files, fragments,
+                      [target_resource_file, registry_file])
+
 
 def parse_raw_install_spec_file(filename):
     """Parse the un-preprocessed install spec file and find the dynamic hosts.
     Returns the parsed json list.
     """
     with open(filename, "rb") as f:
-        json_data = json.load(f)
+        json_data = json_backend.load(f)
     if not isinstance(json_data, list):
         raise Exception("Invalid format for install spec file %s: expecting a list of resources" % filename)
     return json_data
@@ -225,7 +283,7 @@ def fixup_installed_resources_in_install_spec(json_data, inst_list):
 
 def validate_install_spec(install_spec_file):
     with open(install_spec_file, "rb") as f:
-        spec = json.load(f)
+        spec = json_backend.load(f)
     used_ids = set()
     for inst in spec:
         if inst["id"] in used_ids:
@@ -0,0 +1,221 @@
+"""Cache for the results of the is_installed() and is_running() probes of
+resource managers. Drivers often implement these probes by running
+subprocesses, making http requests, or querying databases, which gets
+expensive when a management tool (e.g. svcctl status) is run frequently.
+
+Cache entries are keyed by resource id and are only used if:
+ * the resource's metadata fingerprint is unchanged,
+ * the entry is younger than the time-to-live, and
+ * a cheap validator has not changed. For is_installed(), this is a stat
+   of the resource's home directory (if it has a config_port.home property).
+   For is_running(), this is a stat of the service's pid file (if any),
+   plus a check that the pid is still alive.
+
+Use CachedStateManager to wrap a resource manager. Calls which change the
+state of the resource (install, start, stop, etc.) invalidate the
+resource's cache entries. The cache can be persisted to a file, so that it
+is shared across invocations of a command line tool.
+
+Only the read-only svcctl commands (status, list, and plan) use the cache.
+Commands and tools which change resource state (svcctl start/stop/restart,
+install, upgrade, and backup/restore) act on the results of their probes,
+and a stale entry could make them skip a start, an install, or a stop. They
+call the managers directly and remove the cache file. Management backend
+registration (mgt_registration) does not probe resources at all.
+"""
+
+import os
+import os.path
+import errno
+import time
+import threading
+import tempfile
+
+import fixup_python_path
+from engage.utils.log_setup import setup_engine_logger
+import engage.utils.json_backend as json_backend
+from install_journal import get_fingerprint
+
+logger = setup_engine_logger(__name__)
+
+# default time-to-live for cache entries, in seconds
+DEFAULT_TTL = 30.0
+
+INSTALLED_PROBE = "installed"
+RUNNING_PROBE = "running"
+
+
+def _stat_validator(path):
+    try:
+        st = os.stat(path)
+        return [st.st_ino, st.st_mtime]
+    except OSError:
+        return None
+
+
+def _is_pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except OSError, e:
+        # EPERM means the process exists, but is owned by another user
+        return e.errno==errno.EPERM
+
+
+def _get_pidfile_validator(pidfile):
+    stat = _stat_validator(pidfile)
+    if stat==None:
+        return None
+    try:
+        with open(pidfile, "rb") as f:
+            pid = int(f.read().strip())
+    except (IOError, ValueError):
+        return stat
+    return stat + [pid, _is_pid_alive(pid)]
+
+
+def get_validator(mgr, probe):
+    """Return a json-serializable value that should change if the result of
+    the specified probe may have changed.
+    """
+    if probe==INSTALLED_PROBE:
+        home = mgr.metadata.config_port.get(u"home", None)
+        if isinstance(home, basestring):
+            return _stat_validator(home)
+    elif probe==RUNNING_PROBE and hasattr(mgr, "get_pid_file_path"):
+        pidfile = mgr.get_pid_file_path()
+        if pidfile:
+            return _get_pidfile_validator(pidfile)
+    return None
+
+
+class StateCache(object):
+    def __init__(self, filename=None, ttl=DEFAULT_TTL):
+        self.filename = filename
+        self.ttl = ttl
+        self.entries = {} # map from resource id to map from probe to entry
+        self.lock = threading.RLock()
+        self.dirty = False
+        if filename and os.path.exists(filename):
+            try:
+                with open(filename, "rb") as f:
+                    self.entries = json_backend.load(f)
+            except Exception, e:
+                logger.warning("Unable to read state cache file %s, ignoring: %s" %
+                               (filename, e))
+                self.entries = {}
+
+    def lookup(self, mgr, probe, probe_fn):
+        """Return the result of probe_fn (the manager's probe method),
+        using the cached value if it is still valid.
+        """
+        fingerprint = get_fingerprint(mgr.metadata)
+        with self.lock:
+            entry = self.entries.get(mgr.id, {}).get(probe, None)
+        if entry!=None and entry["fingerprint"]==fingerprint and \
+           (time.time()-entry["time"])<self.ttl and \
+           entry["validator"]==get_validator(mgr, probe):
+            logger.debug("State cache hit for %s probe of resource %s" %
+                         (probe, mgr.id))
+            return entry["value"]
+        value = probe_fn()
+        entry = {"fingerprint":fingerprint, "time":time.time(),
+                 "validator":get_validator(mgr, probe), "value":value}
+        with self.lock:
+            self.entries.setdefault(mgr.id, {})[probe] = entry
+            self.dirty = True
+        return value
+
+    def invalidate(self, resource_id):
+        with self.lock:
+            if self.entries.has_key(resource_id):
+                del self.entries[resource_id]
+                self.dirty = True
+
+    def clear(self):
+        with self.lock:
+            self.entries = {}
+            self.dirty = True
+
+    def save(self):
+        """Write the cache to its file, if it has changed. We write to a
+        temporary file and rename, so that concurrent readers always see a
+        complete file. Problems writing the file are logged, not raised.
+        """
+        with self.lock:
+            if self.filename==None or not self.dirty:
+                return
+            try:
+                (fd, tmpname) = tempfile.mkstemp(dir=os.path.dirname(self.filename),
+                                                 prefix=".state_cache")
+                f = os.fdopen(fd, "wb")
+                try:
+                    json_backend.dump(self.entries, f, compact=True)
+                finally:
+                    f.close()
+                os.rename(tmpname, self.filename)
+                self.dirty = False
+            except (IOError, OSError), e:
+                logger.warning("Unable to write state cache file %s: %s" %
+                               (self.filename, e))
+
+
+def remove_cache_file(filename):
+    """Remove a persisted state cache. This should be done by any tool
+    which changes resource state without going through a CachedStateManager
+    (e.g. the install engine).
+    """
+    if os.path.exists(filename):
+        os.remove(filename)
+
+
+class CachedStateManager(object):
+    """Proxy for a resource manager that answers is_installed() and
+    is_running() from a StateCache. Delegates all other calls to the
+    underlying manager.
+    """
+    def __init__(self, mgr, cache):
+        self.__dict__["_mgr"] = mgr
+        self.__dict__["_cache"] = cache
+
+    def __getattr__(self, attrib):
+        return getattr(self._mgr, attrib)
+
+    def __setattr__(self, attrib, value):
+        setattr(self._mgr, attrib, value)
+
+    def is_installed(self):
+        return self._cache.lookup(self._mgr, INSTALLED_PROBE,
+                                  self._mgr.is_installed)
+
+    def is_running(self):
+        return self._cache.lookup(self._mgr, RUNNING_PROBE,
+                                  self._mgr.is_running)
+
+    def _invalidating_call(self, method_name, *args, **kwargs):
+        self._cache.invalidate(self._mgr.id)
+        try:
+            return getattr(self._mgr, method_name)(*args, **kwargs)
+        finally:
+            self._cache.invalidate(self._mgr.id)
+
+    def install(self, *args, **kwargs):
+        return self._invalidating_call("install", *args, **kwargs)
+
+    def uninstall(self, *args, **kwargs):
+        return self._invalidating_call("uninstall", *args, **kwargs)
+
+    def upgrade(self, *args, **kwargs):
+        return self._invalidating_call("upgrade", *args, **kwargs)
+
+    def restore(self, *args, **kwargs):
+        return self._invalidating_call("restore", *args, **kwargs)
+
+    def start(self, *args, **kwargs):
+        return self._invalidating_call("start", *args, **kwargs)
+
+    def stop(self, *args, **kwargs):
+        return self._invalidating_call("stop", *args, **kwargs)
+
+    def force_stop(self, *args, **kwargs):
+        return self._invalidating_call("force_stop", *args, **kwargs)
@@ -4,6 +4,9 @@ from optparse import OptionParser
 import json
 import os.path
 import copy
+import time
+import threading
+import Queue
 from itertools import ifilter
 
 # fix path if necessary (if running from source or running as test)
@@ -18,9 +21,11 @@ except:
 from engage.drivers.resource_metadata import parse_resource_from_json
 from engage.utils.log_setup import add_log_option, parse_log_options, setup_engage_logger
 import install_plan
+import dag_runner
 from engage_file_layout import get_engine_layout_mgr
 from cmdline_script_utils import add_standard_cmdline_options, process_standard_options, \
                                  get_mgrs_and_pkgs
+import state_cache
 
 class CommandError(Exception):
     pass
@@ -31,37 +36,109 @@ STATUS_STOPPED = "Stopped"
 STATUS_NOT_INSTALLED = "Not installed"
 STATUS_INSTALLED = "Installed" # used only when not a service
 STATUS_UNAVAILABLE = "Unavailable"
+STATUS_TIMEOUT = "Unknown (timeout)"
+STATUS_ERROR = "Unknown (error)"
 
-def get_service_status(rm, resource_map, status_cache_map):
-    """Get the status of the service associated with
-    the resource manager. If the containing service is
-    not up, the status request could fail. To address this,
-    we check the containing service first and, if it is not up,
-    report the status as the inner service as unavalable. The
-    status_cache_map parameter is a map from resource ids to statuses.
-    It is updated by get_service_status() with any status values it
-    obtains (including recursive calls).
+def _probe_status(rm):
+    """Get the status of a single resource, assuming that its container
+    is available.
     """
-    if rm.metadata.inside!=None:
-        inside_id = rm.metadata.inside.id
-        if not status_cache_map.has_key(inside_id):
-            # obtain the status of the containing resource
-            get_service_status(resource_map[inside_id], resource_map,
-                               status_cache_map)
-        if not (status_cache_map[inside_id]==STATUS_RUNNING or
-                status_cache_map[inside_id]==STATUS_INSTALLED):
-            status_cache_map[rm.metadata.id] = STATUS_UNAVAILABLE
-            return STATUS_UNAVAILABLE
-    
     if rm.is_installed()==False:
-        status_cache_map[rm.metadata.id] = STATUS_NOT_INSTALLED
+        return STATUS_NOT_INSTALLED
     elif not rm.is_service():
-        status_cache_map[rm.metadata.id] = STATUS_INSTALLED
+        return STATUS_INSTALLED
     elif rm.is_running()==False:
-        status_cache_map[rm.metadata.id] = STATUS_STOPPED
+        return STATUS_STOPPED
     else:
-        status_cache_map[rm.metadata.id] = STATUS_RUNNING
-    return status_cache_map[rm.metadata.id]
+        return STATUS_RUNNING
+
+
+def _status_probe_worker(rm, result_queue):
+    start_time = time.time()
+    try:
+        status = _probe_status(rm)
+        error = None
+    except Exception, e:
+        status = STATUS_ERROR
+        error = "%s(%s)" % (e.__class__.__name__, e)
+    result_queue.put((rm.metadata.id, status, time.time()-start_time, error))
+
+
+def get_service_statuses(target_ids, resource_map, num_workers=1,
+                         timeout=None):
+    """Get the status of each resource in target_ids (which should be in
+    dependency order), running up to num_workers probes concurrently.
+    If the containing service of a resource is not up, the status request
+    for the resource could fail. Thus, a resource is only probed once its
+    containing resource is known to be installed or running, and is
+    otherwise reported as STATUS_UNAVAILABLE. If timeout is specified,
+    any probe which takes longer than timeout seconds is reported as
+    STATUS_TIMEOUT (the probe thread is abandoned). Returns a map from
+    resource id to a (status, latency, error) tuple, where latency is the time
+    taken by the probe in seconds and error is an error message or None.
+    """
+    # add the containers of the targets, as we need their status too
+    needed = []
+    needed_set = set()
+    def add_needed(resource_id):
+        if resource_id in needed_set:
+            return
+        inside = resource_map[resource_id].metadata.inside
+        if inside!=None:
+            add_needed(inside.id)
+        needed.append(resource_id)
+        needed_set.add(resource_id)
+    for resource_id in target_ids:
+        add_needed(resource_id)
+
+    results = {}
+    result_queue = Queue.Queue()
+    in_flight = {} # map from resource id to probe deadline
+    pending = needed
+    while len(pending)>0 or len(in_flight)>0:
+        still_pending = []
+        for resource_id in pending:
+            rm = resource_map[resource_id]
+            inside = rm.metadata.inside
+            if inside!=None and not results.has_key(inside.id):
+                still_pending.append(resource_id)
+            elif inside!=None and \
+                 results[inside.id][0] not in (STATUS_RUNNING, STATUS_INSTALLED):
+                results[resource_id] = (STATUS_UNAVAILABLE, 0.0, None)
+            elif len(in_flight)<num_workers:
+                t = threading.Thread(target=_status_probe_worker,
+                                     args=(rm, result_queue),
+                                     name="status-probe-%s" % resource_id)
+                t.daemon = True
+                t.start()
+                if timeout!=None:
+                    in_flight[resource_id] = time.time() + timeout
+                else:
+                    in_flight[resource_id] = None
+            else:
+                still_pending.append(resource_id)
+        pending = still_pending
+        if len(in_flight)==0:
+            continue
+        deadlines = [d for d in in_flight.values() if d!=None]
+        if len(deadlines)>0:
+            wait_time = max(min(deadlines)-time.time(), 0.0)
+        else:
+            wait_time = None
+        try:
+            # use a bounded wait so that we remain interruptable from the console
+            (resource_id, status, latency, error) = \
+                result_queue.get(True, min(wait_time, 1.0) if wait_time!=None else 1.0)
+            if in_flight.has_key(resource_id): # ignore probes that timed out
+                del in_flight[resource_id]
+                results[resource_id] = (status, latency, error)
+        except Queue.Empty:
+            now = time.time()
+            for (resource_id, deadline) in in_flight.items():
+                if deadline!=None and now>=deadline:
+                    del in_flight[resource_id]
+                    results[resource_id] = (STATUS_TIMEOUT, timeout, None)
+    return results
 
 
 def dummy(command, command_args, mgr_pkg_list, resource_map, logger):
@@ -80,26 +157,80 @@ def list_resources(command, command_args, mgr_pkg_list, resource_map, logger, dr
     return 0
 
 
-def status(command, command_args, mgr_pkg_list, resource_map, logger, dry_run):
-    status_cache = {}
-    def print_status(rm):
-        if not dry_run:
-            status = get_service_status(rm, resource_map, status_cache)
-            print "%s (%s) Status: %s" % \
-                  (rm.id, rm.package_name, status)
-        else:
-            print "%s (%s) [dry_run]" % (rm.id, rm.package_name)
-
+def status(command, command_args, mgr_pkg_list, resource_map, logger, dry_run,
+           num_workers=1, timeout=None, format="text"):
     if len(command_args)==0 or command_args==["all"]:
-        for (mgr, pkg) in mgr_pkg_list:
-            if mgr.is_service():
-                print_status(mgr)
+        target_ids = [mgr.id for (mgr, pkg) in mgr_pkg_list if mgr.is_service()]
     else:
         for resource_id in command_args:
+            if not resource_map.has_key(resource_id):
+                raise CommandError("Unknown resource %s" % resource_id)
+        target_ids = command_args
+
+    if dry_run:
+        for resource_id in target_ids:
+            rm = resource_map[resource_id]
+            print "%s (%s) [dry_run]" % (rm.id, rm.package_name)
+        return 0
+
+    results = get_service_statuses(target_ids, resource_map,
+                                   num_workers=num_workers, timeout=timeout)
+    if format=="json":
+        status_list = []
+        for resource_id in target_ids:
+            rm = resource_map[resource_id]
+            (status, latency, error) = results[resource_id]
+            entry = {"id":rm.id, "package":rm.package_name, "status":status,
+                     "latency":round(latency, 3)}
+            if error:
+                entry["error"] = error
+            status_list.append(entry)
+        print json.dumps(status_list, indent=2, sort_keys=True,
+                         separators=(",", ": "))
+    else:
+        for resource_id in target_ids:
             rm = resource_map[resource_id]
-            print_status(rm)
+            (status, latency, error) = results[resource_id]
+            if error:
+                print "%s (%s) Status: %s %s" % (rm.id, rm.package_name, status, error)
+            else:
+                print "%s (%s) Status: %s" % (rm.id, rm.package_name, status)
     return 0
 
+_print_lock = threading.Lock()
+
+def _print(msg):
+    """Print a line of output. We use a lock, as start and stop may be
+    running in multiple threads.
+    """
+    with _print_lock:
+        sys.stdout.write(msg + "\n")
+        sys.stdout.flush()
+
+
+def _get_predecessors(mgr_list, all_resources, reverse=False):
+    """Return a map from each resource id in mgr_list to the ids of the
+    resources in mgr_list which it depends on. If reverse is True, the map
+    is instead to the resources which depend on it (used when stopping).
+    all_resources should be the full list of resource metadata objects, so
+    that dependencies can be resolved.
+    """
+    ids = set([mgr.id for mgr in mgr_list])
+    dependencies = install_plan.get_resource_dependencies(all_resources)
+    predecessors = {}
+    for mgr in mgr_list:
+        predecessors[mgr.id] = []
+    for mgr in mgr_list:
+        for dep_id in dependencies[mgr.id]:
+            if dep_id not in ids:
+                continue
+            if reverse:
+                predecessors[dep_id].append(mgr.id)
+            else:
+                predecessors[mgr.id].append(dep_id)
+    return predecessors
+
+
 def _filter_mgr_pkg_list(mgr_pkg_list, filter_fn, target_res_id_list):
     """The filter function takes two resource lists: the set of all resources
     (obtained from mgr_pkg_list) and the set of target resources. It should
@@ -118,26 +249,39 @@ def _stop_mgr(mgr, dry_run, force):
     if not dry_run:
         if mgr.is_running():
             if force:
-                print "Attempting to force stop %s" % mgr.id
+                _print("Attempting to force stop %s" % mgr.id)
                 result = mgr.force_stop()
                 if result:
-                    print "%s stopped successfully." % mgr.id
+                    _print("%s stopped successfully." % mgr.id)
                 else:
-                    print "Unable to force stop %s" % mgr.id
+                    _print("Unable to force stop %s" % mgr.id)
                     return False
             else:
                 mgr.stop()
-                print "%s stopped." % mgr.id
+                _print("%s stopped." % mgr.id)
         else:
-            print "%s already stopped." % mgr.id
+            _print("%s already stopped." % mgr.id)
             
     else:
-        print "%s: stop if not already stopped [dry-run]" % mgr.id
+        _print("%s: stop if not already stopped [dry-run]" % mgr.id)
     return True
 
 
-def stop(command, command_args, mgr_pkg_list, resource_map, logger, dry_run, force=False):
-    had_errors = False
+def _stop_mgrs(mgr_list, all_resources, dry_run, force, num_workers):
+    """Stop the services in mgr_list, which should be in reverse dependency
+    order. A service is stopped once all the services which depend on it have
+    been stopped. Returns True if all the stops were successful.
+    """
+    results = dag_runner.run_in_dependency_order(
+                  mgr_list, [mgr.id for mgr in mgr_list],
+                  _get_predecessors(mgr_list, all_resources, reverse=True),
+                  lambda mgr: _stop_mgr(mgr, dry_run, force),
+                  num_workers, thread_name="svcctl-worker")
+    return False not in results
+
+
+def stop(command, command_args, mgr_pkg_list, resource_map, logger, dry_run, force=False,
+         num_workers=1):
     if len(command_args)==0:
         target_resource_ids = ["all"]
     else:
@@ -146,9 +290,7 @@ def stop(command, command_args, mgr_pkg_list, resource_map, logger, dry_run, for
     reversed_mgr_pkg_list = copy.copy(mgr_pkg_list)
     reversed_mgr_pkg_list.reverse()
     if target_resource_ids == ["all"]:
-        for (mgr, pkg) in reversed_mgr_pkg_list:
-            ok = _stop_mgr(mgr, dry_run, force)
-            if not ok: had_errors = True
+        filtered_list = reversed_mgr_pkg_list
     else:
         filtered_list = _filter_mgr_pkg_list(reversed_mgr_pkg_list,
                                              install_plan.get_transitive_resources_depending_on_resource,
@@ -156,10 +298,10 @@ def stop(command, command_args, mgr_pkg_list, resource_map, logger, dry_run, for
         for (mgr, pkg) in filtered_list:
             if not mgr.is_service() and mgr.id in target_resource_ids:
                 print "%s is not a service" % mgr.id
-                continue
-            ok = _stop_mgr(mgr, dry_run, force)
-            if not ok: had_errors = True
-    return 1 if had_errors else 0
+    ok = _stop_mgrs([mgr for (mgr, pkg) in filtered_list],
+                    [mgr.metadata for (mgr, pkg) in mgr_pkg_list],
+                    dry_run, force, num_workers)
+    return 0 if ok else 1
 
 
 def _start_mgr(mgr, dry_run):
@@ -167,21 +309,32 @@ def _start_mgr(mgr, dry_run):
     if not dry_run:
         if not mgr.is_running():
             mgr.start()
-            print "Started %s." % mgr.id
+            _print("Started %s." % mgr.id)
         else:
-            print "%s already started." % mgr.id
+            _print("%s already started." % mgr.id)
     else:
-        print "%s: check if running and start if not already running [dry-run]" % mgr.id
+        _print("%s: check if running and start if not already running [dry-run]" % mgr.id)
+
+
+def _start_mgrs(mgr_list, all_resources, dry_run, num_workers):
+    """Start the services in mgr_list, which should be in dependency order.
+    A service is started once all of its dependencies have been started.
+    """
+    dag_runner.run_in_dependency_order(mgr_list, [mgr.id for mgr in mgr_list],
+                                       _get_predecessors(mgr_list, all_resources),
+                                       lambda mgr: _start_mgr(mgr, dry_run),
+                                       num_workers, thread_name="svcctl-worker")
+
     
-def start(command, command_args, mgr_pkg_list, resource_map, logger, dry_run):
+def start(command, command_args, mgr_pkg_list, resource_map, logger, dry_run,
+          num_workers=1):
     if len(command_args)==0:
         target_resource_ids = ["all"]
     else:
         target_resource_ids = command_args[0:]
 
     if target_resource_ids == ["all"]:
-        for (mgr, pkg) in mgr_pkg_list:
-            _start_mgr(mgr, dry_run)
+        filtered_list = mgr_pkg_list
     else:
         filtered_list = _filter_mgr_pkg_list(mgr_pkg_list,
                                              install_plan.get_transitive_dependencies_for_resource,
@@ -189,21 +342,58 @@ def start(command, command_args, mgr_pkg_list, resource_map, logger, dry_run):
         for (mgr, pkg) in filtered_list:
             if not mgr.is_service() and mgr.id in target_resource_ids:
                 print "%s is not a service." % mgr.id
-                continue
-            _start_mgr(mgr, dry_run)
+    _start_mgrs([mgr for (mgr, pkg) in filtered_list],
+                [mgr.metadata for (mgr, pkg) in mgr_pkg_list],
+                dry_run, num_workers)
     return 0
 
 
-def restart(command, command_args, mgr_pkg_list, resource_map, logger, dry_run, force=False):
+def restart(command, command_args, mgr_pkg_list, resource_map, logger, dry_run, force=False,
+            num_workers=1):
+    """Restart the specified services (or all services if none are specified).
+    We stop the services and everything that depends on them, dependents
+    first, and then start them again in dependency order. Services which the
+    targets depend on are left running.
+    """
+    if len(command_args)==0 or command_args==["all"]:
+        filtered_list = mgr_pkg_list
+    else:
+        for resource_id in command_args:
+            if not resource_map.has_key(resource_id):
+                raise CommandError("Unknown resource %s" % resource_id)
+        filtered_list = _filter_mgr_pkg_list(mgr_pkg_list,
+                                             install_plan.get_transitive_resources_depending_on_resource,
+                                             command_args)
+    mgr_list = [mgr for (mgr, pkg) in filtered_list]
+    all_resources = [mgr.metadata for (mgr, pkg) in mgr_pkg_list]
+    reversed_mgr_list = copy.copy(mgr_list)
+    reversed_mgr_list.reverse()
+    ok = _stop_mgrs(reversed_mgr_list, all_resources, dry_run, force, num_workers)
+    _start_mgrs(mgr_list, all_resources, dry_run, num_workers)
+    return 0 if ok else 1
+
+
+def plan(command, command_args, mgr_pkg_list, resource_map, logger, dry_run,
+         explain=False, num_workers=1, costs_file=None):
+    """Print the critical-path install plan for the resources, using the
+    install times recorded in costs_file. If explain is True, also print
+    the estimated cost of each resource and the predicted makespan when
+    installing with num_workers parallel workers.
+    """
     if len(command_args)>0:
-        raise Exception("Restart does not take any extra command arguments")
-    reversed_mgr_pkg_list = copy.copy(mgr_pkg_list)
-    reversed_mgr_pkg_list.reverse()
-    for (mgr, pkg) in reversed_mgr_pkg_list:
-        _stop_mgr(mgr, dry_run, force)
-
-    for (mgr, pkg) in mgr_pkg_list:
-        _start_mgr(mgr, dry_run)
+        raise CommandError("Plan does not take any extra command arguments")
+    if costs_file:
+        costs = install_plan.load_install_costs(costs_file)
+    else:
+        costs = {}
+    cost_plan = install_plan.create_critical_path_plan([mgr.metadata for (mgr, pkg) in mgr_pkg_list],
+                                                       costs)
+    if explain:
+        for line in cost_plan.explain(num_workers):
+            print line
+    else:
+        for r in cost_plan.resources:
+            print "%s (%s)" % (r.id, _format_key(r.key))
     return 0
 
 
@@ -212,17 +402,27 @@ commands = {
  "stop":stop,
  "status":status,
  "list":list_resources,
- "restart":restart
+ "restart":restart,
+ "plan":plan
 }
 
 valid_commands = commands.keys()
 
+# Commands which do not change the state of the resources. Only these answer
+# their is_installed() and is_running() checks from the state cache. The
+# other commands act on the results of their checks (e.g. a service is not
+# started if it appears to be running), so they probe the resources directly
+# and remove the cache file, as they change the resources' state.
+read_only_commands = ["status", "list", "plan"]
+
 usage_msg = """usage: %prog [options] command command_args
 Valid commands:
-  start  <resource id>
-  stop   <resource id>
-  status <resource id>
-  list"""
+  start   <resource id>
+  stop    <resource id>
+  restart <resource id>
+  status [--parallel N] [--timeout SECS] [--format text|json] <resource id>
+  list
+  plan"""
 
 def main():
     parser = OptionParser(usage=usage_msg)
@@ -236,6 +436,25 @@ def main():
     parser.add_option("--dry-run", dest="dry_run", default=False,
                       action="store_true",
                       help="If specified, just print what would be done")
+    parser.add_option("--explain", dest="explain", default=False,
+                      action="store_true",
+                      help="If plan, show the estimated install time of each resource and the predicted makespan")
+    parser.add_option("--parallel", dest="parallel", type="int", default=1,
+                      metavar="N",
+                      help="If start, stop, or restart, number of services to start or stop concurrently, respecting dependencies. If status, number of resources to check concurrently. If plan, number of parallel install workers to assume (defaults to 1)")
+    parser.add_option("--timeout", dest="timeout", type="float", default=None,
+                      metavar="SECS",
+                      help="If status, report resources whose status check takes longer than SECS seconds as '%s'" %
+                           STATUS_TIMEOUT)
+    parser.add_option("--format", dest="format", default="text",
+                      help="If status, output format: text or json (defaults to text)")
+    parser.add_option("--no-state-cache", dest="use_state_cache", default=True,
+                      action="store_false",
+                      help="If status, list, or plan, always run the installed and running checks of resources, rather than using cached results")
+    parser.add_option("--state-cache-ttl", dest="state_cache_ttl", type="float",
+                      default=state_cache.DEFAULT_TTL, metavar="SECS",
+                      help="Maximum age, in seconds, of cached resource states (defaults to %.0f)" %
+                           state_cache.DEFAULT_TTL)
     (options, args) = parser.parse_args()
 
     if len(args)==0:
@@ -259,34 +478,75 @@ def main():
 
     logger = setup_engage_logger(__name__)
     
-    mgr_pkg_list = get_mgrs_and_pkgs(file_layout, deployment_home, options, installed_resources_file)
-    resource_map = {}
-    for (mgr, pkg) in mgr_pkg_list:
-        resource_map[mgr.id] = mgr
-
     command = args[0]
     if command not in commands.keys():
         sys.stderr.write("Error: invalid command %s\n" % command)
         parser.print_help()
         sys.exit(1)
 
+    state_cache_file = file_layout.get_state_cache_file(deployment_home)
+    changes_state = command not in read_only_commands and not options.dry_run
+    if changes_state:
+        state_cache.remove_cache_file(state_cache_file)
+        cache = None
+    elif options.use_state_cache and not options.dry_run:
+        cache = state_cache.StateCache(state_cache_file,
+                                       ttl=options.state_cache_ttl)
+    else:
+        cache = None
+    mgr_pkg_list = get_mgrs_and_pkgs(file_layout, deployment_home, options, installed_resources_file,
+                                     state_cache=cache)
+    resource_map = {}
+    for (mgr, pkg) in mgr_pkg_list:
+        resource_map[mgr.id] = mgr
+
     if options.force and command not in ['stop', 'restart']:
         sys.stderr.write("Error: --force option not valid for command %s\n" % command)
         parser.print_help()
         sys.exit(1)
 
+    if options.explain and command!='plan':
+        sys.stderr.write("Error: --explain option not valid for command %s\n" % command)
+        parser.print_help()
+        sys.exit(1)
+    if options.parallel<1:
+        parser.error("Value for --parallel must be at least 1")
+    if options.timeout!=None and options.timeout<=0:
+        parser.error("Value for --timeout must be positive")
+    if options.format not in ["text", "json"]:
+        parser.error("Value for --format must be text or json")
+
     command_args = args[1:]
     cmd_fn = commands[command]
     try:
         if command in ['stop', 'restart']:
             rc = cmd_fn(command, command_args, mgr_pkg_list, resource_map, logger,
-                   options.dry_run, force=options.force)
+                   options.dry_run, force=options.force, num_workers=options.parallel)
+        elif command=='start':
+            rc = cmd_fn(command, command_args, mgr_pkg_list, resource_map, logger,
+                        options.dry_run, num_workers=options.parallel)
+        elif command=='status':
+            rc = cmd_fn(command, command_args, mgr_pkg_list, resource_map, logger,
+                        options.dry_run, num_workers=options.parallel,
+                        timeout=options.timeout, format=options.format)
+        elif command=='plan':
+            rc = cmd_fn(command, command_args, mgr_pkg_list, resource_map, logger,
+                        options.dry_run, explain=options.explain,
+                        num_workers=options.parallel,
+                        costs_file=file_layout.get_install_costs_file(deployment_home))
         else:
             rc = cmd_fn(command, command_args, mgr_pkg_list, resource_map, logger,
                         options.dry_run)
     except CommandError, msg:
         sys.stderr.write("Error: %s\n" % msg)
         sys.exit(1)
+    finally:
+        if cache:
+            cache.save()
+        elif changes_state:
+            # a status command may have cached the state while we were
+            # running
+            state_cache.remove_cache_file(state_cache_file)
 
     sys.exit(rc)
     
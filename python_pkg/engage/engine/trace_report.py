@@ -0,0 +1,166 @@
+"""Summarize the trace files written when running with the --trace option
+(see engage.utils.trace). We report where the time went: by category of span
+(resource overhead, actions, sudo actions, and sleeping in poll loops), by
+action, and by resource.
+"""
+import sys
+import os.path
+from optparse import OptionParser
+import glob
+
+import engage_file_layout
+import cmdline_script_utils
+import engage.utils.trace as tracing
+
+
+def _compute_self_times(events):
+    """Given a list of complete ("X") events, return a list of
+    (event, self_time) pairs, where self_time is the event's duration
+    minus the durations of the spans nested directly inside it. Spans
+    only nest within the same process and thread.
+    """
+    by_thread = {}
+    for e in events:
+        by_thread.setdefault((e.get("pid"), e.get("tid")), []).append(e)
+    results = []
+    for thread_events in by_thread.values():
+        # sort parents before their children
+        thread_events.sort(key=lambda e: (e["ts"], -e["dur"]))
+        stack = [] # list of [event, self_time]
+        for e in thread_events:
+            while len(stack)>0 and \
+                  e["ts"]>=(stack[-1][0]["ts"]+stack[-1][0]["dur"]):
+                results.append(tuple(stack.pop()))
+            if len(stack)>0:
+                stack[-1][1] -= e["dur"]
+            stack.append([e, e["dur"]])
+        while len(stack)>0:
+            results.append(tuple(stack.pop()))
+    return results
+
+
+def _group_name(e):
+    args = e.get("args", {})
+    if e["cat"]=="poll_sleep":
+        return "sleep (%s)" % args.get("action", "?")
+    else:
+        return e["name"]
+
+
+def summarize(events):
+    """Given the events from one or more trace files, return a dict with
+    the following properties (all times are in seconds):
+     wall_clock    - time from the first span start to the last span end
+     by_category   - map from category to total self time
+     by_action     - list of (name, total self time, count), sorted by time
+     by_resource   - list of (resource id, total time), sorted by time
+
+    >>> events = [
+    ...   {"ph":"X", "name":"mysql", "cat":"resource", "ts":0, "dur":10000000,
+    ...    "pid":1, "tid":1, "args":{}},
+    ...   {"ph":"X", "name":"apt_install", "cat":"sudo_action", "ts":1000000,
+    ...    "dur":6000000, "pid":1, "tid":1, "args":{"resource":"mysql"}},
+    ...   {"ph":"X", "name":"sleep", "cat":"poll_sleep", "ts":7000000,
+    ...    "dur":2000000, "pid":1, "tid":1, "args":{"action":"check_port"}},
+    ...   {"ph":"M", "name":"thread_name", "pid":1, "tid":1, "args":{}}]
+    >>> s = summarize(events)
+    >>> s["wall_clock"]
+    10.0
+    >>> sorted(s["by_category"].items())
+    [('poll_sleep', 2.0), ('resource', 2.0), ('sudo_action', 6.0)]
+    >>> s["by_action"]
+    [('apt_install', 6.0, 1), ('sleep (check_port)', 2.0, 1)]
+    >>> s["by_resource"]
+    [('mysql', 10.0)]
+    """
+    complete = [e for e in events if e.get("ph")=="X"]
+    if len(complete)==0:
+        return {"wall_clock":0.0, "by_category":{}, "by_action":[],
+                "by_resource":[]}
+    start = min([e["ts"] for e in complete])
+    end = max([e["ts"]+e["dur"] for e in complete])
+    by_category = {}
+    action_times = {}
+    action_counts = {}
+    resource_times = {}
+    for (e, self_time) in _compute_self_times(complete):
+        secs = self_time/1000000.0
+        by_category[e["cat"]] = by_category.get(e["cat"], 0.0) + secs
+        if e["cat"]=="resource":
+            resource_times[e["name"]] = resource_times.get(e["name"], 0.0) + \
+                                        e["dur"]/1000000.0
+        elif e["cat"]!="phase":
+            name = _group_name(e)
+            action_times[name] = action_times.get(name, 0.0) + secs
+            action_counts[name] = action_counts.get(name, 0) + 1
+    by_action = [(name, action_times[name], action_counts[name])
+                 for name in action_times.keys()]
+    by_action.sort(key=lambda (name, secs, cnt): (-secs, name))
+    by_resource = resource_times.items()
+    by_resource.sort(key=lambda (name, secs): (-secs, name))
+    return {"wall_clock":(end-start)/1000000.0,
+            "by_category":by_category,
+            "by_action":by_action,
+            "by_resource":by_resource}
+
+
+def print_report(summary, top=10, stream=sys.stdout):
+    wall_clock = summary["wall_clock"]
+    def pct(secs):
+        if wall_clock>0:
+            return 100.0*secs/wall_clock
+        else:
+            return 0.0
+    stream.write("Wall clock time: %.1fs\n" % wall_clock)
+    stream.write("(percentages are of wall clock time, and may exceed 100%% if resources were installed in parallel)\n\n")
+    stream.write("Time by category (excluding nested spans):\n")
+    for (cat, secs) in sorted(summary["by_category"].items(),
+                              key=lambda (cat, secs): -secs):
+        stream.write("  %-30s %9.1fs %5.1f%%\n" % (cat, secs, pct(secs)))
+    stream.write("\nTop %d actions (excluding nested spans):\n" % top)
+    for (name, secs, cnt) in summary["by_action"][0:top]:
+        stream.write("  %-30s %9.1fs %5.1f%% %6d calls\n" %
+                     (name, secs, pct(secs), cnt))
+    stream.write("\nTop %d resources:\n" % top)
+    for (name, secs) in summary["by_resource"][0:top]:
+        stream.write("  %-30s %9.1fs %5.1f%%\n" % (name, secs, pct(secs)))
+
+
+def find_latest_trace_file(log_directory):
+    files = glob.glob(os.path.join(log_directory,
+                                   "*" + tracing.TRACE_FILE_SUFFIX))
+    if len(files)==0:
+        return None
+    files.sort(key=lambda f: os.path.getmtime(f))
+    return files[-1]
+
+
+def main(argv=sys.argv[1:]):
+    parser = OptionParser(usage='usage: %prog [options] [trace_file ...]')
+    parser.add_option("--top", "-t", dest="top", type="int", default=10,
+                      help="Number of actions and resources to list. Default is 10")
+    parser.add_option("--deployment-home", "-d", dest="deployment_home",
+                      default=None,
+                      help="Location of deployed application - used to find the latest trace file if none is specified")
+    (options, args) = parser.parse_args(args=argv)
+    if len(args)==0:
+        efl = engage_file_layout.get_engine_layout_mgr()
+        cmdline_script_utils.get_deployment_home(options, parser, efl,
+                                                 allow_overrides=True)
+        trace_file = find_latest_trace_file(efl.get_log_directory())
+        if not trace_file:
+            parser.error("No trace files found in %s - run with --trace to create one" %
+                         efl.get_log_directory())
+        args = [trace_file]
+    events = []
+    for trace_file in args:
+        if not os.path.exists(trace_file):
+            parser.error("Trace file %s does not exist" % trace_file)
+        print "Reading trace file %s" % trace_file
+        events.extend(tracing.read_trace_file(trace_file))
+    print_report(summarize(events), top=options.top)
+    return 0
+
+
+if __name__=="__main__":
+    sys.exit(main())
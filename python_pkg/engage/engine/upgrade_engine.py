@@ -5,6 +5,7 @@ import sys
 import cmdline_script_utils
 from engage.drivers.resource_metadata import parse_install_soln
 from install_sequencer import get_install_target_mgr
+import state_cache
 from engage.utils.log_setup import setup_engage_logger
 logger = setup_engage_logger(__name__)
 
@@ -79,6 +80,9 @@ class UpgradeRollbackInProgress(UserError):
 def upgrade(backup_dir, file_layout, deployment_home, options,
             atomic_upgrade=True):
     old_resources = get_old_resources(backup_dir)
+    # The upgrade changes the state of the resources, so we remove svcctl's
+    # state cache, and don't use one for our own probes.
+    state_cache.remove_cache_file(file_layout.get_state_cache_file(deployment_home))
     mgrs_and_pkgs = cmdline_script_utils.get_mgrs_and_pkgs(file_layout,
                                                            deployment_home,
                                                            options,
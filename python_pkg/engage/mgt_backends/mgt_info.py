@@ -1,6 +1,6 @@
 """Classes for representing system management information.
 """
-import json
+import engage.utils.json_backend as json_backend
 from itertools import ifilter
 
 class ServiceInfo(object):
@@ -23,7 +23,7 @@ class ServiceInfo(object):
                 "pidfile":self.pidfile}
     
     def __str__(self):
-        return json.dumps(self.to_json())
+        return json_backend.dumps(self.to_json())
         
 
 class ManagementInfo(object):
@@ -109,7 +109,7 @@ class ManagementInfo(object):
                 "services": [svc.to_json() for svc in self.services]}
 
     def __str__(self):
-        return json.dumps(self.to_json(), indent=2)
+        return json_backend.dumps(self.to_json(), indent=2)
 
     def with_only_pidfile_services(self):
         """Return another ManagementInfo object that only
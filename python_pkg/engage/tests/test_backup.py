@@ -0,0 +1,62 @@
+import gzip
+import os
+import os.path
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+import engage.utils.backup as backup
+
+
+class TestParallelGzip(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _write(self, chunks, block_size):
+        path = os.path.join(self.temp_dir, "data.gz")
+        gz = backup.ParallelGzipFile(open(path, "wb"), block_size=block_size)
+        for chunk in chunks:
+            gz.write(chunk)
+        gz.close()
+        self.assertEqual(gz.bytes_out, os.path.getsize(path))
+        return (path, gz)
+
+    def test_multiple_blocks(self):
+        data = "".join(["line %d of the backup\n" % i for i in range(20000)])
+        chunks = [data[i:i+10000] for i in range(0, len(data), 10000)]
+        (path, gz) = self._write(chunks, 64*1024)
+        self.assertEqual(gz.bytes_in, len(data))
+        self.assertTrue(gz.bytes_out < len(data))
+        self.assertEqual(gzip.open(path).read(), data)
+
+    def test_empty_file(self):
+        (path, gz) = self._write([], 64*1024)
+        self.assertEqual(gzip.open(path).read(), "")
+
+    def test_save_and_restore_to_temp_directory(self):
+        src = os.path.join(self.temp_dir, "src")
+        os.makedirs(os.path.join(src, "media"))
+        for i in range(50):
+            with open(os.path.join(src, "media/file%d.txt" % i), "wb") as f:
+                f.write(("contents of file %d\n" % i)*1000)
+        archive = os.path.join(self.temp_dir, "resource.tar.gz")
+        (bytes_in, bytes_out) = backup.save([src], archive)
+        self.assertEqual(bytes_out, os.path.getsize(archive))
+        self.assertTrue(bytes_in > bytes_out)
+        tar = tarfile.open(archive, "r:gz")
+        self.assertEqual(len(tar.getmembers()), 52)
+        tar.close()
+        restored = backup.restore_to_temp_directory(archive)
+        try:
+            with open(os.path.join(restored, src[1:], "media/file7.txt"), "rb") as f:
+                self.assertEqual(f.read(), "contents of file 7\n"*1000)
+        finally:
+            shutil.rmtree(restored)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,11 +1,16 @@
 import os.path
+import re
 import subprocess
 import sys
+import threading
 import time
 import unittest
 import urllib
+import BaseHTTPServer
 
 from engage.engine.library import randstr, HTTPDownloader, get_logger, get_test_logger
+from engage.utils.http_download import DownloadError, PART_SUFFIX, get_file_sha256, \
+                                       get_url_info
 
 HTTP = {'host': 'localhost',
         'port': '5555',
@@ -60,3 +65,73 @@ class TestHTTPDownloader(unittest.TestCase):
         dl.download_to_cache()
         assert os.path.exists(target)
         os.remove(target)
+
+    def test_checksum_mismatch(self):
+        target = 'httpdownloader-test-' + randstr()
+        dl = HTTPDownloader('http://{host}:{port}/{path}'.format(path=THIS_FILE, **HTTP),
+                            target, {"sha256":"0"*64})
+        dl.tries = 1
+        self.assertRaises(DownloadError, dl.download_to_cache)
+        assert not os.path.exists(target)
+        assert not os.path.exists(target + PART_SUFFIX)
+
+    def test_checksum_match(self):
+        target = 'httpdownloader-test-' + randstr()
+        dl = HTTPDownloader('http://{host}:{port}/{path}'.format(path=THIS_FILE, **HTTP),
+                            target, {"sha256":get_file_sha256(THIS_FILE)})
+        dl.download_to_cache()
+        assert os.path.exists(target)
+        os.remove(target)
+
+
+_NO_HEAD_DATA = "".join(["line %d\n" % i for i in range(1000)])
+
+class _NoHeadHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Rejects HEAD requests, as some mirrors do, and supports ranged GETs"""
+    def do_HEAD(self):
+        self.send_error(405)
+
+    def do_GET(self):
+        mo = re.match(r"bytes=(\d+)-(\d*)$", self.headers.getheader("range") or "")
+        if mo:
+            start = int(mo.group(1))
+            end = int(mo.group(2)) if mo.group(2) else len(_NO_HEAD_DATA)-1
+            data = _NO_HEAD_DATA[start:end+1]
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" %
+                             (start, end, len(_NO_HEAD_DATA)))
+        else:
+            data = _NO_HEAD_DATA
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+class TestServerRejectingHead(unittest.TestCase):
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(("localhost", 0), _NoHeadHandler)
+        self.url = "http://localhost:%d/package.tar.gz" % self.server.server_port
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_url_info_falls_back_to_range_get(self):
+        info = get_url_info(self.url)
+        self.assertEqual(info.length, len(_NO_HEAD_DATA))
+        self.assertTrue(info.accepts_ranges)
+
+    def test_download(self):
+        target = 'httpdownloader-test-' + randstr()
+        dl = HTTPDownloader(self.url, target)
+        assert dl.is_available()
+        dl.download_to_cache()
+        with open(target) as f:
+            self.assertEqual(f.read(), _NO_HEAD_DATA)
+        os.remove(target)
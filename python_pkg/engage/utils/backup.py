@@ -4,6 +4,13 @@
 We backup and restore a list of files/directories to a directory
 identified by backup_location. The files are saved in a tar archive.
 
+Compressed archives are written by ParallelGzipFile, which splits the tar
+stream into blocks and compresses each block as an independent gzip member
+(as pigz does) on a pool of threads shared by all the archives being
+written. zlib releases the GIL while compressing, so this uses all the
+cores. A sequence of gzip members is a valid gzip file, readable by gunzip,
+tar, and gzip.GzipFile. The tarfile stream mode ("r|gz") only reads the
+first member, so we open compressed archives with "r:gz".
 """
 import os
 import os.path
@@ -11,12 +18,156 @@ import tarfile
 import sys
 import shutil
 import tempfile
+import struct
+import threading
+import time
+import zlib
+import Queue
+from collections import deque
 
 import process_bootstrap as process
 import log_setup
 
 logger = log_setup.setup_engage_logger(__name__)
 
+# Size of the blocks compressed as separate gzip members. Each block costs a
+# few bytes of header and restarts the compression dictionary, which is
+# negligible at this size.
+COMPRESSION_BLOCK_SIZE = 1024*1024
+COMPRESSION_LEVEL = 6
+
+
+def _get_cpu_count():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+
+class _CompressionPool(object):
+    """Pool of daemon threads compressing blocks. Each task is a
+    (block, result) pair, where result is a _CompressionResult.
+    """
+    def __init__(self, num_workers):
+        self.num_workers = num_workers
+        self.tasks = Queue.Queue()
+        for i in range(num_workers):
+            t = threading.Thread(target=self._worker,
+                                 name="backup-compress-%d" % i)
+            t.daemon = True
+            t.start()
+
+    def _worker(self):
+        while True:
+            (block, result) = self.tasks.get()
+            try:
+                result.set(_compress_gzip_member(block, result.level))
+            except:
+                result.set_error(sys.exc_info())
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def _get_compression_pool():
+    global _pool
+    with _pool_lock:
+        if _pool==None:
+            _pool = _CompressionPool(_get_cpu_count())
+        return _pool
+
+
+class _CompressionResult(object):
+    def __init__(self, level):
+        self.level = level
+        self.event = threading.Event()
+        self.data = None
+        self.exc_info = None
+
+    def set(self, data):
+        self.data = data
+        self.event.set()
+
+    def set_error(self, exc_info):
+        self.exc_info = exc_info
+        self.event.set()
+
+    def get(self):
+        self.event.wait()
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.data
+
+
+def _compress_gzip_member(block, level):
+    """Return the block compressed as a complete gzip member (RFC 1952)"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    header = "\037\213\010\000" + struct.pack("<I", long(time.time())) + \
+             "\000\377"
+    trailer = struct.pack("<II", zlib.crc32(block) & 0xffffffffL,
+                          len(block) & 0xffffffffL)
+    return header + compressor.compress(block) + compressor.flush() + trailer
+
+
+class ParallelGzipFile(object):
+    """Write-only file object which gzip compresses the data written to it
+    in parallel. Blocks are compressed by the shared pool and written to
+    fileobj in order. At most max_pending blocks are buffered, so memory
+    use is bounded. bytes_in and bytes_out count the uncompressed and
+    compressed data.
+    """
+    def __init__(self, fileobj, block_size=COMPRESSION_BLOCK_SIZE,
+                 level=COMPRESSION_LEVEL):
+        self.fileobj = fileobj
+        self.block_size = block_size
+        self.level = level
+        self.pool = _get_compression_pool()
+        self.max_pending = 2*self.pool.num_workers
+        self.buffer = []
+        self.buffered = 0
+        self.pending = deque()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.closed = False
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        self.bytes_in += len(data)
+        if self.buffered>=self.block_size:
+            data = "".join(self.buffer)
+            for i in range(0, len(data) - self.block_size + 1, self.block_size):
+                self._submit(data[i:i+self.block_size])
+            rest = data[len(data) - (len(data) % self.block_size):]
+            self.buffer = [rest]
+            self.buffered = len(rest)
+
+    def _submit(self, block):
+        while len(self.pending)>=self.max_pending:
+            self._write_next()
+        result = _CompressionResult(self.level)
+        self.pool.tasks.put((block, result))
+        self.pending.append(result)
+
+    def _write_next(self):
+        data = self.pending.popleft().get()
+        self.fileobj.write(data)
+        self.bytes_out += len(data)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.buffered>0 or self.bytes_in==0:
+            # an empty file still needs one member to be valid gzip
+            self._submit("".join(self.buffer))
+            self.buffer = []
+            self.buffered = 0
+        while len(self.pending)>0:
+            self._write_next()
+        self.fileobj.close()
+
 def _ends_with(s, suffix):
     if s[0-len(suffix):]==suffix:
         return True
@@ -63,17 +214,34 @@ def check_if_restore_requires_superuser(backup_archive):
     return False
 
 def save(file_list, backup_location, move=False):
+    """Save the files to a tar archive at backup_location, compressing it if
+    the location ends in .tar.gz or .tgz. Returns a (bytes_in, bytes_out)
+    pair, giving the size of the tar stream and of the archive file.
+    """
     full_path_list = [os.path.abspath(os.path.expanduser(f)) for f in file_list]
-    tar = tarfile.open(backup_location, "w|" + _get_compression_mode(backup_location))
-    for f in full_path_list:
-        tar.add(f)
-    tar.close()
+    if _get_compression_mode(backup_location)=="gz":
+        fileobj = ParallelGzipFile(open(backup_location, "wb"))
+    else:
+        fileobj = open(backup_location, "wb")
+    try:
+        tar = tarfile.open(mode="w|", fileobj=fileobj)
+        for f in full_path_list:
+            tar.add(f)
+        tar.close()
+    finally:
+        fileobj.close()
+    if isinstance(fileobj, ParallelGzipFile):
+        stats = (fileobj.bytes_in, fileobj.bytes_out)
+    else:
+        size = os.path.getsize(backup_location)
+        stats = (size, size)
     if move:
         for f in full_path_list:
             if os.path.isdir(f):
                 shutil.rmtree(f)
             else:
                 os.remove(f)
+    return stats
 
 def save_as_sudo_subprocess(file_list, backup_location, sudo_password, move=False):
     backup_loc_path = os.path.abspath(os.path.expanduser(backup_location))
@@ -90,8 +258,15 @@ def save_as_sudo_subprocess(file_list, backup_location, sudo_password, move=Fals
         os.unlink(f.name)
 
                 
+def _open_for_restore(backup_location):
+    if _get_compression_mode(backup_location)=="gz":
+        # not the stream mode, which only reads the first gzip member
+        return tarfile.open(backup_location, "r:gz")
+    else:
+        return tarfile.open(backup_location, "r|")
+
 def restore(backup_location, move=False):
-    tar = tarfile.open(backup_location, "r|" + _get_compression_mode(backup_location))
+    tar = _open_for_restore(backup_location)
     tar.extractall("/")
     tar.close()
     if move:
@@ -107,7 +282,7 @@ def restore_as_sudo_subprocess(backup_location, sudo_password, move=False):
 
 
 def restore_to_temp_directory(backup_location):
-    tar = tarfile.open(backup_location, "r|" + _get_compression_mode(backup_location))
+    tar = _open_for_restore(backup_location)
     tempdir = tempfile.mkdtemp()
     tar.extractall(tempdir)
     tar.close()
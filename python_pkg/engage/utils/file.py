@@ -7,13 +7,13 @@ import os.path
 import tempfile
 import shutil
 import stat
-import string
 import grp
 import subprocess
 import sys
 import codecs
 
 from user_error import UserError, InstErrInf
+import template_engine
 import gettext
 _ = gettext.gettext
 
@@ -170,6 +170,7 @@ def instantiate_template_file(src_file_path, dest_file_path, substitution_map, s
     See string.Template() in the standard python library for the syntax of
     template files. If the source file and destination file are the same,
     the original file is left at <filename>.orig, unless subst_in_place=True.
+    Compiled templates are cached (see template_engine.py).
 
     By default, we set the permissions of the new file version to be the same
     as those for the original file. If the file ends in .sh or force_executable_permissions
@@ -213,11 +214,14 @@ def instantiate_template_file(src_file_path, dest_file_path, substitution_map, s
         logger.debug("  substitutions=%s" % substitution_map.__repr__())
     source_file_perms = os.stat(src_file_path).st_mode
 
-    fileObj = open(src_file_path, "rb")
-    templStr = fileObj.read()
-    fileObj.close()
-    templ = string.Template(templStr)
-    result = templ.substitute(substitution_map)
+    # When substituting in place, the file has usually just been copied over
+    # and may have the same size and timestamps as a previous version, so
+    # we don't use the template cache.
+    in_place = os.path.abspath(src_file_path)==os.path.abspath(dest_file_path)
+    templ = template_engine.get_template_file(src_file_path,
+                                              template_engine.STRING_TEMPLATE_DIALECT,
+                                              use_cache=not in_place)
+    result = templ.render(substitution_map)
 
     if (src_file_path==dest_file_path) and not subst_in_place:
         shutil.move(src_file_path, src_file_path + ".orig")
@@ -420,8 +424,9 @@ def subst_utf8_template_file(filename, substitutions, srcfile=None):
         raise Exception("Template file %s not found" % templ_file)
     with codecs.open(templ_file, "r", "utf-8" ) as fileObj:
         templStr = fileObj.read()
-    templ = string.Template(templStr)
-    result = templ.substitute(substitutions)
+    templ = template_engine.compile_template(templStr,
+                                             template_engine.STRING_TEMPLATE_DIALECT)
+    result = templ.render(substitutions)
     with open(filename, "w") as outfileObj:
         outfileObj.write(result)
 
@@ -0,0 +1,244 @@
+"""Robust http downloads for the package cache. Compared to
+urllib.urlretrieve(), we:
+ * check availability with a HEAD request rather than a full GET (falling
+   back to a GET of the first byte for servers which reject HEAD),
+ * stream the response in chunks to a temporary file (<target>.part) and
+   rename it to the target only once complete (and verified), so that a
+   partial download is never mistaken for a cached package,
+ * resume partial downloads with an http Range request, if the server
+   supports ranges,
+ * retry failed transfers with exponential backoff,
+ * optionally verify a sha256 digest of the downloaded file, and
+ * download large files as several ranged segments in parallel.
+"""
+
+import os
+import os.path
+import time
+import hashlib
+import re
+import threading
+import urllib2
+
+import engage.utils.trace as tracing
+
+CHUNK_SIZE = 64*1024
+DEFAULT_TRIES = 4
+DEFAULT_BACKOFF = 2.0 # seconds before the first retry, doubled for each retry
+DEFAULT_TIMEOUT = 60.0
+# files at least this large are downloaded in parallel segments
+SEGMENT_THRESHOLD = 64*1024*1024
+DEFAULT_SEGMENTS = 4
+
+PART_SUFFIX = ".part"
+
+
+class DownloadError(Exception):
+    pass
+
+
+class _HeadRequest(urllib2.Request):
+    def get_method(self):
+        return "HEAD"
+
+
+class UrlInfo(object):
+    """Results of a HEAD request"""
+    def __init__(self, url, length, accepts_ranges):
+        self.url = url
+        self.length = length # None if not provided by the server
+        self.accepts_ranges = accepts_ranges
+
+
+_content_range_re = re.compile(r"^\s*bytes\s+\d+\-\d+/(\d+)\s*$")
+
+def _get_range_url_info(url, timeout):
+    """Some servers and mirrors reject HEAD requests (e.g. with 403, 405, or
+    501). For those, we make a GET request for just the first byte and
+    close the connection after reading the headers. A 206 response gives
+    the full length in its Content-Range header.
+    """
+    request = urllib2.Request(url)
+    request.add_header("Range", "bytes=0-0")
+    try:
+        response = urllib2.urlopen(request, timeout=timeout)
+    except (urllib2.URLError, IOError, ValueError):
+        return None
+    try:
+        if response.getcode()==206:
+            mo = _content_range_re.match(response.info().getheader("content-range") or "")
+            return UrlInfo(response.geturl(),
+                           int(mo.group(1)) if mo else None, True)
+        else:
+            return _make_url_info(response)
+    finally:
+        response.close()
+
+
+def _make_url_info(response):
+    length = response.info().getheader("content-length")
+    accept_ranges = response.info().getheader("accept-ranges")
+    return UrlInfo(response.geturl(),
+                   int(length) if length else None,
+                   accept_ranges!=None and \
+                   accept_ranges.strip().lower()=="bytes")
+
+
+def get_url_info(url, timeout=DEFAULT_TIMEOUT):
+    """Make a HEAD request for the url. Returns a UrlInfo object, or None if
+    the url is not available. If the server returns an error for the HEAD
+    request, we retry with a ranged GET (see _get_range_url_info()).
+    """
+    try:
+        response = urllib2.urlopen(_HeadRequest(url), timeout=timeout)
+    except urllib2.HTTPError:
+        return _get_range_url_info(url, timeout)
+    except (urllib2.URLError, IOError, ValueError):
+        return None
+    try:
+        return _make_url_info(response)
+    finally:
+        response.close()
+
+
+def get_file_sha256(filepath):
+    h = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        while True:
+            data = f.read(CHUNK_SIZE)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+
+def _fetch_range(url, filepath, start, end, timeout):
+    """Append bytes [start+size of filepath, end] (inclusive, end may be None
+    for the end of the resource) of the url to filepath. If the file
+    already contains data, we request the remaining range only. If the
+    server ignores the range request, we start the file over.
+    """
+    if os.path.exists(filepath):
+        offset = os.path.getsize(filepath)
+    else:
+        offset = 0
+    if end!=None and start+offset>end:
+        return # segment already complete
+    request = urllib2.Request(url)
+    if start+offset>0 or end!=None:
+        request.add_header("Range", "bytes=%d-%s" %
+                           (start+offset, "" if end==None else str(end)))
+    response = urllib2.urlopen(request, timeout=timeout)
+    try:
+        if response.getcode()==206:
+            mode = "ab"
+        elif start==0 and end==None:
+            mode = "wb" # server sent the whole file
+        else:
+            raise DownloadError("Server does not support range requests for %s" %
+                                url)
+        with open(filepath, mode) as f:
+            while True:
+                data = response.read(CHUNK_SIZE)
+                if not data:
+                    break
+                f.write(data)
+    finally:
+        response.close()
+
+
+def _fetch_segments(url, part_file, length, num_segments, timeout):
+    """Fetch the url as num_segments ranges in parallel, each into its own
+    file, then concatenate them into part_file. Segment files are kept
+    between tries, so each segment resumes independently.
+    """
+    segment_size = (length + num_segments - 1)/num_segments
+    ranges = [(i*segment_size, min((i+1)*segment_size, length)-1)
+              for i in range(num_segments)]
+    errors = []
+    def fetch(i, start, end):
+        try:
+            with tracing.span(os.path.basename(part_file), "download_segment",
+                              segment=i):
+                _fetch_range(url, "%s.%d" % (part_file, i), start, end, timeout)
+        except Exception, e:
+            errors.append(e)
+    threads = [threading.Thread(target=fetch, args=(i, start, end),
+                                name="download-segment-%d" % i)
+               for (i, (start, end)) in enumerate(ranges)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if len(errors)>0:
+        raise errors[0]
+    with open(part_file, "wb") as f:
+        for i in range(num_segments):
+            segment_file = "%s.%d" % (part_file, i)
+            with open(segment_file, "rb") as sf:
+                while True:
+                    data = sf.read(CHUNK_SIZE)
+                    if not data:
+                        break
+                    f.write(data)
+    for i in range(num_segments):
+        os.remove("%s.%d" % (part_file, i))
+
+
+def download(url, target_filepath, sha256=None, tries=DEFAULT_TRIES,
+             backoff=DEFAULT_BACKOFF, timeout=DEFAULT_TIMEOUT,
+             num_segments=DEFAULT_SEGMENTS,
+             segment_threshold=SEGMENT_THRESHOLD, logger=None):
+    """Download url to target_filepath. The target only appears once the
+    download is complete and, if sha256 was specified, has the expected
+    digest. Raises DownloadError if the download fails after the specified
+    number of tries.
+    """
+    part_file = target_filepath + PART_SUFFIX
+    delay = backoff
+    for attempt in range(1, tries+1):
+        try:
+            info = get_url_info(url, timeout=timeout)
+            if info and info.accepts_ranges and info.length and \
+               info.length>=segment_threshold and num_segments>1 and \
+               not os.path.exists(part_file):
+                if logger:
+                    logger.debug("Downloading %s in %d segments" %
+                                 (url, num_segments))
+                _fetch_segments(url, part_file, info.length, num_segments,
+                                timeout)
+            elif info and info.length!=None and os.path.exists(part_file) and \
+                 os.path.getsize(part_file)==info.length:
+                pass # completed, but not renamed by a previous run
+            else:
+                if os.path.exists(part_file) and \
+                   (not (info and info.accepts_ranges) or
+                    (info.length!=None and
+                     os.path.getsize(part_file)>info.length)):
+                    os.remove(part_file) # cannot resume
+                elif os.path.exists(part_file) and logger:
+                    logger.debug("Resuming download of %s at byte %d" %
+                                 (url, os.path.getsize(part_file)))
+                _fetch_range(url, part_file, 0, None, timeout)
+            if info and info.length!=None and \
+               os.path.getsize(part_file)!=info.length:
+                raise DownloadError("Download of %s incomplete: got %d of %d bytes" %
+                                    (url, os.path.getsize(part_file),
+                                     info.length))
+            if sha256:
+                actual = get_file_sha256(part_file)
+                if actual!=sha256.lower():
+                    os.remove(part_file) # bad data, cannot resume from it
+                    raise DownloadError("Checksum mismatch for %s: expecting sha256 %s, got %s" %
+                                        (url, sha256, actual))
+            os.rename(part_file, target_filepath)
+            return target_filepath
+        except (DownloadError, urllib2.URLError, IOError, OSError), e:
+            if attempt==tries:
+                raise DownloadError("Download of %s failed after %d tries: %s" %
+                                    (url, tries, e))
+            if logger:
+                logger.warning("Download of %s failed (try %d of %d), retrying in %.1f seconds: %s" %
+                               (url, attempt, tries, delay, e))
+            tracing.sleep(delay, action="download_retry")
+            delay = delay*2
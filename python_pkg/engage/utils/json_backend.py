@@ -0,0 +1,147 @@
+"""Pluggable JSON implementation for the engine's metadata files (install
+solutions, installed_resources.json, library and packages.json files, the
+state cache, preprocessing manifests, etc.). These are read and written on
+every install, svcctl, and backup run, and on deployments with hundreds of
+resources, json parsing and serialization are near the top of the profiles.
+
+We use simplejson if it is installed with its C speedups, and otherwise
+fall back to the json module in the standard library. The backend can be
+forced by setting the ENGAGE_JSON_BACKEND environment variable to
+"simplejson" or "stdlib".
+
+The interface mirrors the json module, restricted to the options we use.
+In addition, dump() and dumps() take a compact option, for files that are
+only read by the engine: no indentation, no whitespace after separators,
+and no key sorting. For the stdlib backend, this is the only mode which
+uses the C encoder.
+
+Both backends return unicode strings when parsing, as the stdlib module
+does (simplejson may return str for ASCII strings, unless the input is
+already unicode, so we decode first). We do not support ujson, as it
+rounds floats, which would break our comparisons of file modification
+times.
+
+>>> s = dumps({"b":[1, 2.5, None], "a":u"x/y"}, compact=True)
+>>> loads(s)==loads(dumps({"a":u"x/y", "b":[1, 2.5, None]}, indent=2, sort_keys=True))
+True
+>>> " " in s
+False
+>>> print dumps({"b":1, "a":True}, sort_keys=True)
+{"a": true, "b": 1}
+>>> loads('["abc"]')
+[u'abc']
+"""
+
+import os
+import json as _stdlib_json
+
+BACKEND_ENV_VAR = "ENGAGE_JSON_BACKEND"
+STDLIB_BACKEND = "stdlib"
+SIMPLEJSON_BACKEND = "simplejson"
+VALID_BACKENDS = [SIMPLEJSON_BACKEND, STDLIB_BACKEND]
+
+COMPACT_SEPARATORS = (',', ':')
+
+
+class StdlibBackend(object):
+    name = STDLIB_BACKEND
+
+    def loads(self, s):
+        return _stdlib_json.loads(s)
+
+    def dumps(self, obj, indent, sort_keys, separators):
+        return _stdlib_json.dumps(obj, indent=indent, sort_keys=sort_keys,
+                                  separators=separators)
+
+
+class SimplejsonBackend(object):
+    name = SIMPLEJSON_BACKEND
+
+    def __init__(self, simplejson_module):
+        self.simplejson = simplejson_module
+
+    def loads(self, s):
+        if isinstance(s, str):
+            s = s.decode("utf-8")
+        return self.simplejson.loads(s)
+
+    def dumps(self, obj, indent, sort_keys, separators):
+        return self.simplejson.dumps(obj, indent=indent, sort_keys=sort_keys,
+                                     separators=separators)
+
+
+def _create_backend(name):
+    """Return the backend object for name, or None if it is not available.
+    """
+    if name==STDLIB_BACKEND:
+        return StdlibBackend()
+    elif name==SIMPLEJSON_BACKEND:
+        try:
+            import simplejson
+            import simplejson._speedups
+        except ImportError:
+            return None
+        return SimplejsonBackend(simplejson)
+    else:
+        raise ValueError("Invalid JSON backend '%s', valid backends are %s" %
+                         (name, ", ".join(VALID_BACKENDS)))
+
+
+def _select_backend():
+    name = os.environ.get(BACKEND_ENV_VAR, None)
+    if name in VALID_BACKENDS:
+        backend = _create_backend(name)
+        if backend!=None:
+            return backend
+    for name in VALID_BACKENDS:
+        backend = _create_backend(name)
+        if backend!=None:
+            return backend
+
+
+_backend = _select_backend()
+
+
+def get_backend_name():
+    return _backend.name
+
+
+def get_available_backends():
+    return [name for name in VALID_BACKENDS if _create_backend(name)!=None]
+
+
+def set_backend(name):
+    """Switch to the named backend, returning the name of the previous one.
+    Raises ValueError if the backend is not available.
+    """
+    global _backend
+    backend = _create_backend(name)
+    if backend==None:
+        raise ValueError("JSON backend '%s' is not available" % name)
+    old_name = _backend.name
+    _backend = backend
+    return old_name
+
+
+def loads(s):
+    return _backend.loads(s)
+
+
+def load(fp):
+    return _backend.loads(fp.read())
+
+
+def dumps(obj, indent=None, sort_keys=False, compact=False):
+    if compact:
+        return _backend.dumps(obj, None, False, COMPACT_SEPARATORS)
+    else:
+        return _backend.dumps(obj, indent, sort_keys, None)
+
+
+def dump(obj, fp, indent=None, sort_keys=False, compact=False):
+    fp.write(dumps(obj, indent=indent, sort_keys=sort_keys, compact=compact))
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -14,6 +14,8 @@ from optparse import OptionParser
 import re
 import copy
 import os.path
+import bisect
+from collections import deque
 
 try:
     import engage_utils.resource_utils as ru
@@ -105,8 +107,34 @@ def is_specific_version_constraint(target_constraint):
     version_type = type(target_key[u"version"])
     return (version_type==str) or (version_type==unicode)
 
+_version_sep_re = re.compile(r"[.\-]")
+_version_num_re = re.compile(r"^[0-9]+$")
+
+def version_key(version):
+    """Return a comparable key for a version string. The version is split
+    into components at each '.' or '-'. Numeric components are compared as
+    integers and sort before non-numeric components, which are compared as
+    strings. This must agree with compare_versions in
+    config_src/config/resources.ml, which the configurator uses for
+    version range constraints.
+
+    >>> version_key("10.0") > version_key("9.0")
+    True
+    >>> sorted(["10.0", "9.0", "1.0-beta", "1.0", "1.0.1"], key=version_key)
+    ['1.0', '1.0.1', '1.0-beta', '9.0', '10.0']
+    """
+    return tuple([(0, int(c)) if _version_num_re.match(c) else (1, c)
+                  for c in _version_sep_re.split(version) if c!=""])
+
 def version_matches_constraint(version, constraint):
     """Return true if the version string matches the constraint
+
+    >>> version_matches_constraint("10.0", {u"greater-than-or-equal":"9.0"})
+    True
+    >>> version_matches_constraint("10.0", {u"less-than":"9.0"})
+    False
+    >>> version_matches_constraint("1.0", "1.0")
+    True
     """
     GT = u"greater-than"
     GTE = u"greater-than-or-equal"
@@ -117,17 +145,94 @@ def version_matches_constraint(version, constraint):
     elif type(constraint) != dict:
         return False
     # otherwise, check that all the constraints present are satisfied
-    if constraint.has_key(GT) and not (version > constraint[GT]):
+    vk = version_key(version)
+    if constraint.has_key(GT) and not (vk > version_key(constraint[GT])):
         return False
-    if constraint.has_key(GTE) and not (version >= constraint[GTE]):
+    if constraint.has_key(GTE) and not (vk >= version_key(constraint[GTE])):
         return False
-    if constraint.has_key(LT) and not (version < constraint[LT]):
+    if constraint.has_key(LT) and not (vk < version_key(constraint[LT])):
         return False
-    if constraint.has_key(LTE) and not (version <= constraint[LTE]):
+    if constraint.has_key(LTE) and not (vk <= version_key(constraint[LTE])):
         return False
     return True
 
 
+class VersionIndex(object):
+    """The resources sharing a name, sorted by version key, so that a
+    version range constraint can be answered by bisection.
+    """
+    def __init__(self, resources):
+        entries = sorted([(version_key(r.key[u"version"]), r.key_as_string)
+                          for r in resources])
+        self.version_keys = [vk for (vk, key_as_string) in entries]
+        self.key_strings = [key_as_string for (vk, key_as_string) in entries]
+        self.by_version = {}
+        for r in resources:
+            self.by_version[r.key[u"version"]] = r.key_as_string
+
+    def find_matching(self, version_constraint):
+        """Return a frozenset of the serialized keys of the resources
+        matching the version constraint.
+        """
+        GT = u"greater-than"
+        GTE = u"greater-than-or-equal"
+        LT = u"less-than"
+        LTE = u"less-than-or-equal"
+        if type(version_constraint) != dict:
+            if self.by_version.has_key(version_constraint):
+                return frozenset([self.by_version[version_constraint]])
+            else:
+                return frozenset()
+        lo = 0
+        hi = len(self.version_keys)
+        if version_constraint.has_key(GT):
+            lo = max(lo, bisect.bisect_right(self.version_keys,
+                                             version_key(version_constraint[GT])))
+        if version_constraint.has_key(GTE):
+            lo = max(lo, bisect.bisect_left(self.version_keys,
+                                            version_key(version_constraint[GTE])))
+        if version_constraint.has_key(LT):
+            hi = min(hi, bisect.bisect_left(self.version_keys,
+                                            version_key(version_constraint[LT])))
+        if version_constraint.has_key(LTE):
+            hi = min(hi, bisect.bisect_right(self.version_keys,
+                                             version_key(version_constraint[LTE])))
+        return frozenset(self.key_strings[lo:hi])
+
+
+class ResourcesByName(dict):
+    """Map from resource names to sets of resources. The version index for
+    a name is built on first lookup, and the results for each
+    (name, version constraint) pair are memoized, as many resources share the
+    same constraints. The map should not be changed after the first lookup.
+    """
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.indexes = {}
+        self.matches = {}
+
+    def find_matching(self, name, version_constraint):
+        """Return a frozenset of the serialized keys of the resources
+        with the specified name which match the version constraint.
+        """
+        if type(version_constraint) == dict:
+            memo_key = (name, tuple(sorted(version_constraint.items())))
+        else:
+            memo_key = (name, version_constraint)
+        result = self.matches.get(memo_key, None)
+        if result is None:
+            if not self.has_key(name):
+                result = frozenset()
+            else:
+                index = self.indexes.get(name, None)
+                if index is None:
+                    index = VersionIndex(self[name])
+                    self.indexes[name] = index
+                result = index.find_matching(version_constraint)
+            self.matches[memo_key] = result
+        return result
+
+
 # map from constraint node name to actual constraint
 constraint_nodes = {}
 
@@ -307,11 +412,14 @@ class BaseConstraint(Constraint):
         if not resources_by_name.has_key(self.name):
             print "WARNING: Constraint '%s' in resource '%s' has no matching resources" % (self, self.parent_resource.key_as_string)
             return set()
-        candidates = resources_by_name[self.name]
-        result_set = set()
-        for candidate in candidates:
-            if self.matches_key(candidate.key):
-                result_set.add(candidate.key_as_string)
+        if isinstance(resources_by_name, ResourcesByName):
+            result_set = resources_by_name.find_matching(self.name,
+                                                         self.version_constraint)
+        else:
+            result_set = set()
+            for candidate in resources_by_name[self.name]:
+                if self.matches_key(candidate.key):
+                    result_set.add(candidate.key_as_string)
         if len(result_set)==0:
             print "WARNING: Constraint '%s' in resource '%s' has no matching resources" % (self, self.parent_resource.key_as_string)
             if DEBUG:
@@ -417,7 +525,7 @@ class OneOfConstraint(CompositeConstraint):
     def find_all_matching(self, resources_by_name):
         result_set = set()
         for constraint in self.constraint_list:
-            result_set = result_set.union(constraint.find_all_matching(resources_by_name))
+            result_set.update(constraint.find_all_matching(resources_by_name))
         return result_set
 
     def write_link_to_graph_file(self, file, src_node, res_by_name, style):
@@ -463,7 +571,7 @@ class AllOfConstraint(CompositeConstraint):
     def find_all_matching(self, resources_by_name):
         result_set = set()
         for constraint in self.constraint_list:
-            result_set = result_set.union(constraint.find_all_matching(resources_by_name))
+            result_set.update(constraint.find_all_matching(resources_by_name))
         return result_set
 
     def write_link_to_graph_file(self, file, src_node, res_by_name, style):
@@ -757,33 +865,34 @@ def _add_to_map_of_sets(map, key, entry):
 
 
 def prune_resources(res_map, res_by_name, resource_keys):
-    """Prune out all resources not reachable by the specified resource_key list
+    """Prune out all resources not reachable by the specified resource_key list.
+    This is a breadth-first search, so each resource's constraints are
+    evaluated once.
     """
     # our sets are sets of keys, represented as repr strings
     keep_set = set()
-    work_set = set()
+    work_queue = deque()
     for key in resource_keys:
         key_repr = hash_key_for_res_key(key)
         assert res_map.has_key(key_repr), "Resource '%s' not found" % key_repr
-        keep_set.add(key_repr)
-        work_set.add(key_repr)
-    while len(work_set)>0:
-        pick_key = work_set.pop()
+        if key_repr not in keep_set:
+            keep_set.add(key_repr)
+            work_queue.append(key_repr)
+    while len(work_queue)>0:
+        pick_key = work_queue.popleft()
         debug("chose resource %s" % pick_key)
         assert res_map.has_key(pick_key), "Invalid reference to resource '%s'" % pick_key
         res = res_map[pick_key]
-        matching = set()
-        if res.inside_constraint:
-            matching = matching.union(res.inside_constraint.find_all_matching(res_by_name))
-        if res.env_constraint:
-            matching = matching.union(res.env_constraint.find_all_matching(res_by_name))
-        if res.peer_constraint:
-            matching = matching.union(res.peer_constraint.find_all_matching(res_by_name))
-        new = matching.difference(keep_set)
-        keep_set = keep_set.union(new)
-        work_set = work_set.union(new)
+        for constraint in (res.inside_constraint, res.env_constraint,
+                           res.peer_constraint):
+            if not constraint:
+                continue
+            for key_as_string in constraint.find_all_matching(res_by_name):
+                if key_as_string not in keep_set:
+                    keep_set.add(key_as_string)
+                    work_queue.append(key_as_string)
     new_map = {}
-    new_by_name_map = {}
+    new_by_name_map = ResourcesByName()
     for key_as_string in keep_set:
         res = res_map[key_as_string]
         new_map[key_as_string] = res
@@ -794,7 +903,8 @@ def prune_resources(res_map, res_by_name, resource_keys):
 class ResourceGraph(object):
     """A resource graph contains two maps: 1) a map of all resources by key (in
     serialized json form), and 2) a map of resource sets by the name component of
-    the key. The second map is used when looking up constraints.
+    the key. The second map is used when looking up constraints. It is a
+    ResourcesByName, which indexes the resources by version.
     """
     def __init__(self, res_map, res_by_name):
         self.res_map = res_map
@@ -885,13 +995,45 @@ def create_resource_graph(resource_json):
     else:
         resource_json_list = resource_json[RESOURCE_DEFINITIONS_PROP]
     res_map = {}
-    res_by_name = {}
+    res_by_name = ResourcesByName()
     for res_json in resource_json_list:
         res = Resource(res_json)
         res_map[res.key_as_string] = res
         _add_to_map_of_sets(res_by_name, res.key[u"name"], res)
     return ResourceGraph(res_map, res_by_name)
-                              
+
+
+def prune_resource_file(resource_file, resource_keys, pruned_file):
+    """Write to pruned_file only the resource definitions from resource_file
+    which are reachable from resource_keys via inside, environment, or peer
+    constraints. The remaining definitions keep their original order, and
+    any other top-level properties of the file are preserved. Returns a pair
+    of the number of definitions kept and the total number.
+    """
+    with open(resource_file, "rb") as f:
+        resource_json = json.load(f)
+    rg = create_resource_graph(resource_json)
+    for key in resource_keys:
+        if not rg.has_resource(key):
+            raise ParseException("Resource %s not found in %s" %
+                                 (hash_key_for_res_key(key), resource_file))
+    pruned = rg.filter(resource_keys)
+    if isinstance(resource_json, list):
+        resource_json_list = resource_json
+    else:
+        resource_json_list = resource_json[RESOURCE_DEFINITIONS_PROP]
+    pruned_list = [r for r in resource_json_list
+                   if pruned.has_resource(r[u"key"])]
+    if isinstance(resource_json, list):
+        pruned_json = pruned_list
+    else:
+        pruned_json = copy.copy(resource_json)
+        pruned_json[RESOURCE_DEFINITIONS_PROP] = pruned_list
+    with open(pruned_file, "wb") as f:
+        json.dump(pruned_json, f, indent=2)
+        f.write("\n")
+    return (len(pruned_list), len(resource_json_list))
+
 
 def create_opt_parser():
     """Returns (options, args) pair
@@ -0,0 +1,287 @@
+"""Compiled templates, shared by the template actions in
+engage.drivers.action and by engage.utils.file.instantiate_template_file().
+Drivers render many configuration files per resource, and the same
+templates again for each instance on multi-instance hosts. Rather than
+re-reading a template and running a regular expression substitution with a
+python callback on each render, we tokenize each template once into
+literal and variable segments, and render by joining the segments.
+Compiled template files are cached by path, validated by the file's inode,
+modification and change times, and size, so that edited templates are
+picked up.
+
+There are two template syntaxes (dialects):
+  ACTION_DIALECT          - variables are of the form ${x.y.z}. A $$ is left
+                            as is, as is any other $.
+  STRING_TEMPLATE_DIALECT - the syntax of string.Template in the python
+                            standard library: $x or ${x}, with $$ as an
+                            escape for $. Other uses of $ are an error.
+
+>>> t = compile_template("home=${config_port.home} cost=$$5 ${x}")
+>>> t.variables
+['config_port.home', 'x']
+>>> t.render({"config_port.home":"/opt/app", "x":"y"})
+'home=/opt/app cost=$$5 y'
+>>> t.get_missing_variables({"x":"y"})
+['config_port.home']
+>>> try:
+...     t.render({"x":"y"})
+... except TemplateError, e:
+...     print e.var
+config_port.home
+>>> t = compile_template("$a and ${b}, $$1", STRING_TEMPLATE_DIALECT)
+>>> t.render({"a":"x", "b":2})
+'x and 2, $1'
+>>> try:
+...     t.render({"a":"x"})
+... except KeyError, e:
+...     print e
+'b'
+"""
+
+import os
+import os.path
+import re
+import string
+import threading
+
+ACTION_DIALECT = "action"
+STRING_TEMPLATE_DIALECT = "string.Template"
+
+# maximum number of compiled templates kept in each cache
+MAX_CACHE_ENTRIES = 500
+
+
+class TemplateError(Exception):
+    def __init__(self, msg, var):
+        super(TemplateError, self).__init__(msg)
+        self.var = var
+
+
+def _build_template_var_re():
+    import engage.utils.regexp as r
+    start_char = r.character_set("A-Za-z\\_")
+    follow_char = r.character_set("A-Za-z0-9\\_")
+    identifier = r.concat(start_char,
+                          r.zero_or_more(follow_char))
+    composite_identifier = r.concat(identifier,
+                                    r.zero_or_more(r.concat(r.lit("."),
+                                                            identifier)))
+    template_var = r.concat(r.lit("${"), r.group(composite_identifier), r.lit("}"))
+    escape = r.lit("$$")
+    return r.or_match(escape, template_var)
+
+_template_var_re = _build_template_var_re().compile()
+
+
+def _tokenize_action(text):
+    """Return a list of segments: strings for literal text and one-element
+    tuples for variables.
+    """
+    segments = []
+    pos = 0
+    for mo in _template_var_re.finditer(text):
+        if mo.group(1)==None:
+            continue # a $$, which is left in the literal text
+        segments.append(text[pos:mo.start()])
+        segments.append((mo.group(1),))
+        pos = mo.end()
+    segments.append(text[pos:])
+    return segments
+
+
+def _tokenize_string_template(text):
+    """Tokenize using the pattern of string.Template. Raises ValueError for
+    invalid placeholders, as string.Template.substitute() does.
+    """
+    segments = []
+    literal = []
+    pos = 0
+    for mo in string.Template.pattern.finditer(text):
+        literal.append(text[pos:mo.start()])
+        pos = mo.end()
+        if mo.group("escaped")!=None:
+            literal.append("$")
+        elif mo.group("named")!=None or mo.group("braced")!=None:
+            segments.append("".join(literal))
+            literal = []
+            segments.append((mo.group("named") or mo.group("braced"),))
+        else:
+            i = mo.start("invalid")
+            lines = text[:i].splitlines(True)
+            if not lines:
+                colno = 1
+                lineno = 1
+            else:
+                colno = i - len(''.join(lines[:-1]))
+                lineno = len(lines)
+            raise ValueError('Invalid placeholder in string: line %d, col %d' %
+                             (lineno, colno))
+    literal.append(text[pos:])
+    segments.append("".join(literal))
+    return segments
+
+
+class CompiledTemplate(object):
+    """A template split into literal and variable segments. The segments
+    alternate, starting and ending with a literal (which may be empty).
+    """
+    def __init__(self, text, dialect=ACTION_DIALECT):
+        if dialect==ACTION_DIALECT:
+            segments = _tokenize_action(text)
+        elif dialect==STRING_TEMPLATE_DIALECT:
+            segments = _tokenize_string_template(text)
+        else:
+            raise ValueError("Invalid template dialect '%s'" % dialect)
+        self.dialect = dialect
+        self.literals = segments[0::2]
+        self.variables = [var for (var,) in segments[1::2]]
+
+    def get_missing_variables(self, substitutions):
+        """Return the variables referenced by the template which are not in
+        the substitutions map, in the order they first appear.
+        """
+        missing = []
+        for var in self.variables:
+            if not substitutions.has_key(var) and var not in missing:
+                missing.append(var)
+        return missing
+
+    def render(self, substitutions):
+        """Return the template instantiated with the substitutions map.
+        If a variable is missing, raises TemplateError for ACTION_DIALECT or
+        KeyError for STRING_TEMPLATE_DIALECT (as string.Template does).
+        """
+        parts = [None]*(2*len(self.variables)+1)
+        parts[0::2] = self.literals
+        try:
+            if self.dialect==ACTION_DIALECT:
+                parts[1::2] = [substitutions[var] for var in self.variables]
+            else:
+                parts[1::2] = ['%s' % (substitutions[var],)
+                               for var in self.variables]
+        except KeyError:
+            var = self.get_missing_variables(substitutions)[0]
+            if self.dialect==ACTION_DIALECT:
+                raise TemplateError("Variable '%s' found in document but not in substitution map" % var, var)
+            else:
+                raise KeyError(var)
+        return "".join(parts)
+
+
+class TemplateCache(object):
+    """Cache of compiled templates. File templates are keyed by absolute
+    path and dialect, and the entry is reused only if the file's inode,
+    modification and change times, and size are unchanged. Timestamps may
+    only have one second resolution, so a file rewritten in place within the
+    same second with the same size can still look unchanged: callers which
+    render a file they just wrote should pass use_cache=False. String
+    templates are keyed by the text. When the cache is full, it is cleared.
+    """
+    def __init__(self, max_entries=MAX_CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.files = {}
+        self.strings = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _add(self, cache, key, value):
+        with self.lock:
+            if len(cache)>=self.max_entries:
+                cache.clear()
+            cache[key] = value
+            self.misses += 1
+
+    def get_file_template(self, path, dialect=ACTION_DIALECT, use_cache=True):
+        path = os.path.abspath(path)
+        if not use_cache:
+            with open(path, "rb") as f:
+                return CompiledTemplate(f.read(), dialect)
+        st = os.stat(path)
+        validator = (st.st_ino, st.st_mtime, st.st_ctime, st.st_size)
+        key = (path, dialect)
+        entry = self.files.get(key, None)
+        if entry!=None and entry[0]==validator:
+            self.hits += 1
+            return entry[1]
+        with open(path, "rb") as f:
+            compiled = CompiledTemplate(f.read(), dialect)
+        self._add(self.files, key, (validator, compiled))
+        return compiled
+
+    def get_string_template(self, text, dialect=ACTION_DIALECT):
+        key = (text, dialect)
+        compiled = self.strings.get(key, None)
+        if compiled!=None:
+            self.hits += 1
+            return compiled
+        compiled = CompiledTemplate(text, dialect)
+        self._add(self.strings, key, compiled)
+        return compiled
+
+    def clear(self):
+        with self.lock:
+            self.files.clear()
+            self.strings.clear()
+
+
+_cache = TemplateCache()
+
+
+def compile_template(text, dialect=ACTION_DIALECT):
+    """Return the compiled template for the text, using the cache.
+    """
+    return _cache.get_string_template(text, dialect)
+
+
+def get_template_file(path, dialect=ACTION_DIALECT, use_cache=True):
+    """Return the compiled template for the file, using the cache unless
+    use_cache is False.
+
+    >>> import tempfile
+    >>> (fd, path) = tempfile.mkstemp()
+    >>> os.write(fd, "a=${x}")
+    6
+    >>> os.close(fd)
+    >>> get_template_file(path).render({"x":"1"})
+    'a=1'
+    >>> st = os.stat(path)
+    >>> with open(path, "wb") as f:
+    ...     f.write("b=${x}")
+    >>> os.utime(path, (st.st_atime, st.st_mtime))
+    >>> get_template_file(path, use_cache=False).render({"x":"1"})
+    'b=1'
+    >>> os.remove(path)
+    """
+    return _cache.get_file_template(path, dialect, use_cache)
+
+
+def render_file(path, substitutions, dialect=ACTION_DIALECT):
+    return get_template_file(path, dialect).render(substitutions)
+
+
+def render_batch(paths, substitutions, dialect=ACTION_DIALECT):
+    """Render a list of template files with one substitution map, returning
+    the list of results. All the templates are compiled and checked for
+    missing variables before any are rendered, so that an error is found
+    before we do any work. Raises TemplateError (or KeyError, for
+    STRING_TEMPLATE_DIALECT) for the first missing variable, with the
+    path of its template in the path attribute.
+    """
+    templates = [get_template_file(path, dialect) for path in paths]
+    for (path, template) in zip(paths, templates):
+        missing = template.get_missing_variables(substitutions)
+        if len(missing)>0:
+            if dialect==ACTION_DIALECT:
+                e = TemplateError("Variable '%s' found in template %s but not in substitution map" %
+                                  (missing[0], path), missing[0])
+            else:
+                e = KeyError(missing[0])
+            e.path = path
+            raise e
+    return [template.render(substitutions) for template in templates]
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
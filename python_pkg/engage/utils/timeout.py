@@ -2,7 +2,7 @@
 utilities for timeouts, retrying
 """
 
-import time
+import engage.utils.trace as tracing
 
 
 def retry(fn, tries, time_between_tries_in_fp_secs, *args, **kwargs):
@@ -10,5 +10,6 @@ def retry(fn, tries, time_between_tries_in_fp_secs, *args, **kwargs):
         if fn(*args, **kwargs):
             return True
         else:
-            time.sleep(time_between_tries_in_fp_secs)
+            tracing.sleep(time_between_tries_in_fp_secs,
+                          action=getattr(fn, "__name__", "retry"))
     return False
@@ -0,0 +1,189 @@
+"""Opt-in tracing of resources and actions. When enabled (via the --trace
+command line option), we write a trace file in the Chrome trace-event
+format (viewable at chrome://tracing or with the engage-trace-report
+command). Each span is written as a "complete" event with the following
+fields:
+ name - resource id, action name, or "sleep"
+ cat  - the kind of span: "resource", "action", "sudo_action", or
+        "poll_sleep"
+ ts   - start time in microseconds since the epoch
+ dur  - duration in microseconds
+ pid  - the process id
+ tid  - the thread id (resources may be installed in parallel threads)
+ args - extra information, such as the resource id for an action
+
+Spans on the same thread nest by time, so an action span will appear
+inside the span for the resource being installed.
+
+The events are streamed to the file as they complete, so that we still have
+a usable trace if the install crashes. In that case, the closing bracket of
+the JSON array will be missing, which Chrome and the report command accept.
+"""
+
+import sys
+import os
+import os.path
+import time
+import json
+import threading
+import atexit
+
+TRACE_FILE_SUFFIX = ".trace.json"
+
+_tracer = None
+
+
+class Tracer(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.named_threads = set()
+        self.f = open(filename, "wb")
+        self.f.write("[\n")
+        self.first_event = True
+
+    def _write_event(self, event):
+        if self.first_event:
+            self.first_event = False
+        else:
+            self.f.write(",\n")
+        self.f.write(json.dumps(event, sort_keys=True))
+
+    def add_complete_event(self, name, cat, start_time, end_time, args):
+        """Add a span. Times are floating point seconds, as returned by
+        time.time().
+        """
+        t = threading.current_thread()
+        tid = t.ident
+        with self.lock:
+            if self.f==None:
+                return # already closed
+            if tid not in self.named_threads:
+                self.named_threads.add(tid)
+                self._write_event({"name":"thread_name", "ph":"M",
+                                   "pid":self.pid, "tid":tid,
+                                   "args":{"name":t.name}})
+            self._write_event({"name":name, "cat":cat, "ph":"X",
+                               "ts":int(start_time*1000000),
+                               "dur":int((end_time-start_time)*1000000),
+                               "pid":self.pid, "tid":tid, "args":args})
+            self.f.flush()
+
+    def close(self):
+        with self.lock:
+            if self.f!=None:
+                self.f.write("\n]\n")
+                self.f.close()
+                self.f = None
+
+
+class span(object):
+    """Context manager which records a span if tracing is enabled, e.g.:
+
+      with trace.span(a.NAME, "action", resource=self.props.id):
+          a.run(*args, **kwargs)
+
+    The keyword arguments are stored in the args property of the event. If
+    the body raises an exception, we also record the exception type.
+    """
+    def __init__(self, name, cat, **args):
+        self.name = name
+        self.cat = cat
+        self.args = args
+        self.start_time = None
+
+    def __enter__(self):
+        if _tracer!=None:
+            self.start_time = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if _tracer!=None and self.start_time!=None:
+            if exc_type!=None:
+                self.args["error"] = exc_type.__name__
+            _tracer.add_complete_event(self.name, self.cat, self.start_time,
+                                       time.time(), self.args)
+        return False
+
+
+def sleep(seconds, **args):
+    """Replacement for time.sleep() in poll loops. Records a poll_sleep
+    span so that we can see how much of an install was spent waiting.
+    """
+    with span("sleep", "poll_sleep", seconds=seconds, **args):
+        time.sleep(seconds)
+
+
+def is_tracing_enabled():
+    return _tracer!=None
+
+
+def get_trace_file():
+    """Return the name of the current trace file, or None if tracing is
+    not enabled.
+    """
+    if _tracer!=None:
+        return _tracer.filename
+    else:
+        return None
+
+
+def enable_tracing(filename):
+    global _tracer
+    if _tracer==None:
+        _tracer = Tracer(filename)
+        atexit.register(disable_tracing)
+    return _tracer
+
+
+def disable_tracing():
+    global _tracer
+    if _tracer!=None:
+        _tracer.close()
+        _tracer = None
+
+
+def add_trace_option(option_parser):
+    """Add the tracing option to an command line option parser"""
+    option_parser.add_option("--trace", action="store_true", dest="trace",
+                             default=False,
+                             help="Write a trace of resource and action timings (in Chrome trace-event format) to the log directory. Use engage-trace-report to summarize.")
+
+
+def extract_trace_options_from_options_obj(options):
+    if hasattr(options, "trace") and options.trace:
+        return ["--trace"]
+    else:
+        return []
+
+
+def parse_trace_options(options, log_directory):
+    """If tracing was requested, start a trace file in the log directory.
+    The file is named after the logfile and the process id, as a script
+    may call subprocesses that trace to the same log directory.
+    """
+    if not (hasattr(options, "trace") and options.trace):
+        return None
+    if hasattr(options, "logfile") and options.logfile:
+        base = os.path.splitext(options.logfile)[0]
+    else:
+        base = os.path.basename(sys.argv[0]).replace(".py", "")
+    filename = os.path.join(log_directory,
+                            "%s.%d%s" % (base, os.getpid(), TRACE_FILE_SUFFIX))
+    enable_tracing(filename)
+    return filename
+
+
+def read_trace_file(filename):
+    """Read the events from a trace file, tolerating a missing closing
+    bracket (from a process which did not exit cleanly).
+    """
+    with open(filename, "rb") as f:
+        data = f.read().strip()
+    if data.startswith("[") and not data.endswith("]"):
+        data = data.rstrip(",") + "]"
+    events = json.loads(data)
+    if isinstance(events, dict): # object form of the trace format
+        events = events.get("traceEvents", [])
+    return events
@@ -0,0 +1,223 @@
+"""Virtualenv templates for bootstrap.py. Creating the engage virtualenv and
+installing the bootstrap packages into it (some of which, like pycrypto,
+involve a compile) takes minutes, and is the same work for every deployment
+home on a host. Instead, we build the virtualenv once into a template
+directory, keyed by a digest of everything that goes into it (python
+executable and version, virtualenv version, and the package manifest), and
+then clone the template into each new deployment home.
+
+Virtualenvs are not relocatable: scripts, activate files, .pth/.egg-link
+files, and (on Debian) the local/ symlinks contain the absolute path of the
+virtualenv. When cloning, we rewrite any text file which contains the path
+the template was built at and re-point symlinks under it. Binary files (e.g.
+compiled extensions, whose debug info may contain the build path) are never
+rewritten, as changing the length of the path would corrupt them. Files which installers
+update in place (scripts in bin/ and .pth/.egg-link files) are copied, so
+that later installs into a clone cannot write through to the template. All
+other files are hardlinked (or copied, if hardlinking fails). Compiled
+.pyc/.pyo files are not cloned, as they record the template's source paths;
+python regenerates them on first import.
+
+This module is used by bootstrap.py before engage_utils is installed, so it
+should only depend on the standard library.
+
+>>> import tempfile
+>>> root = tempfile.mkdtemp()
+>>> def build(venv_dir):
+...     os.makedirs(os.path.join(venv_dir, "bin"))
+...     write_file(os.path.join(venv_dir, "bin/activate"),
+...                'VIRTUAL_ENV="%s"\\nPS1="(%s)$PS1"\\n' % (venv_dir, os.path.basename(venv_dir)))
+...     write_file(os.path.join(venv_dir, "bin/python"), "\\177ELF\\0%s/lib\\0" % venv_dir)
+...     os.makedirs(os.path.join(venv_dir, "lib/site-packages"))
+...     write_file(os.path.join(venv_dir, "lib/site-packages/nose.py"), "import os")
+...     write_file(os.path.join(venv_dir, "lib/site-packages/_AES.so"),
+...                "\\177ELF\\0%s/include\\0" % venv_dir)
+...     write_file(os.path.join(venv_dir, "bin/python.pyc"), "compiled")
+...     os.symlink(os.path.join(venv_dir, "bin"), os.path.join(venv_dir, "local_bin"))
+>>> key = get_template_key(["python 2.7", "virtualenv 1.7", "nose-1.0.0.tar.gz"])
+>>> template = get_virtualenv_template(os.path.join(root, "templates"), key, build, logger)
+>>> get_virtualenv_template(os.path.join(root, "templates"), key, None, logger)==template
+True
+>>> dest = os.path.join(root, "home/engage")
+>>> clone_virtualenv(template, dest, logger)
+>>> read_file(os.path.join(dest, "bin/activate"))==('VIRTUAL_ENV="%s"\\nPS1="(engage)$PS1"\\n' % dest)
+True
+>>> os.stat(os.path.join(dest, "lib/site-packages/nose.py")).st_nlink
+2
+>>> os.stat(os.path.join(dest, "bin/python")).st_nlink
+1
+>>> read_file(os.path.join(dest, "bin/python"))==read_file(os.path.join(template, "bin/python"))
+True
+>>> read_file(os.path.join(dest, "lib/site-packages/_AES.so"))==read_file(os.path.join(template, "lib/site-packages/_AES.so"))
+True
+>>> os.readlink(os.path.join(dest, "local_bin"))==os.path.join(dest, "bin")
+True
+>>> os.path.exists(os.path.join(dest, "bin/python.pyc"))
+False
+>>> shutil.rmtree(root)
+"""
+
+import os
+import os.path
+import shutil
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+# File in the template recording the directory where the template was built
+BUILD_PATH_FILE = ".engage_template_build_path"
+
+# Files larger than this are never rewritten, just linked
+MAX_FIXUP_FILE_SIZE = 1024*1024
+
+_skipped_extensions = [".pyc", ".pyo"]
+_copied_extensions = [".pth", ".egg-link"]
+_binary_extensions = [".so", ".dylib", ".a", ".o"]
+
+
+def read_file(path):
+    # don't use "with" as this should be python 2.5 compatible
+    f = open(path, "rb")
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+
+def write_file(path, data):
+    f = open(path, "wb")
+    try:
+        f.write(data)
+    finally:
+        f.close()
+
+
+def get_file_digest(path):
+    """Return the sha1 hex digest of the file's contents"""
+    h = hashlib.sha1()
+    f = open(path, "rb")
+    try:
+        while True:
+            data = f.read(65536)
+            if not data:
+                break
+            h.update(data)
+    finally:
+        f.close()
+    return h.hexdigest()
+
+
+def get_template_key(components):
+    """Return the template key for the list of strings which determine the
+    contents of the virtualenv.
+    """
+    h = hashlib.sha1()
+    for component in components:
+        h.update(component + "\n")
+    return h.hexdigest()
+
+
+def get_virtualenv_template(template_root, key, build_fn, logger):
+    """Return the path to the template virtualenv for the key, calling
+    build_fn(venv_dir) to create it if it does not already exist. The
+    template is built in a temporary directory and then renamed into place,
+    so that concurrent bootstraps on the same host never see a partial
+    template.
+    """
+    template_dir = os.path.join(template_root, key)
+    if os.path.exists(os.path.join(template_dir, BUILD_PATH_FILE)):
+        logger.info("Using virtualenv template %s" % template_dir)
+        return template_dir
+    if not os.path.exists(template_root):
+        os.makedirs(template_root)
+    build_dir = "%s.tmp-%d" % (template_dir, os.getpid())
+    if os.path.exists(build_dir):
+        shutil.rmtree(build_dir)
+    logger.info("Building virtualenv template %s" % template_dir)
+    try:
+        build_fn(build_dir)
+        write_file(os.path.join(build_dir, BUILD_PATH_FILE), build_dir)
+    except:
+        if os.path.exists(build_dir):
+            shutil.rmtree(build_dir)
+        raise
+    try:
+        os.rename(build_dir, template_dir)
+    except OSError:
+        if not os.path.exists(os.path.join(template_dir, BUILD_PATH_FILE)):
+            raise
+        # another bootstrap finished the same template first
+        logger.debug("Virtualenv template %s was created concurrently" %
+                     template_dir)
+        shutil.rmtree(build_dir)
+    return template_dir
+
+
+def _link_or_copy(src, dest):
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copy2(src, dest)
+
+
+def clone_virtualenv(template_dir, dest_dir, logger, use_hardlinks=True):
+    """Clone the template virtualenv to dest_dir, fixing up references to
+    the template's build path. dest_dir may already exist, but should not
+    contain any of the template's files.
+    """
+    build_path = read_file(os.path.join(template_dir, BUILD_PATH_FILE)).strip()
+    dest_dir = os.path.abspath(dest_dir)
+    logger.debug("Cloning virtualenv template %s to %s" % (template_dir, dest_dir))
+    num_linked = 0
+    num_copied = 0
+    num_fixed = 0
+    bin_dir = os.path.join(template_dir, "bin")
+    # the activate scripts also put the virtualenv's name in the prompt
+    build_prompt = "(%s)" % os.path.basename(build_path)
+    dest_prompt = "(%s)" % os.path.basename(dest_dir)
+    for (dirpath, dirnames, filenames) in os.walk(template_dir):
+        rel_dir = os.path.relpath(dirpath, template_dir)
+        dest_dirpath = os.path.normpath(os.path.join(dest_dir, rel_dir))
+        if not os.path.exists(dest_dirpath):
+            os.makedirs(dest_dirpath)
+            shutil.copystat(dirpath, dest_dirpath)
+        for name in dirnames + filenames:
+            src = os.path.join(dirpath, name)
+            dest = os.path.join(dest_dirpath, name)
+            if os.path.islink(src):
+                target = os.readlink(src)
+                if target==build_path or target.startswith(build_path + "/"):
+                    target = dest_dir + target[len(build_path):]
+                os.symlink(target, dest)
+                continue
+            if name in dirnames or name==BUILD_PATH_FILE or \
+               os.path.splitext(name)[1] in _skipped_extensions:
+                continue
+            data = None
+            if os.path.getsize(src)<=MAX_FIXUP_FILE_SIZE and \
+               os.path.splitext(name)[1] not in _binary_extensions:
+                data = read_file(src)
+                if build_path not in data or "\0" in data:
+                    data = None # no references, or a binary file
+            if data!=None:
+                data = data.replace(build_path, dest_dir)
+                if dirpath==bin_dir:
+                    data = data.replace(build_prompt, dest_prompt)
+                write_file(dest, data)
+                shutil.copymode(src, dest)
+                num_fixed += 1
+            elif use_hardlinks and dirpath!=bin_dir and \
+                 os.path.splitext(name)[1] not in _copied_extensions:
+                _link_or_copy(src, dest)
+                num_linked += 1
+            else:
+                shutil.copy2(src, dest)
+                num_copied += 1
+    logger.debug("Cloned virtualenv to %s: %d files fixed up, %d linked, %d copied" %
+                 (dest_dir, num_fixed, num_linked, num_copied))
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
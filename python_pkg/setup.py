@@ -18,7 +18,8 @@ setup(
             'deployer = engage.engine.deploy_spec:call_from_console_script',
             'create-distribution = engage.engine.create_distribution:call_from_console_script',
             'password_manager = engage.engine.password:main',
-            'package_report = engage.engine.package_report:main'
+            'package_report = engage.engine.package_report:main',
+            'engage-trace-report = engage.engine.trace_report:main'
             ]},
     install_requires=[],
     license='Apache V2.0',